@@ -0,0 +1,723 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import socket
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from types import GeneratorType
+
+from connection import SpreadsheetConnection
+from message_log import MessageLog
+from metrics import Metrics
+from request_handler import (
+    BUSY,
+    LOCK_BUSY,
+    SEND_TIMEOUT,
+    TIMEOUT,
+    SpreadsheetSession,
+    _error_response,
+    command_name,
+    parse_handshake,
+)
+from scheduler import SchedulerBusy
+from wire import JSON, decode_message, encode_message
+
+MAX_WORKERS = 4  # The number of threads that make calls to LibreOffice
+
+# How often, in seconds, to try again for a lock that is held elsewhere.
+# Waiters are woken when a session unlocks a replica, so this is only for the
+# locks released by the monitor thread.
+LOCK_RETRY_INTERVAL = 0.1
+
+
+class ReplicaQueue:
+    """The free replicas of a spreadsheet. They are handed to the waiting
+    connections with the highest priority first, then in order of arrival, as
+    the Scheduler does for the ThreadedTCPServer."""
+
+    def __init__(self, replicas):
+        self.free = deque(replicas)
+        self.waiters = []  # A heap of (-priority, order, future)
+        self.order = itertools.count()
+
+    async def get(self, priority=0, timeout=None):
+        """Wait for a free replica and return its index. SchedulerBusy is
+        raised if none is free within 'timeout' seconds."""
+
+        if self.free and not self.waiters:
+            return self.free.popleft()
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (-priority, next(self.order), future)
+        heapq.heappush(self.waiters, waiter)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The replica was handed over as the wait was given up.
+                self.put_nowait(future.result())
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+                heapq.heapify(self.waiters)
+
+            if isinstance(e, asyncio.TimeoutError):
+                raise SchedulerBusy("Waited too long for the spreadsheet.")
+            raise
+
+    def put_nowait(self, replica):
+        """Hand a replica that has been made free to the next waiter."""
+
+        while self.waiters:
+            future = heapq.heappop(self.waiters)[2]
+            if not future.done():
+                future.set_result(replica)
+                return
+        self.free.append(replica)
+
+
+class AsyncTCPServer:
+    """Serves clients from a single asyncio event loop instead of a thread per
+    connection.
+
+    The protocol is the same as that of the ThreadedTCPRequestHandler. Calls to
+    LibreOffice are run in a bounded pool of worker threads. Clients waiting
+    for a spreadsheet are queued per spreadsheet without holding a thread.
+
+    The interface mirrors ThreadedTCPServer: 'serve_forever' is run in its own
+    thread and 'shutdown' and 'server_close' stop it.
+    """
+
+    def __init__(self, save_path, server_address, max_workers=MAX_WORKERS):
+        self.save_path = save_path
+        self.result_cache = None
+        self.open_spreadsheet = None
+        self.unpin_spreadsheet = None
+        self.restore_replica = None
+        self.track_changes = False
+        self.reset_after_session = False
+        self.dependencies = None
+        self.sheet_indexes = {}
+        # Waiting clients are queued per spreadsheet by the event loop, so no
+        # Scheduler is used.
+        self.scheduler = None
+        self.metrics = Metrics()
+        self.metrics.queue_depths = self.queue_depths
+        self.message_log = MessageLog()
+        self.max_workers = max_workers
+
+        # Bind now so that an address in use is reported to the caller, as
+        # with socketserver.TCPServer.
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(server_address)
+            self.socket.listen()
+        except OSError:
+            self.socket.close()
+            raise
+
+        # A queue of the free replica indices for each spreadsheet.
+        self.free_replicas = {}
+
+        # The replicas of each spreadsheet shared by read-only sessions, and
+        # the number of sessions using each.
+        self.readers = {}
+        # The number of writing sessions waiting for each spreadsheet. While
+        # any are waiting, read-only sessions do not join shared replicas.
+        self.waiting_writers = {}
+        # The number of read-only sessions waiting for a free replica.
+        self.waiting_readers = {}
+
+        # A heap of the connections waiting to lock each (spreadsheet,
+        # replica), by priority and then in order of arrival. Each has an
+        # asyncio.Event that is set when it is its turn to try the lock.
+        self.lock_queues = {}
+        self.lock_order = itertools.count()
+
+        self.loop = None
+        self.__serving = threading.Event()
+        self.__stopped = threading.Event()
+
+    def serve_forever(self):
+        """Run the event loop until 'shutdown' is called."""
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        server = self.loop.run_until_complete(
+            asyncio.start_server(self.__handle, sock=self.socket)
+        )
+        self.__serving.set()
+
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+
+            # Let the open connections unlock their spreadsheets.
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True)
+            )
+
+            self.executor.shutdown()
+            self.loop.close()
+            self.__stopped.set()
+
+    def shutdown(self):
+        """Stop the event loop and wait for 'serve_forever' to return."""
+
+        if self.__serving.is_set():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.__stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+
+    def queue_depths(self):
+        """Return the number of clients waiting for each spreadsheet."""
+
+        depths = {}
+        for waiting in (self.waiting_writers, self.waiting_readers):
+            for spreadsheet, count in waiting.items():
+                if count:
+                    depths[spreadsheet] = depths.get(spreadsheet, 0) + count
+        return depths
+
+    async def __send(
+        self, writer, msg, encoding=JSON, session=None, command=None
+    ):
+        """Encode a message and send it to the client. If it is the response
+        to a command from a session, the time taken is recorded in the
+        metrics."""
+
+        start = perf_counter()
+        encoded = encode_message(msg, encoding)
+        serialized = perf_counter()
+        writer.writelines([struct.pack(">I", len(encoded)), encoded])
+        await asyncio.wait_for(writer.drain(), SEND_TIMEOUT)
+        sent = perf_counter()
+
+        spreadsheet = None
+        if session is not None:
+            spreadsheet = session.spreadsheet_name
+            self.metrics.observe(
+                "serialize", spreadsheet, command, serialized - start
+            )
+            self.metrics.observe(
+                "send", spreadsheet, command, sent - serialized
+            )
+
+        self.message_log.sent(
+            spreadsheet, command, msg, len(encoded), sent - start
+        )
+
+    async def __send_stream(
+        self, writer, frames, encoding, session, command
+    ):
+        """Send each frame of a stream as it is read. Reading the next frame
+        calls LibreOffice, so is run in the executor."""
+
+        while True:
+            frame = await self.loop.run_in_executor(
+                self.executor, next, frames, None
+            )
+            if frame is None:
+                break
+            await self.__send(writer, frame, encoding, session, command)
+
+    async def __receive(self, reader, encoding=JSON, spreadsheet=None):
+        """Receive a message from the client, decode it and return it. False
+        is returned if the connection is lost or times out. 'spreadsheet' is
+        the one the client is connected to, for the log.
+        """
+
+        try:
+            raw_msg_length = await asyncio.wait_for(
+                reader.readexactly(4), TIMEOUT
+            )
+            msg_length = struct.unpack(">I", raw_msg_length)[0]
+            recv = await asyncio.wait_for(
+                reader.readexactly(msg_length), TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logging.warning("Waited too long to recieve from the client.")
+            return False
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return False
+
+        recv_string = decode_message(recv, encoding)
+
+        self.message_log.received(spreadsheet, recv_string, msg_length)
+        return recv_string
+
+    async def __make_connection(self, reader, writer):
+        """Handle the first request from the client. A SpreadsheetSession and
+        the encoding the client asked for are returned once a replica of the
+        spreadsheet is locked, otherwise (None, JSON).
+        """
+
+        data = await self.__receive(reader)
+
+        options = parse_handshake(data)
+        if options is None:
+            logging.error(
+                "Client attempted to connect using and invalid protocol."
+            )
+            await self.__send(writer, "PROTOCOL ERROR")
+            return None, JSON
+
+        # If the spreadsheet has not been loaded yet, or is being reloaded,
+        # wait a bit and try again
+        max_attempts = self.monitor_frequency + 1
+        for attempt in range(max_attempts):
+            if self.open_spreadsheet is not None:
+                # Spreadsheets are opened when they are first asked for.
+                found = await self.loop.run_in_executor(
+                    self.executor, self.open_spreadsheet, data[1]
+                )
+            else:
+                found = data[1] in self.spreadsheets
+
+            if found:
+                try:
+                    session = await self.__start_session(data[1], options)
+                except SchedulerBusy as e:
+                    logging.info("Turned away a client: %s", e)
+                    await self.__send(writer, BUSY)
+                    return None, JSON
+                finally:
+                    if self.unpin_spreadsheet is not None:
+                        # A replica is now locked, so the spreadsheet is not
+                        # closed to make room for others.
+                        self.unpin_spreadsheet(data[1])
+
+                if session is not None:
+                    break
+
+            logging.debug("Waiting for spreadsheet")
+            await asyncio.sleep(1)
+        else:
+            logging.debug("Waited too long for spreadsheet")
+            await self.__send(writer, "NOT FOUND")
+            return None, JSON
+
+        # The client is only answered once the replica is locked, so its
+        # first request does not time out waiting for it.
+        try:
+            await self.__send(writer, "OK")
+        except BaseException:
+            self.__release(session)
+            raise
+        return session, options["encoding"]
+
+    async def __start_session(self, spreadsheet, options):
+        """Lock a replica of the spreadsheet and return a SpreadsheetSession
+        on it. None is returned if the spreadsheet has been closed, or
+        reloaded while the client waited for it. SchedulerBusy is raised if
+        the client waits longer than its queue_timeout."""
+
+        locks = self.locks.get(spreadsheet)
+        if locks is None:
+            return None
+
+        start = perf_counter()
+        if options["lock_per_request"]:
+            replica = self.__choose_replica(locks)
+        else:
+            if options["read_only"]:
+                acquire = self.__acquire_shared_replica
+            else:
+                acquire = self.__acquire_replica
+            replica = await acquire(
+                spreadsheet,
+                locks,
+                options["priority"],
+                options["queue_timeout"],
+            )
+
+            # The monitor releases the locks of a spreadsheet it has closed
+            # or reloaded, so the lock may no longer be the replica's.
+            current = self.locks.get(spreadsheet)
+            if current is None or current[replica] is not locks[replica]:
+                self.__unlock(
+                    spreadsheet, replica, locks[replica], options["read_only"]
+                )
+                return None
+
+            self.metrics.observe(
+                "lock_wait", spreadsheet, "SPREADSHEET", perf_counter() - start
+            )
+
+        # A lock_per_request session holds no lock yet, so the spreadsheet
+        # may be closed at any time. Its messages check for this.
+        replicas = self.spreadsheets.get(spreadsheet)
+        if replicas is None:
+            return None
+
+        con = SpreadsheetConnection(
+            replicas[replica],
+            locks[replica],
+            self.save_path,
+            self.track_changes,
+            None
+            if self.dependencies is None
+            else self.dependencies.get(spreadsheet),
+            self.__get_sheet_index(spreadsheet, replica),
+            options["read_only"],
+        )
+        return SpreadsheetSession(
+            con,
+            self,
+            spreadsheet,
+            replica,
+            options["lock_per_request"],
+            priority=options["priority"],
+            queue_timeout=options["queue_timeout"],
+        )
+
+    def notify_unlocked(self, spreadsheet, replica):
+        """Wake the connection waiting longest for a replica after it has been
+        unlocked. This can be called from any thread."""
+
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.__wake, spreadsheet, replica)
+
+    def __wake(self, spreadsheet, replica):
+        queue = self.lock_queues.get((spreadsheet, replica))
+        if queue:
+            queue[0][2].set()
+
+    async def __in_turn(
+        self, spreadsheet, replica, attempt, priority=0, timeout=None
+    ):
+        """Await 'attempt()' until it returns something other than LOCK_BUSY
+        and return that. Connections waiting for the same replica make their
+        attempts by priority and then in order of arrival, each once the
+        replica is unlocked, rather than tying up a worker thread waiting for
+        it. SchedulerBusy is raised if it is not done within 'timeout'
+        seconds."""
+
+        deadline = None if timeout is None else perf_counter() + timeout
+
+        key = (spreadsheet, replica)
+        queue = self.lock_queues.setdefault(key, [])
+        turn = (-priority, next(self.lock_order), asyncio.Event())
+        heapq.heappush(queue, turn)
+
+        try:
+            while True:
+                if queue[0] is turn:
+                    result = await attempt()
+                    if result is not LOCK_BUSY:
+                        return result
+
+                wait = LOCK_RETRY_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - perf_counter()
+                    if remaining <= 0:
+                        raise SchedulerBusy(
+                            "Waited too long for the spreadsheet."
+                        )
+                    wait = min(wait, remaining)
+
+                turn[2].clear()
+                try:
+                    await asyncio.wait_for(turn[2].wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            queue.remove(turn)
+            heapq.heapify(queue)
+            if queue:
+                queue[0][2].set()
+            else:
+                del self.lock_queues[key]
+
+    async def __acquire_lock(
+        self, spreadsheet, replica, acquire, priority, deadline
+    ):
+        """Acquire a replica's lock with 'acquire', its acquire or
+        acquire_read method. The lock can be held by the monitor thread or by
+        a lock_per_request session, so it is waited for in turn, until the
+        'deadline', a perf_counter time, if there is one."""
+
+        async def attempt():
+            return True if acquire(blocking=False) else LOCK_BUSY
+
+        timeout = None if deadline is None else deadline - perf_counter()
+        await self.__in_turn(spreadsheet, replica, attempt, priority, timeout)
+
+    def __choose_replica(self, locks):
+        """Return the index of a replica for a lock_per_request session,
+        without locking it. One that is not locked is preferred. 'locks' are
+        the locks of the spreadsheet's replicas."""
+
+        for replica, lock in enumerate(locks):
+            if not lock.locked():
+                return replica
+
+        return random.randrange(len(locks))
+
+    def __get_free_replicas(self, spreadsheet, locks):
+        replicas = self.free_replicas.get(spreadsheet)
+        if replicas is None:
+            replicas = ReplicaQueue(range(len(locks)))
+            self.free_replicas[spreadsheet] = replicas
+        return replicas
+
+    async def __acquire_replica(
+        self, spreadsheet, locks, priority=0, timeout=None
+    ):
+        """Wait for a free replica, lock it with 'locks', the locks of the
+        replicas, and return its index. Connections with a higher 'priority'
+        are served first. SchedulerBusy is raised if it takes longer than
+        'timeout' seconds."""
+
+        deadline = None if timeout is None else perf_counter() + timeout
+        replicas = self.__get_free_replicas(spreadsheet, locks)
+
+        self.waiting_writers[spreadsheet] = (
+            self.waiting_writers.get(spreadsheet, 0) + 1
+        )
+        try:
+            replica = await replicas.get(priority, timeout)
+        finally:
+            self.waiting_writers[spreadsheet] -= 1
+
+        try:
+            await self.__acquire_lock(
+                spreadsheet,
+                replica,
+                locks[replica].acquire,
+                priority,
+                deadline,
+            )
+        except BaseException:
+            replicas.put_nowait(replica)
+            raise
+
+        return replica
+
+    async def __acquire_shared_replica(
+        self, spreadsheet, locks, priority=0, timeout=None
+    ):
+        """Lock a replica for reading and return its index. A replica already
+        shared by read-only sessions is joined, unless a writing session is
+        waiting. Otherwise a free replica is waited for, as by
+        '__acquire_replica'."""
+
+        deadline = None if timeout is None else perf_counter() + timeout
+        shared = self.readers.setdefault(spreadsheet, {})
+
+        if shared and not self.waiting_writers.get(spreadsheet):
+            replica = min(shared, key=shared.get)
+            if locks[replica].acquire_read(blocking=False):
+                shared[replica] += 1
+                return replica
+
+        replicas = self.__get_free_replicas(spreadsheet, locks)
+
+        self.waiting_readers[spreadsheet] = (
+            self.waiting_readers.get(spreadsheet, 0) + 1
+        )
+        try:
+            replica = await replicas.get(priority, timeout)
+        finally:
+            self.waiting_readers[spreadsheet] -= 1
+
+        try:
+            await self.__acquire_lock(
+                spreadsheet,
+                replica,
+                locks[replica].acquire_read,
+                priority,
+                deadline,
+            )
+        except BaseException:
+            replicas.put_nowait(replica)
+            raise
+
+        shared[replica] = 1
+        return replica
+
+    def __get_sheet_index(self, spreadsheet, replica):
+        try:
+            return self.sheet_indexes[spreadsheet][replica]
+        except (KeyError, IndexError):
+            return None
+
+    def __release(self, session):
+        """Unlock the session's replica and make it available again. If the
+        server resets or restores replicas, this is done first."""
+
+        if session.lock_per_request:
+            # The replica is not locked between messages, so there is only a
+            # reset, if any, to do.
+            if self.reset_after_session and not session.con.read_only:
+                asyncio.ensure_future(self.__end_unlocked(session))
+            return
+
+        if session.con.read_only:
+            self.__unlock(
+                session.spreadsheet_name,
+                session.replica,
+                session.con.lock,
+                True,
+            )
+            return
+
+        # The session may have writes to make, if it was served from the
+        # result cache.
+        if (
+            self.restore_replica is None
+            and not self.reset_after_session
+            and not session.skipped_writes
+        ):
+            self.__unlock(
+                session.spreadsheet_name,
+                session.replica,
+                session.con.lock,
+                False,
+            )
+            return
+
+        replicas = self.free_replicas[session.spreadsheet_name]
+        ended = self.loop.run_in_executor(self.executor, session.end)
+        ended.add_done_callback(
+            lambda future: replicas.put_nowait(session.replica)
+        )
+
+    def __unlock(self, spreadsheet, replica, lock, read_only):
+        """Unlock a replica locked by '__acquire_replica', or for reading by
+        '__acquire_shared_replica', and make it available again."""
+
+        if read_only:
+            lock.release_read()
+        else:
+            lock.release()
+        self.__wake(spreadsheet, replica)
+
+        if read_only:
+            shared = self.readers[spreadsheet]
+            shared[replica] -= 1
+            if shared[replica] > 0:
+                return
+            del shared[replica]
+
+        self.free_replicas[spreadsheet].put_nowait(replica)
+
+    async def __run_message(self, session, data):
+        """Run a message in the executor and return the response. A
+        lock_per_request session's replica may be locked by another session,
+        in which case the message is tried again in turn once it is free."""
+
+        waiting_since = perf_counter()
+
+        def attempt():
+            return self.loop.run_in_executor(
+                self.executor,
+                session.handle_message,
+                data,
+                False,
+                waiting_since,
+            )
+
+        if not session.lock_per_request:
+            return await attempt()
+
+        try:
+            return await self.__in_turn(
+                session.spreadsheet_name,
+                session.replica,
+                attempt,
+                session.priority,
+                session.queue_timeout,
+            )
+        except SchedulerBusy as e:
+            logging.info("Turned away a message: %s", e)
+            return _error_response(data, BUSY)
+
+    async def __end_unlocked(self, session):
+        """End a lock_per_request session once its replica is free."""
+
+        async def attempt():
+            ended = await self.loop.run_in_executor(
+                self.executor, session.end, False
+            )
+            return True if ended else LOCK_BUSY
+
+        await self.__in_turn(
+            session.spreadsheet_name, session.replica, attempt
+        )
+
+    async def __handle(self, reader, writer):
+        """Make a connection to the client, run the main protocol loop and
+        close the connection.
+        """
+
+        session = None
+        try:
+            session, encoding = await self.__make_connection(reader, writer)
+            if session is not None:
+                self.metrics.open_session(session.spreadsheet_name)
+
+            while session is not None:
+                data = await self.__receive(
+                    reader, encoding, session.spreadsheet_name
+                )
+
+                if data == False:
+                    # The connection has been lost.
+                    break
+
+                response = await self.__run_message(session, data)
+                command = command_name(data)
+                if isinstance(response, GeneratorType):
+                    await self.__send_stream(
+                        writer, response, encoding, session, command
+                    )
+                elif response is not None:
+                    await self.__send(
+                        writer, response, encoding, session, command
+                    )
+
+        except ConnectionError:
+            pass
+
+        except asyncio.TimeoutError:
+            logging.warning("Waited too long to send to the client.")
+
+        finally:
+            logging.debug("Closing socket for AsyncTCPServer")
+            writer.close()
+
+            if session is not None:
+                self.metrics.close_session(session.spreadsheet_name)
+                self.__release(session)
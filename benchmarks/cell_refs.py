@@ -0,0 +1,45 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Time parsing cell references, with and without the LRU cache.
+
+Run from the root of the repository: python benchmarks/cell_refs.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connection import parse_cell_ref  # noqa: E402
+
+CELL_REFS = ["A1", "$B$7", "AMJ1048576", "C3:F75", "Sheet1!K12", "F7:B3"]
+NUMBER = 200000
+
+
+def run(parse):
+    for cell_ref in CELL_REFS:
+        parse(cell_ref)
+
+
+if __name__ == "__main__":
+    uncached = parse_cell_ref.__wrapped__
+
+    for name, parse in (("uncached", uncached), ("cached", parse_cell_ref)):
+        seconds = timeit.timeit(lambda: run(parse), number=NUMBER)
+        per_ref = seconds / (NUMBER * len(CELL_REFS)) * 1e9
+        print("%-8s %.0f ns per cell reference" % (name, per_ref))
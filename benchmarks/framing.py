@@ -0,0 +1,99 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Time sending and receiving large length-prefixed frames over a local socket
+pair, with the framing the client and server used before (a select before each
+recv, growing a bytes object) and with the current framing in wire.py.
+
+Run from the root of the repository: python benchmarks/framing.py [MB ...]
+"""
+
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wire import receive_exactly, send_frame  # noqa: E402
+
+SIZES_MB = [1, 10, 100]
+
+
+def old_send(sock, body):
+    sock.sendall(struct.pack(">I", len(body)) + body)
+
+
+def old_receive_length(sock, length):
+    data = b""
+    while len(data) < length:
+        ready = select.select([sock], [], [], 10)
+        if ready[0]:
+            packet = sock.recv(length - len(data))
+            if not packet:
+                return b""
+            data += packet
+        else:
+            return b""
+    return data
+
+
+def old_receive(sock):
+    length = struct.unpack(">I", old_receive_length(sock, 4))[0]
+    return old_receive_length(sock, length)
+
+
+def new_receive(sock):
+    length = struct.unpack(">I", receive_exactly(sock, 4))[0]
+    return receive_exactly(sock, length)
+
+
+def time_frame(send, receive, body):
+    """Return the seconds taken to send and receive one frame."""
+
+    sender, receiver = socket.socketpair()
+    try:
+        start = time.perf_counter()
+        thread = threading.Thread(target=send, args=(sender, body))
+        thread.start()
+        received = receive(receiver)
+        thread.join()
+        seconds = time.perf_counter() - start
+    finally:
+        sender.close()
+        receiver.close()
+
+    assert len(received) == len(body)
+    return seconds
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES_MB
+
+    for size in sizes:
+        body = os.urandom(size * 1024 * 1024)
+        for name, send, receive in (
+            ("old", old_send, old_receive),
+            ("new", send_frame, new_receive),
+        ):
+            seconds = time_frame(send, receive, body)
+            print(
+                "%4d MB %s %8.3f s %8.1f MB/s"
+                % (size, name, seconds, size / seconds)
+            )
@@ -14,39 +14,165 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import asyncio
 import socket
-import json
 import traceback
 import struct
-import select
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is only needed for 'get_array' and 'set_array'.
+    numpy = None
+
+from wire import (
+    ARRAY_DTYPE,
+    JSON,
+    decode_message,
+    encode_message,
+    receive_exactly,
+    send_frame,
+)
 
 IP, PORT = "localhost", 5555
 
 TIMEOUT = 10
 
+# Pooled connections are closed after this many seconds unused. This must be
+# less than the server's receive TIMEOUT, after which it drops the connection.
+POOL_IDLE_TIMEOUT = 5
+POOL_MAX_SIZE = 4  # The number of connections per spreadsheet
+
+
+def _to_numpy(received):
+    """Convert a GET_ARRAY response to a NumPy array."""
+
+    if numpy is None:
+        raise RuntimeError("NumPy is required for get_array.")
+
+    values = numpy.frombuffer(received["data"], dtype=received["dtype"])
+    return values.reshape(received["shape"])
+
+
+def _from_numpy(values):
+    """Convert a NumPy array, or anything NumPy can convert to one, to the
+    form SET_ARRAY expects."""
+
+    if numpy is None:
+        raise RuntimeError("NumPy is required for set_array.")
+
+    values = numpy.ascontiguousarray(values, dtype=ARRAY_DTYPE)
+    return {
+        "dtype": ARRAY_DTYPE,
+        "shape": list(values.shape),
+        "data": memoryview(values).cast("B"),
+    }
+
+
+class ServerBusyError(RuntimeError):
+    """Raised when the server turns a client or a message away because too
+    many are waiting for the spreadsheet. Try again later."""
+
+
+def _error(message):
+    """The exception to raise for an error returned by the server."""
+
+    if message == "BUSY":
+        return ServerBusyError("The server is busy.")
+    return RuntimeError(message)
+
+
+# The options of the SPREADSHEET handshake and the server's defaults for them.
+HANDSHAKE_DEFAULTS = {
+    "encoding": JSON,
+    "read_only": False,
+    "lock_per_request": False,
+    "priority": 0,
+    "queue_timeout": None,
+}
+
+
+def _handshake(spreadsheet, options):
+    """The SPREADSHEET message a client starts with. Options are only sent if
+    they are not the defaults, so older servers are still understood."""
+
+    options = {
+        name: value
+        for name, value in options.items()
+        if value != HANDSHAKE_DEFAULTS[name]
+    }
+
+    if not options:
+        return ["SPREADSHEET", spreadsheet]
+    return ["SPREADSHEET", spreadsheet, options]
+
 
 class SpreadsheetClient:
-    def __init__(self, spreadsheet, ip=IP, port=PORT):
+    def __init__(
+        self,
+        spreadsheet,
+        ip=IP,
+        port=PORT,
+        encoding=JSON,
+        read_only=False,
+        lock_per_request=False,
+        priority=0,
+        queue_timeout=None,
+    ):
+        """Connect to the server and the spreadsheet.
+
+        With 'read_only', the spreadsheet is shared with other read-only
+        clients and cells can not be set. With 'lock_per_request', the
+        spreadsheet is only locked while each message, e.g. a transaction or
+        a batch, is run, so other clients can use it in between. Deferred
+        calculation then only lasts until the end of each message.
+
+        While the spreadsheet is busy, clients with a higher 'priority' are
+        served first. ServerBusyError is raised if the server turns the client
+        away, for example after waiting 'queue_timeout' seconds.
+        """
+
+        # Messages are JSON until the server has accepted the encoding.
+        self.encoding = JSON
         try:
             self.sock = self.__connect(ip, port)
         except socket.error:
             raise RuntimeError("Could not connect to the server.")
         else:
-            self.__set_spreadsheet(spreadsheet)
+            self.__set_spreadsheet(
+                spreadsheet,
+                {
+                    "encoding": encoding,
+                    "read_only": read_only,
+                    "lock_per_request": lock_per_request,
+                    "priority": priority,
+                    "queue_timeout": queue_timeout,
+                },
+            )
 
     def __connect(self, ip, port):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((ip, port))
+        sock.settimeout(TIMEOUT)
         return sock
 
-    def __set_spreadsheet(self, spreadsheet):
-        self.__send(["SPREADSHEET", spreadsheet])
+    def __set_spreadsheet(self, spreadsheet, options):
+        self.__send(_handshake(spreadsheet, options))
         received = self.__receive()
 
+        if received == "BUSY":
+            self.disconnect()
+            raise _error(received)
+
         if received == "NOT FOUND" or received != "OK":
             self.disconnect()
             raise RuntimeError("The requested spreadsheet was not found.")
 
+        self.encoding = options["encoding"]
+
     def set_cells(self, sheet, cell_ref, data):
         """Set the value(s) for a single cell or a cell range.
 
@@ -67,7 +193,7 @@ class SpreadsheetClient:
         received = self.__receive()
         if type(received) == dict:
             # The server is retuning an error
-            raise RuntimeError(received["ERROR"])
+            raise _error(received["ERROR"])
 
     def get_sheet_names(self):
         """Returns a list of all sheet names in the workbook."""
@@ -98,10 +224,168 @@ class SpreadsheetClient:
 
         if type(cells) == dict:
             # The server is retuning an error
-            raise RuntimeError(cells["ERROR"])
+            raise _error(cells["ERROR"])
+
+        return cells
+
+    def get_cells_stream(self, sheet, cell_ref, chunk_rows=None):
+        """Get the values of a cell range from the server in blocks of rows.
+
+        A generator is returned that yields each block, a list of at most
+        'chunk_rows' rows each a list of cell values, as it arrives. Neither
+        side holds more than one block in memory, so this suits very large
+        ranges. The server's default block size is used if 'chunk_rows' is
+        None. The connection can not be used for anything else until the
+        generator is finished or closed.
+
+        See 'get_cells' for the other arguments.
+        """
+
+        if chunk_rows is None:
+            self.__send(["GET_STREAM", sheet, cell_ref])
+        else:
+            self.__send(["GET_STREAM", sheet, cell_ref, chunk_rows])
+
+        finished = False
+        try:
+            while True:
+                frame = self.__receive()
+
+                if frame == False:
+                    raise Exception("Connection to server closed!")
+
+                if type(frame) == dict:
+                    # The server is retuning an error
+                    finished = True
+                    raise _error(frame["ERROR"])
+
+                if frame[0] == "END":
+                    finished = True
+                    return
+
+                yield frame[1]
+        finally:
+            # Read the rest of a stream that was not finished with so that the
+            # connection can be used again.
+            while not finished:
+                frame = self.__receive()
+                finished = (
+                    frame == False or type(frame) == dict or frame[0] == "END"
+                )
+
+    def set_many(self, sheet, cells):
+        """Set the values of many single cells that need not be next to each
+        other.
+
+        'sheet' is either a 0-based index or the string name of the sheet.
+        'cells' is a dictionary of LibreOffice style cell references to
+        values. eg. {"B3": 1, "F7": 2, "K12": "text"}.
+        """
+
+        self.__send(["SET_MANY", sheet, cells])
+
+        received = self.__receive()
+        if type(received) == dict:
+            # The server is retuning an error
+            raise _error(received["ERROR"])
+
+    def get_many(self, sheet, cell_refs):
+        """Get the values of many single cells that need not be next to each
+        other.
+
+        'sheet' is either a 0-based index or the string name of the sheet.
+        'cell_refs' is a list of LibreOffice style cell references.
+        eg. ["B3", "F7", "K12"].
+
+        A dictionary of each cell reference to its value is returned.
+        """
+
+        self.__send(["GET_MANY", sheet, cell_refs])
+        cells = self.__receive()
+
+        if type(cells) == dict and "ERROR" in cells:
+            # The server is retuning an error
+            raise _error(cells["ERROR"])
 
         return cells
 
+    def get_array(self, sheet, cell_ref):
+        """Get the values of a cell range as a two dimensional NumPy array of
+        float64s. Empty and text cells are NaN.
+
+        The values are sent as a float64 buffer, rather than as a list of
+        values, so this is much quicker for large numeric ranges. NumPy must
+        be installed.
+
+        See 'get_cells' for the arguments.
+        """
+
+        self.__send(["GET_ARRAY", sheet, cell_ref])
+        received = self.__receive()
+
+        if "ERROR" in received:
+            # The server is retuning an error
+            raise _error(received["ERROR"])
+
+        return _to_numpy(received)
+
+    def set_array(self, sheet, cell_ref, values):
+        """Set the values of a cell range from a NumPy array. Cells that are
+        NaN are emptied.
+
+        'values' must have a value for each cell. It is two dimensional, or
+        one dimensional for a row or column of cells. See 'get_array'.
+        """
+
+        self.__send(["SET_ARRAY", sheet, cell_ref, _from_numpy(values)])
+        received = self.__receive()
+
+        if type(received) == dict:
+            # The server is retuning an error
+            raise _error(received["ERROR"])
+
+    def transaction(self, operations):
+        """Run a list of operations on the server in a single round trip and
+        return a list of their results.
+
+        Each operation is a list in the same form as the message for a single
+        request: ["SET", sheet, cell_ref, data], ["GET", sheet, cell_ref],
+        ["SET_MANY", sheet, cells], ["GET_MANY", sheet, cell_refs] or
+        ["GET_SHEETS"]. The results are in the same order as the operations.
+        None is returned for a SET or SET_MANY. A RuntimeError is raised for
+        the first operation the server reports as failed.
+        """
+
+        self.__send(["TRANSACTION", operations])
+        received = self.__receive()
+
+        if type(received) == dict:
+            # The server is retuning an error
+            raise _error(received["ERROR"])
+
+        results = []
+        for result in received:
+            if type(result) == dict and "ERROR" in result:
+                raise _error(result["ERROR"])
+            results.append(None if result == "OK" else result)
+
+        return results
+
+    def batch(self):
+        """Return a SpreadsheetBatch that collects operations to be sent to
+        the server in a single round trip.
+
+        It can be used as a context manager:
+
+        with sc.batch() as batch:
+            batch.set_cells("Sheet1", "A1", 5)
+            c3 = batch.get_cells("Sheet1", "C3")
+
+        print(c3.value)
+        """
+
+        return SpreadsheetBatch(self)
+
     def save_spreadsheet(self, filename):
         """Save the spreadsheet in its current state on the server. The
         server determines where it is saved."""
@@ -109,24 +393,91 @@ class SpreadsheetClient:
         self.__send(["SAVE", filename])
         return self.__receive()
 
-    def __send(self, msg):
-        """Encode msg into json and then send it over the socket."""
+    def affected(self, sheet, cell_refs):
+        """Return which of the single cells in 'cell_refs' have been set, or
+        depend on cells that have been set, during this session. The server
+        must be indexing dependencies.
+
+        'sheet' is either a 0-based index or the string name of the sheet.
+        """
+
+        self.__send(["AFFECTED", sheet, cell_refs])
 
-        json_msg = json.dumps(msg)
-        json_msg = bytes(json_msg, "utf-8")
+        received = self.__receive()
+        if type(received) == dict:
+            # The server is retuning an error
+            raise _error(received["ERROR"])
+
+        return received
+
+    def defer_calculation(self, deferred=True):
+        """Turn deferred calculation on or off for the rest of the session.
+
+        While it is on, the server does not recalculate the spreadsheet after
+        each cell is set. It is recalculated once before cells are next read,
+        or when 'recalculate' is called.
+        """
 
-        # Prepend the length of the string to the meg
-        json_msg = struct.pack(">I", len(json_msg)) + json_msg
+        self.__send(["DEFER_CALCULATION", deferred])
+
+        received = self.__receive()
+        if type(received) == dict:
+            # The server is retuning an error
+            raise _error(received["ERROR"])
+
+    def recalculate(self):
+        """Recalculate the spreadsheet now."""
+
+        self.__send(["RECALC"])
+
+        received = self.__receive()
+        if type(received) == dict:
+            # The server is retuning an error
+            raise _error(received["ERROR"])
+
+    def reset(self):
+        """Restore every cell set since connecting, or since the last reset,
+        to its original contents. The server must be tracking changes."""
+
+        self.__send(["RESET"])
+
+        received = self.__receive()
+        if type(received) == dict:
+            # The server is retuning an error
+            raise _error(received["ERROR"])
+
+    def get_stats(self):
+        """Return the server's metrics: the number of messages and errors,
+        latency histograms for each stage of handling them, the open sessions
+        and the number of clients waiting, per spreadsheet and per command.
+        """
+
+        self.__send(["STATS"])
+        return self.__receive()
+
+    def ping(self):
+        """Check that the connection to the server is still usable. True or
+        False is returned."""
 
         try:
-            self.sock.sendall(json_msg)
+            self.__send(["PING"])
+            return self.__receive() == "OK"
+        except Exception:
+            return False
+
+    def __send(self, msg):
+        """Encode msg and then send it over the socket."""
+
+        encoded = encode_message(msg, self.encoding)
+
+        try:
+            send_frame(self.sock, encoded)
         except:  # noqa
             traceback.print_exc()
             raise Exception("Could not send message to server")
 
     def __receive(self):
-        """Receive a message from the client, convert the received utf-8
-        bytes into a string then decode if from json."""
+        """Receive a message from the server and decode it."""
 
         raw_msg_length = self.__receive_length(4)
         if not raw_msg_length:
@@ -135,43 +486,520 @@ class SpreadsheetClient:
 
         recv = self.__receive_length(msg_length)
 
-        if recv == b"":
+        if not recv:
             # The connection has been closed.
             raise Exception("Connection to server closed!")
 
-        received = str(recv, encoding="utf-8")
-        received = json.loads(received)
+        return decode_message(recv, self.encoding)
+
+    def __receive_length(self, length):
+        """Receive length number of bytes from the server."""
+
+        try:
+            data = receive_exactly(self.sock, length)
+        except socket.timeout:
+            # Did not recieve on the socket within the timeout
+            return b""
+
+        return b"" if data is None else data
+
+    def disconnect(self):
+        """Disconnect from the server."""
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # The client has already disconnected
+            pass
+
+        self.sock.close()
+
+
+class SpreadsheetClientPool:
+    """A thread safe pool of SpreadsheetClients that are already connected to
+    their spreadsheets.
+
+    Reusing a connection saves connecting to the server and the SPREADSHEET
+    handshake for each use. A pooled connection keeps a replica of its
+    spreadsheet locked on the server while it is open, so 'max_size' should
+    not be more than the server's soffice instances if other clients also use
+    the spreadsheet, unless 'lock_per_request' is used.
+
+    with pool.connection("example.ods") as sc:
+        sc.get_cells("Sheet1", "A1")
+    """
+
+    def __init__(
+        self,
+        ip=IP,
+        port=PORT,
+        max_size=POOL_MAX_SIZE,
+        idle_timeout=POOL_IDLE_TIMEOUT,
+        encoding=JSON,
+        read_only=False,
+        lock_per_request=False,
+        priority=0,
+        queue_timeout=None,
+    ):
+        self.ip = ip
+        self.port = port
+        self.encoding = encoding
+        self.read_only = read_only
+        self.lock_per_request = lock_per_request
+        self.priority = priority
+        self.queue_timeout = queue_timeout
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+        self.idle = {}  # spreadsheet: a list of (client, time last used)
+        self.size = {}  # spreadsheet: the number of open clients
+        self.condition = threading.Condition()
+
+    def __discard(self, spreadsheet, client):
+        """Disconnect a client taken out of the pool and make space for
+        another. The condition must not be held, as this talks to the
+        server."""
+
+        client.disconnect()
+        with self.condition:
+            self.size[spreadsheet] -= 1
+            self.condition.notify()
+
+    def acquire(self, spreadsheet):
+        """Return a connected SpreadsheetClient for the spreadsheet, waiting
+        for one to be released if 'max_size' are in use."""
+
+        while True:
+            with self.condition:
+                while True:
+                    idle = self.idle.setdefault(spreadsheet, [])
+                    if idle:
+                        client, last_used = idle.pop()
+                        break
+
+                    if self.size.get(spreadsheet, 0) < self.max_size:
+                        self.size[spreadsheet] = (
+                            self.size.get(spreadsheet, 0) + 1
+                        )
+                        client = None
+                        break
+
+                    self.condition.wait()
+
+            if client is None:
+                break
+
+            # The client is out of the pool, so other threads can use the
+            # pool while it is checked.
+            if (
+                time.monotonic() - last_used <= self.idle_timeout
+                and client.ping()
+            ):
+                return client
+            self.__discard(spreadsheet, client)
+
+        try:
+            return SpreadsheetClient(
+                spreadsheet,
+                self.ip,
+                self.port,
+                self.encoding,
+                self.read_only,
+                self.lock_per_request,
+                self.priority,
+                self.queue_timeout,
+            )
+        except RuntimeError:
+            with self.condition:
+                self.size[spreadsheet] -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, spreadsheet, client):
+        """Return a client to the pool."""
+
+        with self.condition:
+            self.idle.setdefault(spreadsheet, []).append(
+                (client, time.monotonic())
+            )
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self, spreadsheet):
+        """A context manager that acquires a client and releases it again."""
+
+        client = self.acquire(spreadsheet)
+        try:
+            yield client
+        finally:
+            self.release(spreadsheet, client)
+
+    def close(self):
+        """Disconnect all the idle clients."""
+
+        with self.condition:
+            idle = self.idle
+            self.idle = {}
+
+        for spreadsheet, clients in idle.items():
+            for client, last_used in clients:
+                self.__discard(spreadsheet, client)
+
+
+class BatchResult:
+    """The result of an operation in a SpreadsheetBatch. 'value' is set once
+    the batch has been run."""
+
+    def __init__(self):
+        self.value = None
+
+
+class SpreadsheetBatch:
+    """Collects SET, GET, SET_MANY, GET_MANY and GET_SHEETS operations and
+    runs them on the server as one transaction.
+
+    The operations are run when 'run' is called or, when used as a context
+    manager, on leaving the 'with' block without an exception.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+        self.results = []
+
+    def set_cells(self, sheet, cell_ref, data):
+        """Add setting a single cell or a cell range to the batch.
+
+        See 'SpreadsheetClient.set_cells' for the arguments.
+        """
+
+        return self.__add(["SET", sheet, cell_ref, data])
+
+    def get_cells(self, sheet, cell_ref):
+        """Add getting a single cell or a cell range to the batch. A
+        BatchResult is returned that holds the cell value(s) once the batch
+        has been run.
+
+        See 'SpreadsheetClient.get_cells' for the arguments.
+        """
+
+        return self.__add(["GET", sheet, cell_ref])
+
+    def set_many(self, sheet, cells):
+        """Add setting many single cells to the batch.
+
+        See 'SpreadsheetClient.set_many' for the arguments.
+        """
+
+        return self.__add(["SET_MANY", sheet, cells])
+
+    def get_many(self, sheet, cell_refs):
+        """Add getting many single cells to the batch. A BatchResult is
+        returned that holds a dictionary of the cell values once the batch has
+        been run.
+
+        See 'SpreadsheetClient.get_many' for the arguments.
+        """
+
+        return self.__add(["GET_MANY", sheet, cell_refs])
+
+    def get_sheet_names(self):
+        """Add getting the sheet names to the batch. A BatchResult is returned
+        that holds the sheet names once the batch has been run."""
+
+        return self.__add(["GET_SHEETS"])
+
+    def __add(self, operation):
+        result = BatchResult()
+        self.operations.append(operation)
+        self.results.append(result)
+        return result
+
+    def run(self):
+        """Send all the operations to the server and return a list of their
+        results."""
+
+        values = self.client.transaction(self.operations)
+        for result, value in zip(self.results, values):
+            result.value = value
+
+        self.operations = []
+        self.results = []
+        return values
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.run()
+
+
+class AsyncSpreadsheetClient:
+    """An asyncio client for the server.
+
+    Several requests can be in flight on the one connection at the same time,
+    for example with asyncio.gather. Each request is tagged with an id and
+    matched to its response when it arrives.
+
+    Use 'connect' to create a connected client:
+
+    sc = await AsyncSpreadsheetClient.connect("example.ods")
+    a1, c3 = await asyncio.gather(
+        sc.get_cells("Sheet1", "A1"), sc.get_cells("Sheet1", "C3")
+    )
+    await sc.disconnect()
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.encoding = JSON
+        self.next_id = 0
+        self.pending = {}  # id: the future waiting for its response
+        self.receiver = None
+
+    @classmethod
+    async def connect(
+        cls,
+        spreadsheet,
+        ip=IP,
+        port=PORT,
+        encoding=JSON,
+        read_only=False,
+        lock_per_request=False,
+        priority=0,
+        queue_timeout=None,
+    ):
+        """Connect to the server and the spreadsheet and return a client.
+
+        See 'SpreadsheetClient' for the arguments.
+        """
+
+        try:
+            reader, writer = await asyncio.open_connection(ip, port)
+        except OSError:
+            raise RuntimeError("Could not connect to the server.")
+
+        client = cls(reader, writer)
+        await client.__set_spreadsheet(
+            spreadsheet,
+            {
+                "encoding": encoding,
+                "read_only": read_only,
+                "lock_per_request": lock_per_request,
+                "priority": priority,
+                "queue_timeout": queue_timeout,
+            },
+        )
+        return client
+
+    async def __set_spreadsheet(self, spreadsheet, options):
+        await self.__send(_handshake(spreadsheet, options))
+        received = await self.__receive()
+
+        if received == "BUSY":
+            await self.disconnect()
+            raise _error(received)
+
+        if received != "OK":
+            await self.disconnect()
+            raise RuntimeError("The requested spreadsheet was not found.")
+
+        self.encoding = options["encoding"]
+
+        self.receiver = asyncio.ensure_future(self.__receive_responses())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        await self.disconnect()
+
+    async def __send(self, msg):
+        """Encode msg and then send it over the socket."""
+
+        encoded = encode_message(msg, self.encoding)
+        self.writer.writelines([struct.pack(">I", len(encoded)), encoded])
+        await self.writer.drain()
+
+    async def __receive(self):
+        """Receive a message from the server and decode it. False is returned
+        if the connection is closed."""
+
+        try:
+            raw_msg_length = await self.reader.readexactly(4)
+            msg_length = struct.unpack(">I", raw_msg_length)[0]
+            recv = await self.reader.readexactly(msg_length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return False
+
+        return decode_message(recv, self.encoding)
+
+    async def __receive_responses(self):
+        """Pass each response from the server to the request waiting for it."""
+
+        while True:
+            received = await self.__receive()
+            if received == False:
+                break
+
+            future = self.pending.pop(received[1], None)
+            if future is not None and not future.done():
+                future.set_result(received[2])
+
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(
+                    RuntimeError("Connection to server closed!")
+                )
+        self.pending = {}
+
+    async def __request(self, msg):
+        """Send a message to the server and return the response to it."""
+
+        if self.receiver is None or self.receiver.done():
+            raise RuntimeError("Connection to server closed!")
+
+        request_id = self.next_id
+        self.next_id += 1
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+
+        await self.__send(["REQUEST", request_id, msg])
+        received = await future
+
+        if type(received) == dict and "ERROR" in received:
+            # The server is retuning an error
+            raise _error(received["ERROR"])
 
         return received
 
-    def __receive_length(self, length):
-        """Receive length number of bytes from the client."""
+    async def set_cells(self, sheet, cell_ref, data):
+        """Set the value(s) for a single cell or a cell range.
+
+        See 'SpreadsheetClient.set_cells' for the arguments.
+        """
 
-        data = b""
-        while len(data) < length:
+        await self.__request(["SET", sheet, cell_ref, data])
 
-            ready = select.select([self.sock], [], [], TIMEOUT)
+    async def get_cells(self, sheet, cell_ref):
+        """Get the value of a single cell or a cell range.
 
-            if ready[0]:
+        See 'SpreadsheetClient.get_cells' for the arguments and the returned
+        value(s).
+        """
+
+        return await self.__request(["GET", sheet, cell_ref])
 
-                packet = self.sock.recv(length - len(data))
-                if not packet:
-                    return b""
-                data += packet
+    async def set_many(self, sheet, cells):
+        """Set the values of many single cells.
 
-            else:
-                # Did not recieve on the socket within the timeout
-                return b""
+        See 'SpreadsheetClient.set_many' for the arguments.
+        """
 
-        return data
+        await self.__request(["SET_MANY", sheet, cells])
 
-    def disconnect(self):
+    async def get_many(self, sheet, cell_refs):
+        """Get the values of many single cells.
+
+        See 'SpreadsheetClient.get_many' for the arguments and the returned
+        values.
+        """
+
+        return await self.__request(["GET_MANY", sheet, cell_refs])
+
+    async def get_array(self, sheet, cell_ref):
+        """Get the values of a cell range as a NumPy array.
+
+        See 'SpreadsheetClient.get_array' for the arguments and the returned
+        values.
+        """
+
+        received = await self.__request(["GET_ARRAY", sheet, cell_ref])
+        return _to_numpy(received)
+
+    async def set_array(self, sheet, cell_ref, values):
+        """Set the values of a cell range from a NumPy array.
+
+        See 'SpreadsheetClient.set_array' for the arguments.
+        """
+
+        await self.__request(
+            ["SET_ARRAY", sheet, cell_ref, _from_numpy(values)]
+        )
+
+    async def get_sheet_names(self):
+        """Returns a list of all sheet names in the workbook."""
+
+        return await self.__request(["GET_SHEETS"])
+
+    async def transaction(self, operations):
+        """Run a list of operations on the server in a single round trip.
+
+        See 'SpreadsheetClient.transaction' for the operations and the
+        returned results.
+        """
+
+        results = []
+        for result in await self.__request(["TRANSACTION", operations]):
+            if type(result) == dict and "ERROR" in result:
+                raise _error(result["ERROR"])
+            results.append(None if result == "OK" else result)
+
+        return results
+
+    async def affected(self, sheet, cell_refs):
+        """Return which of the cells in 'cell_refs' are affected by the cells
+        set during this session.
+
+        See 'SpreadsheetClient.affected'.
+        """
+
+        return await self.__request(["AFFECTED", sheet, cell_refs])
+
+    async def defer_calculation(self, deferred=True):
+        """Turn deferred calculation on or off for the rest of the session.
+
+        See 'SpreadsheetClient.defer_calculation'.
+        """
+
+        await self.__request(["DEFER_CALCULATION", deferred])
+
+    async def recalculate(self):
+        """Recalculate the spreadsheet now."""
+
+        await self.__request(["RECALC"])
+
+    async def reset(self):
+        """Restore the cells set since connecting to their original contents.
+
+        See 'SpreadsheetClient.reset'.
+        """
+
+        await self.__request(["RESET"])
+
+    async def get_stats(self):
+        """Return the server's metrics. See 'SpreadsheetClient.get_stats'."""
+
+        return await self.__request(["STATS"])
+
+    async def save_spreadsheet(self, filename):
+        """Save the spreadsheet in its current state on the server. The
+        server determines where it is saved."""
+
+        return await self.__request(["SAVE", filename])
+
+    async def disconnect(self):
         """Disconnect from the server."""
 
+        self.writer.close()
         try:
-            self.sock.shutdown(socket.SHUT_RDWR)
-        except socket.error:
+            await self.writer.wait_closed()
+        except ConnectionError:
             # The client has already disconnected
             pass
 
-        self.sock.close()
+        if self.receiver is not None:
+            await self.receiver
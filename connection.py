@@ -16,84 +16,201 @@
 # USA.
 
 import logging
-from math import pow
+import re
+import sys
+from array import array
+from functools import lru_cache
 from werkzeug.utils import secure_filename
+from wire import ARRAY_DTYPE
 from threading import ThreadError
 import os
 
 
 CELL_REF_ERROR_STR = "Cell range is invalid."
 
+CELL_REF_CACHE_SIZE = 4096  # The number of parsed cell references to keep
+
+STREAM_CHUNK_ROWS = 1000  # The default number of rows per streamed block
+
+# A single cell or a cell range with an optional sheet name, e.g. "A1",
+# "$B$2", "A1:C3" or "'My sheet'!A1:C3".
+CELL_REF_RE = re.compile(
+    r"(?:(?:'(?P<quoted_sheet>(?:[^']|'')+)'|(?P<sheet>[^!':]+))!)?"
+    r"\$?(?P<column>[A-Za-z]{1,3})\$?(?P<row>[0-9]{1,7})"
+    r"(?::\$?(?P<end_column>[A-Za-z]{1,3})\$?(?P<end_row>[0-9]{1,7}))?"
+)
+
+
+def column_to_index(letters):
+    """Convert column letters, e.g. "AMJ", to a zero-based index."""
+
+    index = 0
+    for c in letters.upper():
+        index = index * 26 + ord(c) - 64
+    return index - 1
+
+
+def parse_cell_ref(cell_ref):
+    """Parse a LibreOffice style cell reference.
+
+    Returned is (sheet, row_start, row_end, column_start, column_end) with
+    zero-based indices. 'sheet' is None if the reference does not name one.
+    Reversed ranges are flipped so that the start is never after the end.
+
+    A ValueError is raised for an invalid reference.
+    """
+
+    # Only strings are cached, as a client may send any JSON value.
+    if type(cell_ref) is not str:
+        raise ValueError(CELL_REF_ERROR_STR)
+
+    return _parse_cell_ref(cell_ref)
+
+
+@lru_cache(maxsize=CELL_REF_CACHE_SIZE)
+def _parse_cell_ref(cell_ref):
+    match = CELL_REF_RE.fullmatch(cell_ref)
+    if match is None:
+        raise ValueError(CELL_REF_ERROR_STR)
+
+    sheet = match.group("sheet")
+    if match.group("quoted_sheet") is not None:
+        sheet = match.group("quoted_sheet").replace("''", "'")
+
+    row_start = int(match.group("row")) - 1
+    column_start = column_to_index(match.group("column"))
+
+    if match.group("end_row") is None:
+        row_end, column_end = row_start, column_start
+    else:
+        row_end = int(match.group("end_row")) - 1
+        column_end = column_to_index(match.group("end_column"))
+
+    row_start, row_end = sorted((row_start, row_end))
+    column_start, column_end = sorted((column_start, column_end))
+
+    # Rows are 1 to 1048576 and columns A to AMJ (1024).
+    if row_start < 0 or row_end >= 1048576 or column_end >= 1024:
+        raise ValueError(CELL_REF_ERROR_STR)
+
+    return sheet, row_start, row_end, column_start, column_end
+
+
+class SheetIndex:
+    """The sheets of a pyoo spreadsheet by name and by position.
+
+    Listing the sheets through UNO on every request is slow, so this is built
+    once when a spreadsheet is opened and rebuilt with 'refresh' only when a
+    sheet is not found in it, as sheets may have been added since.
+    """
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.refresh()
+
+    def refresh(self):
+        sheets = list(self.spreadsheet.sheets)
+
+        self.names = [sheet.name for sheet in sheets]
+        self.by_position = sheets
+        self.by_name = dict(zip(self.names, sheets))
+        self.name_of = dict(
+            (id(sheet), name) for sheet, name in zip(sheets, self.names)
+        )
+
+    def get(self, sheet):
+        """Return the pyoo sheet for a 0-based index or a sheet name."""
+
+        if type(sheet) is int:
+            return self.by_position[sheet]
+        return self.by_name[sheet]
+
+    def __contains__(self, sheet):
+        if type(sheet) is int:
+            return 0 <= sheet < len(self.names)
+        return sheet in self.by_name
+
 
 class SpreadsheetConnection:
     """Handles connections to the spreadsheets opened by soffice (LibreOffice).
     """
 
-    def __init__(self, spreadsheet, lock, save_path):
+    def __init__(
+        self,
+        spreadsheet,
+        lock,
+        save_path,
+        track_changes=False,
+        dependencies=None,
+        sheet_index=None,
+        read_only=False,
+    ):
         self.spreadsheet = spreadsheet
         self.lock = lock
         self.save_path = save_path
 
-    def lock_spreadsheet(self):
-        """Lock the spreadsheet.
+        # A read-only connection holds 'lock', a ReaderWriterLock, for reading
+        # and so shares the spreadsheet with other readers. Cells can not be
+        # set through it.
+        self.read_only = read_only
+
+        # The SheetIndex built when the spreadsheet was opened, if there is
+        # one. Otherwise it is built when it is first needed.
+        self.__sheet_index = sheet_index
+
+        # The DependencyIndex of the spreadsheet, if it has been built. It is
+        # used to skip deferred calculations that the cells being read do not
+        # depend on, and to report which cells are affected by changes.
+        self.dependencies = dependencies
+        self.changed_cells = set()  # Set since connecting or the last reset
+        self.pending_cells = set()  # Set since the last calculation
+
+        # Whether to record the original contents of the cells that are set
+        # so that 'reset' can restore them.
+        self.track_changes = track_changes
+        self.original_formulas = {}  # sheet name: {(row, column): formula}
+
+        # With deferred calculation, automatic calculation is turned off and
+        # formulas are only recalculated, once, before cells are next read.
+        self.deferred_calculation = False
+        self.calculation_pending = False
+
+    def lock_spreadsheet(self, blocking=True, timeout=-1):
+        """Lock the spreadsheet and return whether it was locked.
 
         The getting and setting cell functions rely on a given spreadsheet
         being locked. This insures simulations requests to the same spreadsheet
-        do not interfere with one another.
+        do not interfere with one another. 'blocking' and 'timeout' are as for
+        threading.Lock.acquire.
         """
 
-        self.lock.acquire()
+        if self.read_only:
+            return self.lock.acquire_read(blocking, timeout)
+        return self.lock.acquire(blocking, timeout)
 
     def unlock_spreadsheet(self):
         """ Unlock the spreadsheet and return a 'success' boolean."""
 
         try:
-            self.lock.release()
+            if self.read_only:
+                self.lock.release_read()
+            else:
+                self.lock.release()
             return True
         except (RuntimeError, ThreadError):
             return False
 
     def __get_xy_index(self, cell_ref):
-        chars = [c for c in cell_ref if c.isalpha()]
-        nums = [n for n in cell_ref if n.isdigit()]
-
-        alpha_index = 0
-        for i, c in enumerate(chars):
-            # The base index for this character is in the range of 0 to 25
-            c_index = ord(c.upper()) - 65
-
-            if i == len(chars) - 1:
-                # The simple case of the least significant character.
-                # Eg. The 'J' in 'AMJ'.
-                alpha_index += c_index
-
-            else:
-                # The index for additional characters to the left are
-                # calculated c_index * 26^(n) where n is the characters
-                # position to the left.
-
-                # Need to increment c_index for correct multiplication
-                c_index += 1
-                alpha_index += c_index * pow(26, len(chars) - i - 1)
+        """Return the zero-based (column, row) index of a single cell."""
 
-        num_index = int("".join(nums)) - 1  # zero-based
-        alpha_index = int(alpha_index)
-
-        # Check max values
-        # Column can not be > AMJ == 1023
-        if alpha_index >= 1024:
-            raise ValueError(CELL_REF_ERROR_STR)
-
-        # Row can not be > 1048576
-        if num_index >= 1048576:
-            raise ValueError(CELL_REF_ERROR_STR)
-
-        return alpha_index, num_index
+        sheet, row, row_end, column, column_end = parse_cell_ref(cell_ref)
+        return column, row
 
     def __is_single_cell(self, cell_ref):
-        if len(cell_ref.split(":")) == 1:
-            return True
-        return False
+        """A range of one cell, e.g. "A1:A1", is also a single cell."""
+
+        sheet, r_start, r_end, c_start, c_end = parse_cell_ref(cell_ref)
+        return r_start == r_end and c_start == c_end
 
     def __check_single_cell(self, cell_ref):
         if not self.__is_single_cell(cell_ref):
@@ -124,19 +241,119 @@ class SpreadsheetConnection:
         "column_start": int, "column_end": int}
         """
 
-        left_ref, right_ref = cell_ref.split(":")
-
-        left_alpha_index, left_num_index = self.__get_xy_index(left_ref)
-        right_alpha_index, right_num_index = self.__get_xy_index(right_ref)
+        sheet, r_start, r_end, c_start, c_end = parse_cell_ref(cell_ref)
 
         return {
-            "row_start": left_num_index,
-            "row_end": right_num_index,
-            "column_start": left_alpha_index,
-            "column_end": right_alpha_index,
+            "row_start": r_start,
+            "row_end": r_end,
+            "column_start": c_start,
+            "column_end": c_end,
         }
 
+    @property
+    def sheet_index(self):
+        if self.__sheet_index is None:
+            self.__sheet_index = SheetIndex(self.spreadsheet)
+        return self.__sheet_index
+
+    def __get_sheet(self, sheet):
+        """Return the pyoo sheet for a 0-based index or a sheet name."""
+
+        return self.sheet_index.get(sheet)
+
+    def __get_sheet_name(self, sheet):
+        """Return the name of a pyoo sheet."""
+
+        return self.sheet_index.name_of[id(sheet)]
+
+    def defer_calculation(self, deferred):
+        """Turn deferred calculation on or off.
+
+        While it is on, LibreOffice does not recalculate the spreadsheet after
+        each cell is set. Instead, it is recalculated once before cells are
+        next read, or when 'calculate' is called.
+        """
+
+        self.__check_for_lock()
+
+        self.deferred_calculation = bool(deferred)
+        self.spreadsheet._target.enableAutomaticCalculation(
+            not self.deferred_calculation
+        )
+        self.calculation_pending = False
+
+    def calculate(self):
+        """Recalculate the formulas that depend on cells that have changed."""
+
+        self.spreadsheet._target.calculate()
+        self.calculation_pending = False
+        self.pending_cells = set()
+
+    def __cells_changed(self, sheet, cells):
+        """Note that 'cells', (row_index, column_index) tuples, on the pyoo
+        'sheet' have been set."""
+
+        if self.dependencies is not None:
+            name = self.__get_sheet_name(sheet)
+            changed = set((name, row, column) for row, column in cells)
+            self.changed_cells |= changed
+            if self.deferred_calculation:
+                self.pending_cells |= changed
+
+        if self.deferred_calculation:
+            self.calculation_pending = True
+
+    def __calculate_if_pending(self, sheet, ranges):
+        """Run a pending calculation before the cells in 'ranges', a list of
+        (r_start, r_end, c_start, c_end) on the pyoo 'sheet', are read. It is
+        skipped if the cells do not depend on any of the cells changed."""
+
+        if not self.calculation_pending:
+            return
+
+        if self.dependencies is not None:
+            name = self.__get_sheet_name(sheet)
+            if not self.dependencies.any_affected(
+                self.pending_cells, [(name,) + r for r in ranges]
+            ):
+                logging.debug("Skipped calculation, cells are unaffected")
+                return
+
+        self.calculate()
+
+    def affected(self, sheet, cell_refs):
+        """Return which of the single cells in 'cell_refs' have been set, or
+        depend on cells that have been set, since the connection was made or
+        the spreadsheet was last reset.
+
+        'sheet' is either a 0-based index or the string name of the sheet.
+        """
+
+        if self.dependencies is None:
+            raise ValueError("The spreadsheet's dependencies are not indexed.")
+
+        self.__validate_sheet_name(sheet)
+        self.__check_list(cell_refs)
+
+        indices = self.__cell_refs_to_index(cell_refs)
+        name = self.__get_sheet_name(self.__get_sheet(sheet))
+
+        affected = set(
+            self.dependencies.affected(
+                self.changed_cells,
+                [(name,) + index for index in indices.values()],
+            )
+        )
+        return [
+            cell_ref
+            for cell_ref, index in indices.items()
+            if (name,) + index in affected
+        ]
+
     def __check_for_lock(self):
+        if self.read_only:
+            raise ValueError("The spreadsheet is open read-only.")
+
         if not self.lock.locked():
             raise RuntimeError(
                 "Lock for this spreadsheet has not been aquired."
@@ -170,11 +387,12 @@ class SpreadsheetConnection:
         """Set the value(s) for a single cell or a cell range. This can be used
         when it is not known if 'cell_ref' refers to a single cell or a range
 
-        See 'set_cell' and 'set_cell_range' for more information.
+        A sheet named in 'cell_ref', e.g. "Sheet2!A1", is used instead of
+        'sheet'. See 'set_cell' and 'set_cell_range' for more information.
         """
 
+        sheet = self.__validate_cell_ref(cell_ref) or sheet
         self.__validate_sheet_name(sheet)
-        self.__validate_cell_ref(cell_ref)
 
         if self.__is_single_cell(cell_ref):
             self.set_cell(sheet, cell_ref, value)
@@ -194,7 +412,7 @@ class SpreadsheetConnection:
         self.__check_for_lock()
 
         r = self.__cell_to_index(cell_ref)
-        sheet = self.spreadsheet.sheets[sheet]
+        sheet = self.__get_sheet(sheet)
 
         if isinstance(value, list):
             raise ValueError(
@@ -203,7 +421,11 @@ class SpreadsheetConnection:
             )
 
         value = self.__convert_to_float_if_numeric(value)
+        self.__record_original_formulas(
+            sheet, [(r["row_index"], r["column_index"])]
+        )
         sheet[r["row_index"], r["column_index"]].value = value
+        self.__cells_changed(sheet, [(r["row_index"], r["column_index"])])
 
     def set_cell_range(self, sheet, cell_ref, data):
         """Set the values for a cell range.
@@ -221,7 +443,14 @@ class SpreadsheetConnection:
         self.__check_for_lock()
 
         r = self.__cell_range_to_index(cell_ref)
-        sheet = self.spreadsheet.sheets[sheet]
+        sheet = self.__get_sheet(sheet)
+
+        cells = [
+            (row, column)
+            for row in range(r["row_start"], r["row_end"] + 1)
+            for column in range(r["column_start"], r["column_end"] + 1)
+        ]
+        self.__record_original_formulas(sheet, cells)
 
         if r["row_start"] == r["row_end"]:  # A row of cells
             data = self.__check_1D_list(data)
@@ -249,70 +478,222 @@ class SpreadsheetConnection:
                 r["column_start"] : r["column_end"] + 1,
             ].values = data
 
-    def get_sheet_names(self):
-        """Returns a list of all sheet names in the workbook."""
+        self.__cells_changed(sheet, cells)
 
-        return [s.name for s in self.spreadsheet.sheets]
+    def __group_cells(self, cells):
+        """Group single cells into the fewest rectangular cell ranges that
+        cover exactly those cells.
 
-    def __validate_cell_ref(self, cell_ref):
-        """ A cell ref must be of the LibreOffice format
-        e.g. A1 or A1:ABC123."""
+        'cells' is an iterable of (row_index, column_index) tuples.
 
-        if type(cell_ref) is not str:
-            raise ValueError(CELL_REF_ERROR_STR)
+        Returned is a list of (row_start, row_end, column_start, column_end)
+        tuples.
+        """
 
-        if not cell_ref[0].isalpha():
-            raise ValueError(CELL_REF_ERROR_STR)
+        # Join cells that are next to each other in a row into runs.
+        runs = []
+        for row, column in sorted(set(cells)):
+            if runs and runs[-1][0] == row and runs[-1][2] == column - 1:
+                runs[-1][2] = column
+            else:
+                runs.append([row, column, column])
 
-        if not cell_ref[-1].isdigit():
-            raise ValueError(CELL_REF_ERROR_STR)
+        # Join runs that span the same columns in consecutive rows.
+        ranges = []
+        open_ranges = {}  # (column_start, column_end): index into ranges
+        for row, column_start, column_end in runs:
+            key = (column_start, column_end)
+            index = open_ranges.get(key)
 
-        if ":" in cell_ref:
-            # Check the second alpha if it exists
-            if not cell_ref[cell_ref.index(":") + 1].isalpha():
-                raise ValueError(CELL_REF_ERROR_STR)
+            if index is not None and ranges[index][1] == row - 1:
+                ranges[index][1] = row
+            else:
+                open_ranges[key] = len(ranges)
+                ranges.append([row, row, column_start, column_end])
 
-            # Check the start of the range has a numeric component
-            if not cell_ref[cell_ref.index(":") - 1].isdigit():
-                raise ValueError(CELL_REF_ERROR_STR)
+        return [tuple(r) for r in ranges]
+
+    def __cell_refs_to_index(self, cell_refs):
+        """Validate a list of single cell references and return a dictionary
+        of each reference to its (row_index, column_index)."""
 
-        # Check for any unallowed characters
-        for ref in cell_ref:
-            if not ref.isdigit() and not ref.isalpha() and ref != ":":
+        indices = {}
+        for cell_ref in cell_refs:
+            if self.__validate_cell_ref(cell_ref) is not None:
+                # The sheet is given separately
                 raise ValueError(CELL_REF_ERROR_STR)
+            self.__check_single_cell(cell_ref)
+
+            r = self.__cell_to_index(cell_ref)
+            indices[cell_ref] = (r["row_index"], r["column_index"])
+
+        return indices
+
+    def set_many(self, sheet, cells):
+        """Set the values of many single cells that need not be next to each
+        other.
+
+        'sheet' is either a 0-based index or the string name of the sheet.
+        'cells' is a dictionary of LibreOffice style cell references to
+        values. eg. {"B3": 1, "F7": 2, "K12": "text"}.
+
+        The cells are written with as few cell range writes as possible.
+        """
+
+        self.__validate_sheet_name(sheet)
+        self.__check_for_lock()
+
+        if not isinstance(cells, dict):
+            raise ValueError("Expecting dict type.")
+
+        for value in cells.values():
+            if isinstance(value, list):
+                raise ValueError("Expected a single value for each cell.")
+
+        indices = self.__cell_refs_to_index(cells)
+        values = {
+            indices[cell_ref]: self.__convert_to_float_if_numeric(value)
+            for cell_ref, value in cells.items()
+        }
+
+        sheet = self.__get_sheet(sheet)
+        self.__record_original_formulas(sheet, values)
+
+        for r_start, r_end, c_start, c_end in self.__group_cells(values):
+            sheet[r_start : r_end + 1, c_start : c_end + 1].values = [
+                [values[(row, column)] for column in range(c_start, c_end + 1)]
+                for row in range(r_start, r_end + 1)
+            ]
+
+        self.__cells_changed(sheet, values)
+
+    def get_many(self, sheet, cell_refs):
+        """Returns the values of many single cells that need not be next to
+        each other.
+
+        'sheet' is either a 0-based index or the string name of the sheet.
+        'cell_refs' is a list of LibreOffice style cell references.
+        eg. ["B3", "F7", "K12"].
+
+        The cells are read with as few cell range reads as possible. A
+        dictionary of each cell reference to its value is returned.
+        """
+
+        self.__validate_sheet_name(sheet)
+        self.__check_list(cell_refs)
+
+        indices = self.__cell_refs_to_index(cell_refs)
+        sheet = self.__get_sheet(sheet)
+        self.__calculate_if_pending(
+            sheet,
+            [(row, row, column, column) for row, column in indices.values()],
+        )
+
+        values = {}
+        for r_start, r_end, c_start, c_end in self.__group_cells(
+            indices.values()
+        ):
+            data = sheet[r_start : r_end + 1, c_start : c_end + 1].values
+            for x, row in enumerate(data):
+                for y, value in enumerate(row):
+                    values[(r_start + x, c_start + y)] = value
+
+        return {
+            cell_ref: values[index] for cell_ref, index in indices.items()
+        }
+
+    def __record_original_formulas(self, sheet, cells):
+        """Record the formulas, or constant contents, of the cells that have
+        not been changed yet so that 'reset' can restore them.
+
+        'sheet' is a pyoo sheet. 'cells' is an iterable of (row_index,
+        column_index) tuples.
+        """
+
+        if not self.track_changes:
+            return
+
+        originals = self.original_formulas.setdefault(
+            self.__get_sheet_name(sheet), {}
+        )
+        cells = [cell for cell in cells if cell not in originals]
+
+        for r_start, r_end, c_start, c_end in self.__group_cells(cells):
+            formulas = sheet[r_start : r_end + 1, c_start : c_end + 1].formulas
+            for x, row in enumerate(formulas):
+                for y, formula in enumerate(row):
+                    originals[(r_start + x, c_start + y)] = formula
+
+    def reset(self):
+        """Restore every cell that has been set since the connection was made,
+        or since the last reset, to its original contents.
+
+        The cells of each sheet are written with as few cell range writes as
+        possible. The number of cells restored is returned.
+        """
+
+        if not self.track_changes:
+            raise ValueError("Changes to the cells are not being tracked.")
+
+        self.__check_for_lock()
+
+        count = 0
+        for sheet_name, originals in self.original_formulas.items():
+            sheet = self.__get_sheet(sheet_name)
+
+            for r_start, r_end, c_start, c_end in self.__group_cells(
+                originals
+            ):
+                sheet[r_start : r_end + 1, c_start : c_end + 1].formulas = [
+                    [
+                        originals[(row, column)]
+                        for column in range(c_start, c_end + 1)
+                    ]
+                    for row in range(r_start, r_end + 1)
+                ]
+
+            self.__cells_changed(sheet, originals)
+            count += len(originals)
 
-        # TODO - Check range for sanity
-        # Reversed ranges should be allowed, they just need to be flipped
-        # e.g. "A5:A1" must become "A1:A5"
-        # Also need to convert "A1:A1" to "A1"
+        self.original_formulas = {}
+        self.changed_cells = set()
+        return count
+
+    def get_sheet_names(self):
+        """Returns a list of all sheet names in the workbook."""
+
+        return list(self.sheet_index.names)
+
+    def __validate_cell_ref(self, cell_ref):
+        """A cell ref must be of the LibreOffice format e.g. A1, A1:ABC123 or
+        Sheet1!A1. The sheet named in the cell ref, or None, is returned."""
+
+        return parse_cell_ref(cell_ref)[0]
 
     def __validate_sheet_name(self, sheet):
         """Don't want to send an invalid sheet to pyoo."""
 
         ERROR_STR = "Sheet name is invalid."
 
-        sheet_names = self.get_sheet_names()
-        if type(sheet) is int:
-
-            if sheet < 0 or sheet > len(sheet_names) - 1:
-                raise ValueError(ERROR_STR)
+        if type(sheet) not in (int, str):
+            raise ValueError(ERROR_STR)
 
-        elif type(sheet) is str:
-            if sheet not in sheet_names:
+        if sheet not in self.sheet_index:
+            # The index may be older than the sheet.
+            self.sheet_index.refresh()
+            if sheet not in self.sheet_index:
                 raise ValueError(ERROR_STR)
 
-        else:
-            raise ValueError(ERROR_STR)
-
     def get_cells(self, sheet, cell_ref):
         """Gets the value(s) of a single cell or a cell range. This can be used
         when it is not known if 'cell_ref' refers to a single cell or a range.
 
-        See 'get_cell' and 'get_cell_range' for more information.
+        A sheet named in 'cell_ref', e.g. "Sheet2!A1", is used instead of
+        'sheet'. See 'get_cell' and 'get_cell_range' for more information.
         """
 
+        sheet = self.__validate_cell_ref(cell_ref) or sheet
         self.__validate_sheet_name(sheet)
-        self.__validate_cell_ref(cell_ref)
 
         if self.__is_single_cell(cell_ref):
             return self.get_cell(sheet, cell_ref)
@@ -331,7 +712,18 @@ class SpreadsheetConnection:
         self.__check_single_cell(cell_ref)
 
         r = self.__cell_to_index(cell_ref)
-        sheet = self.spreadsheet.sheets[sheet]
+        sheet = self.__get_sheet(sheet)
+        self.__calculate_if_pending(
+            sheet,
+            [
+                (
+                    r["row_index"],
+                    r["row_index"],
+                    r["column_index"],
+                    r["column_index"],
+                )
+            ],
+        )
 
         return sheet[r["row_index"], r["column_index"]].value
 
@@ -346,9 +738,12 @@ class SpreadsheetConnection:
         """
 
         r = self.__cell_range_to_index(cell_ref)
-        sheet = self.spreadsheet.sheets[sheet]
+        sheet = self.__get_sheet(sheet)
+        rows = sorted((r["row_start"], r["row_end"]))
+        columns = sorted((r["column_start"], r["column_end"]))
+        self.__calculate_if_pending(sheet, [tuple(rows + columns)])
 
-        logging.debug("Requested cell area: " + str(r))
+        logging.debug("Requested cell area: %s", r)
 
         # Cell ranges are requested as: [vertical area, horizontal area]
 
@@ -368,6 +763,121 @@ class SpreadsheetConnection:
                 r["column_start"] : r["column_end"] + 1,
             ].values
 
+    def iter_cell_range(self, sheet, cell_ref, chunk_rows=STREAM_CHUNK_ROWS):
+        """Yields the values of a range of cells in blocks of rows, so that
+        only one block is held in memory at a time.
+
+        'sheet' and 'cell_ref' are as for 'get_cells'. Each block is a list of
+        at most 'chunk_rows' rows, each a list of cell values, whatever the
+        shape of the range.
+        """
+
+        sheet = self.__validate_cell_ref(cell_ref) or sheet
+        self.__validate_sheet_name(sheet)
+
+        if type(chunk_rows) is not int or chunk_rows < 1:
+            raise ValueError("The number of rows per block must be positive.")
+
+        sheet_ref, r_start, r_end, c_start, c_end = parse_cell_ref(cell_ref)
+        sheet = self.__get_sheet(sheet)
+        self.__calculate_if_pending(sheet, [(r_start, r_end, c_start, c_end)])
+
+        for start in range(r_start, r_end + 1, chunk_rows):
+            end = min(start + chunk_rows, r_end + 1)
+            values = sheet[start:end, c_start : c_end + 1].values
+            yield [list(row) for row in values]
+
+    def get_array(self, sheet, cell_ref):
+        """Returns the values of a range of cells as a float64 array, without
+        building a Python list of the values.
+
+        'sheet' and 'cell_ref' are as for 'get_cells'. Returned is a dict of
+        the "dtype", the "shape", (rows, columns), and the "data", the bytes of
+        the array in row-major order. Empty and text cells are NaN.
+        """
+
+        sheet = self.__validate_cell_ref(cell_ref) or sheet
+        self.__validate_sheet_name(sheet)
+
+        sheet_ref, r_start, r_end, c_start, c_end = parse_cell_ref(cell_ref)
+        sheet = self.__get_sheet(sheet)
+        self.__calculate_if_pending(sheet, [(r_start, r_end, c_start, c_end)])
+
+        values = sheet[r_start : r_end + 1, c_start : c_end + 1].values
+
+        nan = float("nan")
+        floats = array(
+            "d",
+            [
+                value if type(value) is float else nan
+                for row in values
+                for value in row
+            ],
+        )
+        if sys.byteorder == "big":
+            floats.byteswap()
+
+        return {
+            "dtype": ARRAY_DTYPE,
+            "shape": [r_end - r_start + 1, c_end - c_start + 1],
+            "data": floats.tobytes(),
+        }
+
+    def set_array(self, sheet, cell_ref, values):
+        """Sets the values of a range of cells from a float64 array.
+
+        'sheet' and 'cell_ref' are as for 'set_cells'. 'values' is a dict as
+        returned by 'get_array'. The shape may be left out, or one dimensional
+        for a row or column of cells. Cells that are NaN are emptied.
+        """
+
+        self.__check_for_lock()
+
+        sheet = self.__validate_cell_ref(cell_ref) or sheet
+        self.__validate_sheet_name(sheet)
+
+        if type(values) is not dict or values.get("dtype") != ARRAY_DTYPE:
+            raise ValueError("Expecting an array of float64s.")
+
+        sheet_ref, r_start, r_end, c_start, c_end = parse_cell_ref(cell_ref)
+        rows = r_end - r_start + 1
+        columns = c_end - c_start + 1
+
+        floats = array("d")
+        try:
+            floats.frombytes(values["data"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Expecting an array of float64s.")
+        if sys.byteorder == "big":
+            floats.byteswap()
+
+        shape = values.get("shape")
+        if len(floats) != rows * columns or (
+            shape is not None
+            and len(shape) == 2
+            and list(shape) != [rows, columns]
+        ):
+            raise ValueError("The array does not match the cell range.")
+
+        sheet = self.__get_sheet(sheet)
+
+        cells = [
+            (row, column)
+            for row in range(r_start, r_end + 1)
+            for column in range(c_start, c_end + 1)
+        ]
+        self.__record_original_formulas(sheet, cells)
+
+        sheet[r_start : r_end + 1, c_start : c_end + 1].values = [
+            [
+                "" if value != value else value
+                for value in floats[row : row + columns]
+            ]
+            for row in range(0, rows * columns, columns)
+        ]
+
+        self.__cells_changed(sheet, cells)
+
     def save_spreadsheet(self, filename):
         """Save the spreadsheet in it's current state.
 
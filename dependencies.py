@@ -0,0 +1,223 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import re
+
+MAX_ROW = 1048575  # Zero-based
+MAX_COLUMN = 1023  # Zero-based, AMJ
+
+SHEET = r"(?:\$?'(?:[^']|'')+'|\$?[A-Za-z_][\w ]*?)"
+CELL = r"\$?[A-Za-z]{1,3}\$?\d+"
+
+# A cell or range reference as returned by LibreOffice's getFormula, eg. A1,
+# $B$2, C3:D4, Sheet2.A1, $'My sheet'.A1:B2, A:A or 3:5.
+REFERENCE = re.compile(
+    r"(?<![\w.$'])"
+    r"(?:(?P<sheet>" + SHEET + r")\.)?"
+    r"(?:(?P<start>" + CELL + r")"
+    r"(?::(?:(?P<end_sheet>" + SHEET + r")\.)?(?P<end>" + CELL + r"))?"
+    r"|(?P<start_col>\$?[A-Za-z]{1,3}):(?P<end_col>\$?[A-Za-z]{1,3})"
+    r"|(?P<start_row>\$?\d+):(?P<end_row>\$?\d+))"
+    r"(?![\w(.])"
+)
+STRING = re.compile(r'"(?:[^"]|"")*"')
+IDENTIFIER = re.compile(r"(?<![\w.$'])([A-Za-z_][\w.]*)(?!\s*\()")
+
+# Functions whose references can not be worked out from the formula text.
+VOLATILE = re.compile(r"\b(?:INDIRECT|OFFSET|RAND|RANDBETWEEN|NOW|TODAY)\s*\(")
+
+
+def column_index(letters):
+    index = 0
+    for c in letters.upper():
+        index = index * 26 + ord(c) - 64
+    return index - 1
+
+
+def cell_index(ref):
+    """Convert a cell reference such as "$B$3" to (row, column)."""
+
+    ref = ref.replace("$", "")
+    split = len(ref.rstrip("0123456789"))
+    return int(ref[split:]) - 1, column_index(ref[:split])
+
+
+def sheet_name(name):
+    name = name.lstrip("$")
+    if name.startswith("'"):
+        name = name[1:-1].replace("''", "'")
+    return name
+
+
+class DependencyIndex:
+    """Which formula cells depend on which cells in a spreadsheet.
+
+    The index is built once, from the formulas in the spreadsheet when it is
+    opened. References to other spreadsheets, named ranges or functions such
+    as INDIRECT make a formula depend on every cell, so the index errs on the
+    side of reporting a cell as affected.
+    """
+
+    def __init__(self, spreadsheet):
+        # (sheet, row, column): a list of (sheet, r_start, r_end, c_start,
+        # c_end) ranges that the formula in the cell refers to.
+        self.precedents = {}
+
+        # Formula cells that could depend on any cell.
+        self.unknown = set()
+
+        # sheet: a list of (r_start, r_end, c_start, c_end, formula cell)
+        self.ranges = {}
+
+        try:
+            names = set(spreadsheet._target.NamedRanges.getElementNames())
+        except AttributeError:
+            names = set()
+
+        for sheet in spreadsheet.sheets:
+            self.__add_sheet(sheet, names)
+
+        logging.debug(
+            "Indexed %s formulas, %s with unknown precedents",
+            len(self.precedents) + len(self.unknown),
+            len(self.unknown),
+        )
+
+    def __add_sheet(self, sheet, names):
+        cursor = sheet._target.createCursor()
+        cursor.gotoEndOfUsedArea(False)
+        address = cursor.getRangeAddress()
+
+        name = sheet.name
+        formulas = sheet[
+            0 : address.EndRow + 1, 0 : address.EndColumn + 1
+        ].formulas
+
+        for row, row_formulas in enumerate(formulas):
+            for column, formula in enumerate(row_formulas):
+                if formula.startswith("="):
+                    self.__add_formula((name, row, column), formula, names)
+
+    def __add_formula(self, cell, formula, names):
+        formula = STRING.sub('""', formula)
+
+        if VOLATILE.search(formula) or "[" in formula:
+            self.unknown.add(cell)
+            return
+
+        ranges = []
+        for match in REFERENCE.finditer(formula):
+            sheet = cell[0]
+            if match.group("sheet"):
+                sheet = sheet_name(match.group("sheet"))
+
+            end_sheet = match.group("end_sheet")
+            if end_sheet and sheet_name(end_sheet) != sheet:
+                # A range across sheets
+                self.unknown.add(cell)
+                return
+
+            if match.group("start"):
+                r_start, c_start = cell_index(match.group("start"))
+                r_end, c_end = cell_index(
+                    match.group("end") or match.group("start")
+                )
+            elif match.group("start_col"):
+                r_start, r_end = 0, MAX_ROW
+                c_start = column_index(match.group("start_col").lstrip("$"))
+                c_end = column_index(match.group("end_col").lstrip("$"))
+            else:
+                c_start, c_end = 0, MAX_COLUMN
+                r_start = int(match.group("start_row").lstrip("$")) - 1
+                r_end = int(match.group("end_row").lstrip("$")) - 1
+
+            ranges.append(
+                (
+                    sheet,
+                    min(r_start, r_end),
+                    max(r_start, r_end),
+                    min(c_start, c_end),
+                    max(c_start, c_end),
+                )
+            )
+
+        for identifier in IDENTIFIER.findall(REFERENCE.sub("", formula)):
+            if identifier in names:
+                self.unknown.add(cell)
+                return
+
+        self.precedents[cell] = ranges
+        for sheet, r_start, r_end, c_start, c_end in ranges:
+            self.ranges.setdefault(sheet, []).append(
+                (r_start, r_end, c_start, c_end, cell)
+            )
+
+    def dependents(self, cells):
+        """Return the set of formula cells that depend, directly or not, on
+        any of 'cells', an iterable of (sheet, row, column) tuples."""
+
+        # Formulas with unknown precedents may depend on any of the cells, and
+        # so may the formulas that depend on them.
+        found = set(self.unknown)
+        todo = list(cells) + list(self.unknown)
+
+        while todo:
+            sheet, row, column = todo.pop()
+            for r_start, r_end, c_start, c_end, formula in self.ranges.get(
+                sheet, ()
+            ):
+                if (
+                    formula not in found
+                    and r_start <= row <= r_end
+                    and c_start <= column <= c_end
+                ):
+                    found.add(formula)
+                    todo.append(formula)
+
+        return found
+
+    def affected(self, changed, cells):
+        """Return the cells in 'cells' that are in 'changed' or depend on a
+        cell in 'changed'. Both are iterables of (sheet, row, column)."""
+
+        changed = set(changed)
+        if not changed:
+            return []
+
+        dependents = self.dependents(changed)
+        return [
+            cell for cell in cells if cell in changed or cell in dependents
+        ]
+
+    def any_affected(self, changed, ranges):
+        """Return whether any cell in 'ranges', a list of (sheet, r_start,
+        r_end, c_start, c_end), is in 'changed' or depends on it."""
+
+        changed = set(changed)
+        if not changed:
+            return False
+
+        for sheet, row, column in self.dependents(changed) | changed:
+            for r_sheet, r_start, r_end, c_start, c_end in ranges:
+                if (
+                    sheet == r_sheet
+                    and r_start <= row <= r_end
+                    and c_start <= column <= c_end
+                ):
+                    return True
+
+        return False
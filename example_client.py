@@ -69,6 +69,13 @@ if __name__ == "__main__":
     cell_values = sc.get_cells(SHEET_NAME, "A1:C3")
     print(cell_values)
 
+    # Set and retrieve several cells in a single round trip to the server.
+    with sc.batch() as batch:
+        batch.set_cells(SHEET_NAME, "A1", 5)
+        batch.set_cells(SHEET_NAME, "A2:A3", [6, 7])
+        c3 = batch.get_cells(SHEET_NAME, "C3")
+    print(c3.value)
+
     # Save a spreadsheet - it will save into ./saved_spreadsheets
     sc.save_spreadsheet(EXAMPLE_SPREADSHEET)
 
@@ -0,0 +1,98 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import random
+
+# The messages whose second and third items are a sheet and a cell range.
+CELL_RANGE_COMMANDS = ("SET", "GET", "GET_STREAM", "GET_ARRAY", "SET_ARRAY")
+
+
+class MessageLog:
+    """Logs the messages the server sends and receives.
+
+    Each message is logged at the DEBUG level as a single line with its
+    command, spreadsheet, cell range, size in bytes and, when sent, the time
+    taken to encode and send it. Nothing is worked out unless DEBUG records
+    are emitted.
+
+    The payload of the messages can be large, so it is only logged if
+    'payloads' is True, or for a random 'sample_rate' fraction of the
+    messages. As it has been asked for, it is logged at the INFO level, the
+    server's default, and is formatted only if the record is emitted.
+    """
+
+    def __init__(self, payloads=False, sample_rate=0.0):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("The sample rate must be between 0 and 1.")
+
+        self.payloads = payloads
+        self.sample_rate = sample_rate
+
+    def received(self, spreadsheet, msg, size):
+        """Log a message received from a client, 'size' bytes long. The
+        spreadsheet is None before the client has said which it wants."""
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            command, cell_range = _describe(msg)
+            logging.debug(
+                "Received %s %s %s %d bytes",
+                command,
+                spreadsheet or "-",
+                cell_range,
+                size,
+            )
+        self.__log_payload("Received", msg)
+
+    def sent(self, spreadsheet, command, msg, size, seconds):
+        """Log a message sent to a client in reply to 'command', or None for
+        the reply to the handshake. It was 'size' bytes long, and took
+        'seconds' to encode and send."""
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(
+                "Sent %s %s %d bytes %.3f ms",
+                command or "-",
+                spreadsheet or "-",
+                size,
+                seconds * 1000,
+            )
+        self.__log_payload("Sent", msg)
+
+    def __log_payload(self, direction, msg):
+        if self.payloads or (
+            self.sample_rate and random.random() < self.sample_rate
+        ):
+            logging.info("%s: %s", direction, msg)
+
+
+def _describe(msg):
+    """Return the command and the cell range, if any, of a message. The
+    message may not follow the protocol."""
+
+    if type(msg) != list or len(msg) == 0:
+        return "-", "-"
+
+    if msg[0] == "REQUEST" and len(msg) == 3:
+        command, cell_range = _describe(msg[2])
+        return "REQUEST:" + command, cell_range
+
+    command = msg[0] if type(msg[0]) == str else "-"
+    if command in CELL_RANGE_COMMANDS and len(msg) > 2:
+        if type(msg[1]) in (str, int) and type(msg[2]) == str:
+            return command, str(msg[1]) + "!" + msg[2]
+
+    return command, "-"
@@ -0,0 +1,269 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# The stages of handling a message that are timed. "lock_wait" is the time
+# spent waiting for a replica, "execute" running the message in LibreOffice,
+# "serialize" encoding the response and "send" writing it to the socket.
+STAGES = ("lock_wait", "execute", "serialize", "send")
+
+# The prefix of the names of the metrics in the Prometheus format.
+PREFIX = "spreadsheet_server_"
+
+
+class Histogram:
+    """Counts observations in the LATENCY_BUCKETS, as a Prometheus histogram
+    does."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last is for +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return (upper bound, count) pairs, each counting the observations
+        less than or equal to the bound. The last bound is "+Inf"."""
+
+        bounds = list(self.buckets) + ["+Inf"]
+        total = 0
+        pairs = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def snapshot(self):
+        return {
+            "buckets": [list(pair) for pair in self.cumulative()],
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class Metrics:
+    """Counters, latency histograms and gauges for the messages handled by
+    the server, per spreadsheet and per command.
+
+    It is shared by all the connections, so every update holds a lock. The
+    queue depths are read from 'queue_depths', a function returning the
+    number of waiting clients for each spreadsheet, when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (spreadsheet, command): [count, errors]
+        self.latencies = {}  # (spreadsheet, command, stage): Histogram
+        self.sessions = {}  # spreadsheet: the number of open sessions
+        self.queue_depths = dict
+
+    def count(self, spreadsheet, command, error=False):
+        """Count a message handled for a spreadsheet."""
+
+        with self.lock:
+            counts = self.requests.setdefault((spreadsheet, command), [0, 0])
+            counts[0] += 1
+            if error:
+                counts[1] += 1
+
+    def observe(self, stage, spreadsheet, command, seconds):
+        """Record the time, in seconds, a stage of a message took."""
+
+        key = (spreadsheet, command, stage)
+        with self.lock:
+            histogram = self.latencies.get(key)
+            if histogram is None:
+                histogram = self.latencies[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage, spreadsheet, command):
+        """Record the time the body of a with statement takes."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(
+                stage, spreadsheet, command, time.perf_counter() - start
+            )
+
+    def open_session(self, spreadsheet):
+        with self.lock:
+            self.sessions[spreadsheet] = self.sessions.get(spreadsheet, 0) + 1
+
+    def close_session(self, spreadsheet):
+        with self.lock:
+            self.sessions[spreadsheet] -= 1
+            if self.sessions[spreadsheet] == 0:
+                del self.sessions[spreadsheet]
+
+    def snapshot(self):
+        """Return the metrics as nested dicts, keyed by spreadsheet and then
+        command, as sent in reply to a STATS message."""
+
+        requests = {}
+        latencies = {}
+        with self.lock:
+            for (spreadsheet, command), counts in self.requests.items():
+                requests.setdefault(spreadsheet, {})[command] = {
+                    "count": counts[0],
+                    "errors": counts[1],
+                }
+
+            for key, histogram in self.latencies.items():
+                spreadsheet, command, stage = key
+                commands = latencies.setdefault(spreadsheet, {})
+                commands.setdefault(command, {})[stage] = histogram.snapshot()
+
+            sessions = dict(self.sessions)
+
+        return {
+            "requests": requests,
+            "latency": latencies,
+            "sessions": sessions,
+            "queue_depth": self.queue_depths(),
+        }
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append("# HELP " + PREFIX + name + " " + help_text)
+            lines.append("# TYPE " + PREFIX + name + " " + kind)
+
+        def sample(name, labels, value):
+            lines.append(PREFIX + name + _labels(labels) + " " + str(value))
+
+        with self.lock:
+            requests = sorted(self.requests.items())
+            latencies = sorted(
+                (key, histogram.cumulative(), histogram.sum, histogram.count)
+                for key, histogram in self.latencies.items()
+            )
+            sessions = sorted(self.sessions.items())
+
+        metric("requests_total", "counter", "Messages handled.")
+        for (spreadsheet, command), counts in requests:
+            labels = {"spreadsheet": spreadsheet, "command": command}
+            sample("requests_total", labels, counts[0])
+
+        metric("errors_total", "counter", "Messages answered with an error.")
+        for (spreadsheet, command), counts in requests:
+            labels = {"spreadsheet": spreadsheet, "command": command}
+            sample("errors_total", labels, counts[1])
+
+        metric(
+            "stage_seconds",
+            "histogram",
+            "Time spent in each stage of a message.",
+        )
+        for (spreadsheet, command, stage), pairs, total, count in latencies:
+            labels = {
+                "spreadsheet": spreadsheet,
+                "command": command,
+                "stage": stage,
+            }
+            for bound, cumulative in pairs:
+                sample(
+                    "stage_seconds_bucket",
+                    dict(labels, le=str(bound)),
+                    cumulative,
+                )
+            sample("stage_seconds_sum", labels, total)
+            sample("stage_seconds_count", labels, count)
+
+        metric("sessions", "gauge", "Open client sessions.")
+        for spreadsheet, count in sessions:
+            sample("sessions", {"spreadsheet": spreadsheet}, count)
+
+        metric("queue_depth", "gauge", "Clients waiting for a spreadsheet.")
+        for spreadsheet, depth in sorted(self.queue_depths().items()):
+            sample("queue_depth", {"spreadsheet": spreadsheet}, depth)
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    escaped = (
+        name
+        + '="'
+        + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class MetricsHTTPServer(ThreadingHTTPServer):
+    """Serves the metrics in the Prometheus format over HTTP, on any path.
+
+    As with the other servers, 'serve_forever' is run in its own thread and
+    'shutdown' and 'server_close' stop it.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, metrics, server_address):
+        self.metrics = metrics
+        ThreadingHTTPServer.__init__(
+            self, server_address, MetricsRequestHandler
+        )
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.prometheus().encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent, so are not logged.
+        pass
@@ -15,12 +15,25 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import threading
-from os import listdir, remove
-from os.path import isfile, isdir, join, exists
+from os import listdir, remove, stat
+from os.path import basename, isfile, isdir, join, exists, relpath
 import logging
-from time import sleep
+from time import monotonic, sleep
 import hashlib
+from collections import OrderedDict
 from glob import glob
+import psutil
+from watcher import OVERFLOW, InotifyWatcher
+from dependencies import DependencyIndex
+from connection import SheetIndex
+from result_cache import PRISTINE
+from rwlock import ReaderWriterLock
+
+# How long, in seconds, the directory must be quiet before changes seen by the
+# inotify watcher are acted on. This lets a file finish being written.
+DEBOUNCE = 0.5
+
+HASH_CHUNK_SIZE = 1024 * 1024  # Files are hashed this many bytes at a time
 
 
 class MonitorThread(threading.Thread):
@@ -31,10 +44,19 @@ class MonitorThread(threading.Thread):
         spreadsheets,
         locks,
         hashes,
-        soffice,
+        soffices,
         spreadsheets_path,
         monitor_frequency,
         reload_on_disk_change,
+        result_cache=None,
+        monitor_mode="poll",
+        lazy_load=False,
+        max_loaded=None,
+        max_soffice_memory=None,
+        soffice_pids=(),
+        dependencies=None,
+        sheet_indexes=None,
+        spare_replicas=False,
     ):
 
         self._stop_thread = threading.Event()
@@ -42,15 +64,66 @@ class MonitorThread(threading.Thread):
         self.spreadsheets = spreadsheets
         self.locks = locks
         self.hashes = hashes
-        self.soffice = soffice
+        self.soffices = soffices
         self.spreadsheets_path = spreadsheets_path
         self.monitor_frequency = monitor_frequency
         self.reload_on_disk_change = reload_on_disk_change
+        self.result_cache = result_cache
+
+        # "poll" rescans the directory every monitor_frequency seconds.
+        # "inotify" only handles the files that change, as they change.
+        self.monitor_mode = monitor_mode
+        self.watcher = None
+
+        # With lazy_load, spreadsheets are only registered when they are
+        # found and are opened by 'open_spreadsheet' when a client first asks
+        # for them. The least recently used are closed again once more than
+        # 'max_loaded' are open or the soffice processes, 'soffice_pids', use
+        # more than 'max_soffice_memory' bytes.
+        self.lazy_load = lazy_load
+        self.max_loaded = max_loaded
+        self.max_soffice_memory = max_soffice_memory
+        self.soffice_pids = soffice_pids
+        self.registered = {}  # The hash of each spreadsheet found
+        self.last_used = OrderedDict()  # Open spreadsheets, oldest use first
+
+        # The number of client threads that have opened each spreadsheet with
+        # 'open_spreadsheet' but not yet locked a replica of it. A pinned
+        # spreadsheet is not closed to keep within budget.
+        self.pinned = {}
+        self.pin_lock = threading.Lock()
+
+        # A DependencyIndex for each open spreadsheet, or None to not build
+        # them.
+        self.dependencies = dependencies
+
+        # A list of SheetIndexes, one per replica, for each open spreadsheet.
+        self.sheet_indexes = {} if sheet_indexes is None else sheet_indexes
+
+        # With spare_replicas, a pristine copy of each replica is kept open
+        # for 'restore_replica' to swap in, and the next copy is opened in the
+        # background. 'spares' holds a list of (spreadsheet, SheetIndex), or
+        # None while one is being opened, for each open spreadsheet.
+        self.spare_replicas = spare_replicas
+        self.spares = {}
+        self.spare_lock = threading.Lock()
+
+        # Held while spreadsheets are opened or closed, as client threads
+        # open spreadsheets with lazy_load.
+        self.load_lock = threading.RLock()
 
         self.__delete_lock_files()
 
         self.done_scan = False  # Done an initial scan or not
 
+        # The (size, mtime_ns, inode) and hash of each file when it was last
+        # hashed. A file is only hashed again once its stat changes.
+        self.file_stats = {}
+
+        self.last_scan_duration = 0  # In seconds
+        self.last_scan_rehashed = 0  # Files hashed in the last full scan
+        self.files_rehashed = 0  # Files hashed in total
+
         super(MonitorThread, self).__init__()
 
     def stop_thread(self):
@@ -75,21 +148,250 @@ class MonitorThread(threading.Thread):
             remove(lock_file)
 
     def __load_spreadsheet(self, doc):
+        """Open the spreadsheet or, with lazy_load, register it to be opened
+        when it is first asked for."""
+
+        if self.lazy_load:
+            # Registered files are found again on every scan.
+            if self.registered.get(doc["path"]) != doc["hash"]:
+                logging.info("Registering " + doc["path"])
+            self.registered[doc["path"]] = doc["hash"]
+        else:
+            self.__open_spreadsheet(doc)
+
+    def __open_spreadsheet(self, doc):
+        """Open a replica of the spreadsheet in each soffice process."""
+
         logging.info("Loading " + doc["path"])
 
-        self.spreadsheets[doc["path"]] = self.soffice.open_spreadsheet(
-            self.__get_full_path(doc["path"])
-        )
-        self.locks[doc["path"]] = threading.Lock()
+        full_path = self.__get_full_path(doc["path"])
+        replicas = [
+            soffice.open_spreadsheet(full_path) for soffice in self.soffices
+        ]
+
+        if self.dependencies is not None:
+            # The replicas are identical, so one index serves them all.
+            self.dependencies[doc["path"]] = DependencyIndex(replicas[0])
+
+        self.sheet_indexes[doc["path"]] = [SheetIndex(r) for r in replicas]
+        self.spreadsheets[doc["path"]] = replicas
+        self.locks[doc["path"]] = [ReaderWriterLock() for s in self.soffices]
         self.hashes[doc["path"]] = doc["hash"]
+        self.last_used[doc["path"]] = None
+
+        if self.spare_replicas:
+            spares = [None for s in self.soffices]
+            with self.spare_lock:
+                self.spares[doc["path"]] = spares
+            for replica in range(len(spares)):
+                self.__replace_spare(doc["path"], replica, spares)
 
     def __unload_spreadsheet(self, doc_path):
+        """Close the spreadsheet once the sessions using it have ended. The
+        load_lock must not be held, so that clients can open other
+        spreadsheets while this waits."""
+
         logging.info("Removing " + doc_path)
-        self.locks[doc_path].acquire()
-        self.spreadsheets[doc_path].close()
+
+        locks = self.locks.get(doc_path)
+        if locks is None:
+            return
+        for lock in locks:
+            lock.acquire()
+
+        with self.load_lock:
+            if self.locks.get(doc_path) is locks:
+                self.__close_spreadsheet(doc_path)
+                return
+
+        # It was closed meanwhile to make room for others.
+        for lock in locks:
+            lock.release()
+
+    def __close_spreadsheet(self, doc_path):
+        """Close the replicas of the spreadsheet. All its locks must be
+        held."""
+
+        for spreadsheet in self.spreadsheets[doc_path]:
+            spreadsheet.close()
         self.spreadsheets.pop(doc_path, None)
-        self.locks.pop(doc_path, None)
+        locks = self.locks.pop(doc_path, None)
         self.hashes.pop(doc_path, None)
+        self.last_used.pop(doc_path, None)
+        self.sheet_indexes.pop(doc_path, None)
+
+        if self.dependencies is not None:
+            self.dependencies.pop(doc_path, None)
+
+        with self.spare_lock:
+            spares = self.spares.pop(doc_path, None)
+        for spare in spares or ():
+            if spare is not None:
+                spare[0].close()
+
+        if self.result_cache is not None:
+            self.result_cache.invalidate(doc_path)
+
+        # Sessions still waiting for the locks then find that they are no
+        # longer the replicas' locks, release them and wait for the
+        # spreadsheet to be opened again, rather than waiting forever.
+        for lock in locks or ():
+            lock.release()
+
+    def restore_replica(self, doc_path, replica):
+        """Discard any changes made to a replica of the spreadsheet by
+        replacing it with a pristine copy. The replica's lock must be held.
+
+        With spare_replicas, the spare copy is swapped in and the changed
+        replica is closed, and the next spare opened, in the background.
+        Otherwise, or if the spare is not open yet, the replica is closed and
+        opened again from its file.
+        """
+
+        logging.debug("Restoring " + doc_path)
+
+        spreadsheets = self.spreadsheets[doc_path]
+
+        with self.spare_lock:
+            spares = self.spares.get(doc_path)
+            spare = spares[replica] if spares is not None else None
+            if spare is not None:
+                spares[replica] = None
+
+        if spare is not None:
+            changed = spreadsheets[replica]
+            spreadsheets[replica] = spare[0]
+            self.sheet_indexes[doc_path][replica] = spare[1]
+            self.__replace_spare(doc_path, replica, spares, changed)
+        else:
+            spreadsheets[replica].close()
+            spreadsheets[replica] = self.soffices[replica].open_spreadsheet(
+                self.__get_full_path(doc_path)
+            )
+            self.sheet_indexes[doc_path][replica] = SheetIndex(
+                spreadsheets[replica]
+            )
+
+        if self.result_cache is not None:
+            self.result_cache.set_state(doc_path, replica, PRISTINE)
+
+    def __replace_spare(self, doc_path, replica, spares, changed=None):
+        """Close 'changed', if given, and open a spare copy of a replica in a
+        background thread."""
+
+        thread = threading.Thread(
+            target=self.__open_spare,
+            args=(doc_path, replica, spares, changed),
+        )
+        thread.daemon = True
+        thread.start()
+
+    def __open_spare(self, doc_path, replica, spares, changed):
+        try:
+            if changed is not None:
+                changed.close()
+            spreadsheet = self.soffices[replica].open_spreadsheet(
+                self.__get_full_path(doc_path)
+            )
+            spare = (spreadsheet, SheetIndex(spreadsheet))
+        except Exception:
+            logging.exception("Failed to open a spare copy of " + doc_path)
+            return
+
+        with self.spare_lock:
+            # The spreadsheet may have been closed or reloaded meanwhile.
+            if self.spares.get(doc_path) is spares:
+                spares[replica] = spare
+                return
+
+        spreadsheet.close()
+
+    def open_spreadsheet(self, doc_path):
+        """Make sure a spreadsheet is open, opening it if it has only been
+        registered. True is returned if it is open, False if it is not known.
+
+        This is called by the client threads when lazy_load is used. The
+        spreadsheet is pinned open until 'unpin_spreadsheet' is called, which
+        the caller must do once it has locked a replica, or given up.
+        """
+
+        with self.load_lock:
+            if doc_path not in self.spreadsheets:
+                if doc_path not in self.registered:
+                    return False
+
+                self.__open_spreadsheet(
+                    {"path": doc_path, "hash": self.registered[doc_path]}
+                )
+
+            with self.pin_lock:
+                self.pinned[doc_path] = self.pinned.get(doc_path, 0) + 1
+
+            self.last_used.move_to_end(doc_path)
+            self.__close_least_recently_used(doc_path)
+            return True
+
+    def unpin_spreadsheet(self, doc_path):
+        """Allow a spreadsheet pinned by 'open_spreadsheet' to be closed
+        again."""
+
+        with self.pin_lock:
+            self.pinned[doc_path] -= 1
+            if self.pinned[doc_path] == 0:
+                del self.pinned[doc_path]
+
+    def __over_budget(self):
+        if self.max_loaded is not None:
+            if len(self.spreadsheets) > self.max_loaded:
+                return True
+
+        if self.max_soffice_memory is not None:
+            memory = 0
+            for pid in self.soffice_pids:
+                try:
+                    process = psutil.Process(pid)
+                    for p in [process] + process.children(recursive=True):
+                        memory += p.memory_info().rss
+                except psutil.Error:
+                    pass
+
+            if memory > self.max_soffice_memory:
+                return True
+
+        return False
+
+    def __close_least_recently_used(self, keep):
+        """Close the least recently used spreadsheet, other than 'keep', that
+        is not in use if the open spreadsheets are over budget.
+
+        Only one is closed each time a spreadsheet is opened, as soffice does
+        not give back the memory of a closed spreadsheet straight away.
+        """
+
+        if not self.__over_budget():
+            return
+
+        for doc_path in list(self.last_used):
+            # A client that has opened a pinned spreadsheet is about to lock
+            # one of its replicas.
+            if doc_path == keep or doc_path in self.pinned:
+                continue
+
+            # Skip spreadsheets that a client is using.
+            acquired = []
+            for lock in self.locks[doc_path]:
+                if not lock.acquire(blocking=False):
+                    break
+                acquired.append(lock)
+
+            if len(acquired) != len(self.locks[doc_path]):
+                for lock in acquired:
+                    lock.release()
+                continue
+
+            logging.info("Closing least recently used " + doc_path)
+            self.__close_spreadsheet(doc_path)
+            return
 
     def __check_added(self):
         """Check for new spreadsheets and loads them into LibreOffice."""
@@ -98,7 +400,7 @@ class MonitorThread(threading.Thread):
             if doc["path"][0] != ".":  # Ignore hidden files
                 load = True  # Default to loading the spreadsheet
 
-                for key, value in self.spreadsheets.items():
+                for key, value in list(self.spreadsheets.items()):
                     if doc["path"] == key:
 
                         # Check if the file has been modified
@@ -106,7 +408,7 @@ class MonitorThread(threading.Thread):
 
                         if (
                             self.reload_on_disk_change
-                            and doc["hash"] != self.hashes[doc["path"]]
+                            and doc["hash"] != self.hashes.get(doc["path"])
                         ):
 
                             self.__unload_spreadsheet(doc["path"])
@@ -116,7 +418,12 @@ class MonitorThread(threading.Thread):
                         break
 
                 if load:
-                    self.__load_spreadsheet(doc)
+                    try:
+                        with self.load_lock:
+                            self.__load_spreadsheet(doc)
+                    except Exception:
+                        # It is tried again on the next scan.
+                        logging.exception("Could not load " + doc["path"])
 
     def __check_removed(self):
         """Check for any deleted or removed spreadsheets and remove them from
@@ -124,7 +431,7 @@ class MonitorThread(threading.Thread):
         """
 
         removed_spreadsheets = []
-        for key, value in self.spreadsheets.items():
+        for key, value in list(self.spreadsheets.items()):
             removed = True
             for doc in self.docs:
                 if key == doc["path"]:
@@ -136,6 +443,12 @@ class MonitorThread(threading.Thread):
         for doc_path in removed_spreadsheets:
             self.__unload_spreadsheet(doc_path)
 
+        paths = set(doc["path"] for doc in self.docs)
+        with self.load_lock:
+            for doc_path in [p for p in self.registered if p not in paths]:
+                logging.info("Unregistering " + doc_path)
+                del self.registered[doc_path]
+
     def __scan_directory(self, d):
         """Recursively scan a directory for spreadsheets."""
 
@@ -152,26 +465,152 @@ class MonitorThread(threading.Thread):
                 # Remove self.spreadsheets_path from the path
                 relative_path = full_path.split(self.spreadsheets_path)[1][1:]
 
-                # Calculate the MD5 hash for the file
-                hasher = hashlib.md5()
-                with open(self.__get_full_path(relative_path), "rb") as afile:
-                    buf = afile.read()
-                    hasher.update(buf)
-                    h = hasher.hexdigest()
-
+                h = self.__hash_file(relative_path)
                 self.docs.append({"path": relative_path, "hash": h})
             elif isdir(full_path):
                 self.__scan_directory(full_path)
 
-    def run(self):
-        while not self.stopped():
-            self.docs = []
+    def __hash_file(self, doc_path):
+        """Return the MD5 hash for the file. The file is only read if its
+        size, modification time or inode has changed since it was last
+        hashed."""
+
+        st = stat(self.__get_full_path(doc_path))
+        key = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+        cached = self.file_stats.get(doc_path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        hasher = hashlib.md5()
+        with open(self.__get_full_path(doc_path), "rb") as afile:
+            for chunk in iter(lambda: afile.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
 
-            self.__scan_directory(self.spreadsheets_path)
+        h = hasher.hexdigest()
+        self.file_stats[doc_path] = (key, h)
+        self.files_rehashed += 1
+        return h
 
-            self.__check_removed()
-            self.__check_added()
+    def __update_spreadsheet(self, doc_path):
+        """Load, reload or unload a single spreadsheet after its file has
+        changed."""
+
+        name = basename(doc_path)
+        if name[:7] == ".~lock." or name == ".gitignore" or doc_path[0] == ".":
+            return
+
+        if isfile(self.__get_full_path(doc_path)):
+            doc = {"path": doc_path, "hash": self.__hash_file(doc_path)}
+
+            if doc_path not in self.spreadsheets:
+                with self.load_lock:
+                    self.__load_spreadsheet(doc)
+
+            elif (
+                self.reload_on_disk_change
+                and doc["hash"] != self.hashes.get(doc_path)
+            ):
+                self.__unload_spreadsheet(doc_path)
+                with self.load_lock:
+                    self.__load_spreadsheet(doc)
+
+        else:
+            if doc_path in self.spreadsheets:
+                self.__unload_spreadsheet(doc_path)
+            with self.load_lock:
+                self.registered.pop(doc_path, None)
+            self.file_stats.pop(doc_path, None)
+
+    def __handle_events(self):
+        """Wait for changes in the directory and update the affected
+        spreadsheets once the changes have settled."""
+
+        events = self.watcher.read(self.monitor_frequency)
+
+        changed = set()
+        rescan = False
+        while events:
+            for event in events:
+                if event == OVERFLOW:
+                    rescan = True
+                    continue
+
+                path, is_dir, removed = event
+                doc_path = relpath(path, self.spreadsheets_path)
+
+                if not is_dir:
+                    changed.add(doc_path)
+
+                elif removed:
+                    known = set(self.spreadsheets)
+                    known.update(self.registered, self.file_stats)
+                    changed.update(
+                        key for key in known if key.startswith(doc_path + "/")
+                    )
+
+                else:
+                    self.docs = []
+                    self.__scan_directory(path)
+                    changed.update(doc["path"] for doc in self.docs)
+
+            events = self.watcher.read(DEBOUNCE)
+
+        if rescan:
+            # Events have been lost, so every file is checked.
+            logging.warning("Missed changes to the directory, rescanning.")
+            self.__full_scan()
+            return
+
+        for doc_path in sorted(changed):
+            try:
+                self.__update_spreadsheet(doc_path)
+            except Exception:
+                # The file can not be read or opened. It is tried again when
+                # it next changes.
+                logging.exception("Could not update " + doc_path)
+
+    def __full_scan(self):
+        start = monotonic()
+        rehashed = self.files_rehashed
+        self.docs = []
+
+        self.__scan_directory(self.spreadsheets_path)
+
+        # Forget the files that are no longer there.
+        paths = set(doc["path"] for doc in self.docs)
+        for doc_path in [p for p in self.file_stats if p not in paths]:
+            del self.file_stats[doc_path]
+
+        self.__check_removed()
+        self.__check_added()
+
+        self.last_scan_duration = monotonic() - start
+        self.last_scan_rehashed = self.files_rehashed - rehashed
+        logging.debug(
+            "Scanned %s files in %.3f s, %s hashed",
+            len(self.docs),
+            self.last_scan_duration,
+            self.last_scan_rehashed,
+        )
+
+    def run(self):
+        if self.monitor_mode == "inotify":
+            try:
+                self.watcher = InotifyWatcher(self.spreadsheets_path)
+            except RuntimeError:
+                logging.warning("inotify is not available, polling instead.")
+
+        while not self.stopped():
+            if self.watcher is None or not self.done_scan:
+                self.__full_scan()
+            else:
+                self.__handle_events()
 
             self.done_scan = True
 
-            sleep(self.monitor_frequency)
+            if self.watcher is None:
+                sleep(self.monitor_frequency)
+
+        if self.watcher is not None:
+            self.watcher.close()
@@ -14,51 +14,759 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
-import json
 import logging
-import select
+import random
+import socket
 import socketserver
 import struct
 from socket import SHUT_RDWR
-from time import sleep
+from time import perf_counter, sleep
+from types import GeneratorType
 
 from com.sun.star.uno import RuntimeException
 from com.sun.star.io import IOException
 from connection import SpreadsheetConnection
+from message_log import MessageLog
+from metrics import Metrics
+from scheduler import Scheduler, SchedulerBusy
+from wire import (
+    ENCODINGS,
+    JSON,
+    decode_message,
+    encode_message,
+    receive_exactly,
+    send_frame,
+)
 
-TIMEOUT = 10
+TIMEOUT = 10  # How long to wait, in seconds, to receive from a client
+
+# How long to wait to send a message. A client reading a large response
+# slowly is given longer than one that has gone quiet.
+SEND_TIMEOUT = 60
+
+# The messages that can also be sent as part of a TRANSACTION.
+OPERATIONS = (
+    "SET",
+    "GET",
+    "SET_MANY",
+    "GET_MANY",
+    "GET_SHEETS",
+    "DEFER_CALCULATION",
+    "RECALC",
+    "AFFECTED",
+    "GET_ARRAY",
+    "SET_ARRAY",
+)
+
+# The operations that change the cells of the spreadsheet.
+WRITE_OPERATIONS = ("SET", "SET_MANY", "SET_ARRAY")
+
+# All the messages a client can send once connected. Others are counted as
+# "UNKNOWN" in the metrics, so that clients can not add to their labels.
+COMMANDS = OPERATIONS + (
+    "TRANSACTION",
+    "SAVE",
+    "RESET",
+    "GET_STREAM",
+    "PING",
+    "STATS",
+    "REQUEST",
+)
+
+# The messages that are run without locking the spreadsheet in
+# lock_per_request mode.
+UNLOCKED = ("PING", "STATS")
+
+# The options a client can give in the SPREADSHEET handshake, and their
+# defaults.
+HANDSHAKE_OPTIONS = {
+    "encoding": JSON,
+    "read_only": False,
+    "lock_per_request": False,
+    "priority": 0,
+    "queue_timeout": None,
+}
+
+# Sent instead of "OK" in reply to the handshake, and as the error of a
+# lock_per_request message, when the Scheduler turns a request away.
+BUSY = "BUSY"
+
+# The error of a lock_per_request message once the spreadsheet has been
+# reloaded or closed since the session began.
+CLOSED = "The spreadsheet has been reloaded or closed. Reconnect to use it."
+
+# Returned by SpreadsheetSession.handle_message when it is not to block and
+# the spreadsheet is locked by another session.
+LOCK_BUSY = object()
+
+
+def parse_handshake(data):
+    """Check the SPREADSHEET message that a client starts with and return its
+    options, or None if it does not follow the protocol.
+
+    The message is ["SPREADSHEET", spreadsheet], optionally followed by the
+    encoding or by a dict of HANDSHAKE_OPTIONS.
+    """
+
+    if type(data) != list or len(data) not in (2, 3):
+        return None
+
+    if data[0] != "SPREADSHEET":
+        return None
+
+    options = dict(HANDSHAKE_OPTIONS)
+    if len(data) == 3:
+        given = data[2]
+        if type(given) == str:
+            given = {"encoding": given}
+
+        if type(given) != dict or not set(given) <= set(options):
+            return None
+        options.update(given)
+
+    if options["encoding"] not in ENCODINGS:
+        return None
+
+    if type(options["read_only"]) != bool:
+        return None
+
+    if type(options["lock_per_request"]) != bool:
+        return None
+
+    if type(options["priority"]) != int:
+        return None
+
+    queue_timeout = options["queue_timeout"]
+    if queue_timeout is not None and (
+        type(queue_timeout) not in (int, float) or queue_timeout < 0
+    ):
+        return None
+
+    return options
+
+
+def command_name(data):
+    """Return the command of a message, as it is counted in the metrics. A
+    REQUEST is counted as the message it wraps."""
+
+    if type(data) == list and len(data) == 3 and data[0] == "REQUEST":
+        data = data[2]
+
+    if type(data) == list and len(data) > 0 and data[0] in COMMANDS:
+        return data[0]
+    return "UNKNOWN"
+
+
+def is_error(response):
+    """Whether a response, or the response in a RESPONSE, is an error."""
+
+    if type(response) == list and len(response) == 3:
+        if response[0] == "RESPONSE":
+            response = response[2]
+    return type(response) == dict and "ERROR" in response
+
+
+def _error_response(data, error):
+    """The response to a message that could not be run."""
+
+    if data[0] == "REQUEST" and len(data) == 3:
+        return ["RESPONSE", data[1], {"ERROR": error}]
+    return {"ERROR": error}
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     def __init__(self, save_path, *args, **kwargs):
         self.save_path = save_path
+        self.result_cache = None
+        self.open_spreadsheet = None
+        self.unpin_spreadsheet = None
+        self.restore_replica = None
+        self.track_changes = False
+        self.reset_after_session = False
+        self.dependencies = None
+        self.sheet_indexes = {}
+        self.scheduler = Scheduler()
+        self.metrics = Metrics()
+        self.metrics.queue_depths = self.queue_depths
+        self.message_log = MessageLog()
         socketserver.TCPServer.__init__(self, *args, **kwargs)
 
+    def queue_depths(self):
+        """Return the number of clients waiting for each spreadsheet."""
+
+        return self.scheduler.depths()
+
+    def notify_unlocked(self, spreadsheet, replica):
+        """Wake the sessions waiting for a replica after it was unlocked."""
+
+        if self.scheduler is not None:
+            self.scheduler.notify(spreadsheet, replica)
+
+
+class SpreadsheetSession:
+    """Runs the messages from a client that is connected to a spreadsheet.
+
+    This is independent of how the messages are received and sent so that it
+    can be shared by the different server front ends.
+    """
+
+    def __init__(
+        self,
+        con,
+        server,
+        spreadsheet_name,
+        replica=0,
+        lock_per_request=False,
+        priority=0,
+        client=None,
+        queue_timeout=None,
+    ):
+        self.con = con
+        self.server = server
+        self.spreadsheet_name = spreadsheet_name
+        self.replica = replica  # The index of the replica that is locked
+
+        # How the session waits for the server's Scheduler, if it has one.
+        self.priority = priority
+        self.client = client  # Who the session counts against in quotas
+        self.queue_timeout = queue_timeout
+
+        # Whether the replica is only locked while each message is run, rather
+        # than for the whole session. Other sessions can then use it between
+        # messages, so deferred calculation is turned off again at the end of
+        # each message.
+        self.lock_per_request = lock_per_request
+
+        # The writes in transactions served from the result cache, which have
+        # not been made to the replica yet. They are made before anything else
+        # uses it. The state of the replica is kept by the result cache, and
+        # 'initial_state' is its state when the session began, or None if
+        # other sessions can change it in between messages.
+        self.skipped_writes = []
+        self.initial_state = None
+        if server.result_cache is not None and not lock_per_request:
+            self.initial_state = server.result_cache.state(
+                spreadsheet_name, replica
+            )
+
+    def run_operation(self, data):
+        """Run a single operation, one of OPERATIONS, and return the response
+        for it.
+        """
+
+        if data[0] == "SET":
+            try:
+                self.con.set_cells(data[1], data[2], data[3])
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+            else:
+                return "OK"
+
+        elif data[0] == "GET":
+            try:
+                return self.con.get_cells(data[1], data[2])
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+
+        elif data[0] == "SET_MANY":
+            try:
+                self.con.set_many(data[1], data[2])
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+            else:
+                return "OK"
+
+        elif data[0] == "GET_MANY":
+            try:
+                return self.con.get_many(data[1], data[2])
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+
+        elif data[0] == "GET_ARRAY":
+            try:
+                return self.con.get_array(data[1], data[2])
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+
+        elif data[0] == "SET_ARRAY":
+            try:
+                self.con.set_array(data[1], data[2], data[3])
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+            else:
+                return "OK"
+
+        elif data[0] == "GET_SHEETS":
+            return self.con.get_sheet_names()
+
+        elif data[0] == "DEFER_CALCULATION":
+            try:
+                self.con.defer_calculation(data[1])
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+            else:
+                return "OK"
+
+        elif data[0] == "AFFECTED":
+            try:
+                return self.con.affected(data[1], data[2])
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+
+        elif data[0] == "RECALC":
+            try:
+                self.con.calculate()
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+            else:
+                return "OK"
+
+        return {"ERROR": "Unknown operation."}
+
+    def run_transaction(self, operations):
+        """Run a list of operations in order and return a list of their
+        responses.
+        """
+
+        if type(operations) != list:
+            return {"ERROR": "Expecting a list of operations."}
+
+        cache = self.server.result_cache
+        writes = [
+            operation
+            for operation in operations
+            if type(operation) == list
+            and len(operation) > 0
+            and operation[0] in WRITE_OPERATIONS
+        ]
+
+        state = None
+        if cache is not None:
+            file_hash = self.server.hashes.get(self.spreadsheet_name)
+            state = cache.state(self.spreadsheet_name, self.replica)
+
+        # A read-only session can not make the writes of a cached transaction.
+        if state is not None and not (writes and self.con.read_only):
+            responses = cache.get(
+                self.spreadsheet_name, file_hash, operations, state
+            )
+            if responses is not None:
+                logging.debug("Transaction served from the result cache")
+                if writes:
+                    self.skipped_writes.extend(writes)
+                    self.__set_state(cache.advance(state, writes))
+                return responses
+
+        self.apply_skipped_writes()
+
+        responses = []
+        cacheable = True
+        for operation in operations:
+            if type(operation) != list or len(operation) == 0:
+                responses.append({"ERROR": "Operation is invalid."})
+                cacheable = False
+                continue
+
+            response = self.run_operation(operation)
+            if type(response) == dict and "ERROR" in response:
+                cacheable = False
+            responses.append(response)
+
+        if state is not None and cacheable:
+            cache.put(
+                self.spreadsheet_name, file_hash, operations, responses, state
+            )
+
+        if writes and cache is not None:
+            # If an operation failed, which writes were made is not known.
+            if not cacheable:
+                state = None
+            self.__set_state(cache.advance(state, writes))
+
+        return responses
+
+    def apply_skipped_writes(self):
+        """Make the writes of the transactions served from the result cache
+        to the replica, so that it holds the values the responses describe.
+        """
+
+        writes = self.skipped_writes
+        self.skipped_writes = []
+        for operation in writes:
+            self.run_operation(operation)
+
+    def __set_state(self, state):
+        if self.server.result_cache is not None:
+            self.server.result_cache.set_state(
+                self.spreadsheet_name, self.replica, state
+            )
+
+    def __write(self, data):
+        """Run a write operation sent on its own, outside a transaction."""
+
+        response = self.run_operation(data)
+
+        cache = self.server.result_cache
+        if cache is not None:
+            state = cache.state(self.spreadsheet_name, self.replica)
+            if type(response) == dict and "ERROR" in response:
+                state = None
+            self.__set_state(cache.advance(state, [data]))
+
+        return response
+
+    def __reset(self):
+        """Put back the cells set during the session."""
+
+        # The skipped writes would be undone anyway.
+        self.skipped_writes = []
+        try:
+            self.con.reset()
+        except BaseException:
+            self.__set_state(None)
+            raise
+        self.__set_state(self.initial_state)
+
+    def stream_cells(self, data):
+        """Yield the frames of a GET_STREAM response: a ["ROWS", rows] frame
+        for each block of rows read, then ["END"]. An error ends the stream
+        with an {"ERROR": ...} frame instead.
+        """
+
+        try:
+            if len(data) > 3:
+                blocks = self.con.iter_cell_range(data[1], data[2], data[3])
+            else:
+                blocks = self.con.iter_cell_range(data[1], data[2])
+
+            for rows in blocks:
+                yield ["ROWS", rows]
+        except (ValueError, RuntimeException) as e:
+            yield {"ERROR": str(e)}
+        else:
+            yield ["END"]
+
+    def end(self, blocking=True):
+        """Tidy up the spreadsheet after the client has disconnected and
+        unlock it.
+
+        In lock_per_request mode, the replica is locked first if there is
+        anything to do. False is returned if 'blocking' is False and it is
+        locked by another session, otherwise True.
+        """
+
+        if self.lock_per_request:
+            # Only a reset is left to do and the replica is not locked.
+            if self.con.read_only or not self.server.reset_after_session:
+                return True
+            if self.__current_locks() is None:
+                # There is nothing left to reset.
+                return True
+            if not self.con.lock_spreadsheet(blocking):
+                return False
+            if self.__current_locks() is None:
+                self.__unlock()
+                return True
+
+        # Other sessions may be using the replica between their messages, so
+        # it is not restored.
+        restore = (
+            self.server.restore_replica is not None
+            and not self.lock_per_request
+        )
+
+        try:
+            if restore:
+                # The writes would be undone anyway.
+                self.skipped_writes = []
+            elif not self.server.reset_after_session:
+                self.apply_skipped_writes()
+
+            if self.con.deferred_calculation:
+                self.con.defer_calculation(False)
+
+            # A read-only session has changed nothing, and other readers may
+            # still be using the replica.
+            if self.con.read_only:
+                return True
+
+            if self.server.reset_after_session:
+                self.__reset()
+
+            if restore:
+                self.server.restore_replica(
+                    self.spreadsheet_name, self.replica
+                )
+        finally:
+            self.__unlock()
+
+        return True
+
+    def __current_locks(self):
+        """Return the locks of the replicas of the spreadsheet, or None if it
+        has been reloaded or closed since the session began."""
+
+        locks = self.server.locks.get(self.spreadsheet_name)
+        if locks is None or locks[self.replica] is not self.con.lock:
+            return None
+        return locks
+
+    def __lock(self, blocking, locks):
+        """Lock the replica for a message in lock_per_request mode and return
+        whether it was locked. Waiting for it goes through the server's
+        Scheduler, if it has one, which raises SchedulerBusy if the message is
+        turned away."""
+
+        scheduler = self.server.scheduler
+        if scheduler is None or not blocking:
+            return self.con.lock_spreadsheet(blocking)
+
+        scheduler.acquire(
+            self.spreadsheet_name,
+            locks,
+            self.con.read_only,
+            self.replica,
+            self.priority,
+            self.client,
+            self.queue_timeout,
+        )
+        return True
+
+    def __unlock(self):
+        self.con.unlock_spreadsheet()
+        self.server.notify_unlocked(self.spreadsheet_name, self.replica)
+
+    def __end_request(self):
+        """Turn deferred calculation off and unlock the replica after a
+        message in lock_per_request mode."""
+
+        try:
+            self.apply_skipped_writes()
+            if self.con.deferred_calculation:
+                self.con.defer_calculation(False)
+        finally:
+            self.__unlock()
+
+    def __stream_locked(self, frames):
+        """Yield the frames of a stream, then end the request. The replica
+        stays locked until the stream is finished or closed."""
+
+        try:
+            yield from frames
+        finally:
+            self.__end_request()
+
+    def handle_message(self, data, blocking=True, waiting_since=None):
+        """Run a message received from the client and return the response to
+        send back. None is returned if there is nothing to send. For a
+        GET_STREAM a generator of the frames to send is returned.
+
+        In lock_per_request mode, the replica is locked while the message is
+        run. If 'blocking' is False and it is locked by another session,
+        LOCK_BUSY is returned straight away. A caller that tries again can
+        give the perf_counter time of its first try as 'waiting_since', so
+        that the whole wait is measured. If the Scheduler turns the message
+        away, the response is a BUSY error.
+        """
+
+        command = command_name(data)
+        metrics = self.server.metrics
+
+        if not self.lock_per_request or data[0] in UNLOCKED:
+            return self.__measure(data, command)
+
+        if waiting_since is None:
+            waiting_since = perf_counter()
+
+        locks = self.__current_locks()
+        if locks is None:
+            metrics.count(self.spreadsheet_name, command, True)
+            return _error_response(data, CLOSED)
+
+        try:
+            locked = self.__lock(blocking, locks)
+        except SchedulerBusy as e:
+            logging.info("Turned away a message: %s", e)
+            self.__observe_wait(command, waiting_since)
+            metrics.count(self.spreadsheet_name, command, True)
+            return _error_response(data, BUSY)
+
+        if not locked:
+            return LOCK_BUSY
+        self.__observe_wait(command, waiting_since)
+
+        if self.__current_locks() is None:
+            # It was closed while the lock was waited for.
+            self.__unlock()
+            metrics.count(self.spreadsheet_name, command, True)
+            return _error_response(data, CLOSED)
+
+        try:
+            response = self.__measure(data, command)
+        except BaseException:
+            self.__end_request()
+            raise
+
+        if isinstance(response, GeneratorType):
+            return self.__stream_locked(response)
+
+        self.__end_request()
+        return response
+
+    def __observe_wait(self, command, waiting_since):
+        self.server.metrics.observe(
+            "lock_wait",
+            self.spreadsheet_name,
+            command,
+            perf_counter() - waiting_since,
+        )
+
+    def __measure(self, data, command):
+        """Run a message, count it and time it in the server's metrics."""
+
+        metrics = self.server.metrics
+
+        start = perf_counter()
+        response = self.__run_message(data)
+        elapsed = perf_counter() - start
+
+        if isinstance(response, GeneratorType):
+            return self.__measure_stream(response, command)
+
+        metrics.observe("execute", self.spreadsheet_name, command, elapsed)
+        metrics.count(self.spreadsheet_name, command, is_error(response))
+        return response
+
+    def __measure_stream(self, frames, command):
+        """Yield the frames of a stream, timing how long reading them takes.
+        The stream is counted once it is finished or closed."""
+
+        metrics = self.server.metrics
+        elapsed = 0.0
+        error = False
+
+        try:
+            while True:
+                start = perf_counter()
+                frame = next(frames, None)
+                elapsed += perf_counter() - start
+
+                if frame is None:
+                    break
+                error = is_error(frame)
+                yield frame
+        finally:
+            frames.close()
+            metrics.observe("execute", self.spreadsheet_name, command, elapsed)
+            metrics.count(self.spreadsheet_name, command, error)
+
+    def __run_message(self, data):
+        """Run a message, without locking, and return the response."""
+
+        if data[0] in OPERATIONS + ("SAVE", "GET_STREAM"):
+            self.apply_skipped_writes()
+
+        if data[0] in WRITE_OPERATIONS:
+            return self.__write(data)
+
+        elif data[0] in OPERATIONS:
+            return self.run_operation(data)
+
+        elif data[0] == "TRANSACTION":
+            return self.run_transaction(data[1])
+
+        elif data[0] == "SAVE":
+            try:
+                self.con.save_spreadsheet(data[1])
+            except (IOException, OSError) as e:
+                return {"ERROR": str(e)}
+            else:
+                return "OK"
+
+        elif data[0] == "RESET":
+            try:
+                self.__reset()
+            except (ValueError, RuntimeException) as e:
+                return {"ERROR": str(e)}
+            else:
+                return "OK"
+
+        elif data[0] == "GET_STREAM":
+            if len(data) < 3:
+                return {"ERROR": "Expecting a sheet and a cell range."}
+            return self.stream_cells(data)
+
+        elif data[0] == "PING":
+            # Lets a client check that the connection is still usable.
+            return "OK"
+
+        elif data[0] == "STATS":
+            return self.server.metrics.snapshot()
+
+        elif data[0] == "REQUEST":
+            # A message tagged with an id chosen by the client. The response
+            # carries the same id so that a client with several requests in
+            # flight can match them up.
+            if len(data) != 3:
+                return {"ERROR": "Expecting an id and a message."}
+
+            response = None
+            if type(data[2]) == list and len(data[2]) > 0:
+                response = self.__run_message(data[2])
+
+            if isinstance(response, GeneratorType):
+                # A stream has several frames, so has no single response.
+                response.close()
+                response = {"ERROR": "GET_STREAM can not be a REQUEST."}
+
+            elif response is None:
+                response = {"ERROR": "Unknown message."}
+
+            return ["RESPONSE", data[1], response]
+
+        return None
+
 
 class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
-    def __send(self, msg):
-        """Convert a message to JSON and send it to the client.
+    def __send(self, msg, command=None):
+        """Encode a message and send it to the client.
 
-        The messages are sent as utf-8 encoded bytes
+        Messages are JSON, as utf-8 encoded bytes, unless the client asked for
+        the binary encoding in the SPREADSHEET handshake. If the message is
+        the response to a command, the time taken is recorded in the metrics.
         """
 
-        # What type is msg coming in as?
-        json_msg = json.dumps(msg)
-        json_msg = bytes(json_msg, "utf-8")
+        start = perf_counter()
+        encoded = encode_message(msg, self.encoding)
+        serialized = perf_counter()
 
-        # Prepend the length of the string to the meg
-        json_msg = struct.pack(">I", len(json_msg)) + json_msg
+        self.request.settimeout(SEND_TIMEOUT)
+        try:
+            send_frame(self.request, encoded)
+        except socket.timeout:
+            logging.warning("Waited too long to send to the client.")
+            raise
+        finally:
+            self.request.settimeout(TIMEOUT)
+        sent = perf_counter()
 
-        self.request.send(json_msg)
+        spreadsheet = self.spreadsheet_name
+        if command is not None:
+            metrics = self.server.metrics
+            metrics.observe(
+                "serialize", spreadsheet, command, serialized - start
+            )
+            metrics.observe("send", spreadsheet, command, sent - serialized)
 
-        logging.info("Sent: " + json.dumps(msg))
+        self.server.message_log.sent(
+            spreadsheet, command, msg, len(encoded), sent - start
+        )
 
     def __receive(self):
-        """Receive a message from the client, decode it from JSON and return.
+        """Receive a message from the client, decode it and return it.
 
-        The received messages are utf-8 encoded bytes. False is returned on
-        failure to connect to the client, otherwise a string of the message is
-        returned.
+        False is returned on failure to connect to the client, otherwise the
+        decoded message is returned.
         """
 
         raw_msg_length = self.__receive_length(4)
@@ -68,36 +776,30 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
 
         recv = self.__receive_length(msg_length)
 
-        if recv == b"":
+        if not recv:
             # The connection is closed.
             return False
 
-        recv_json = str(recv, encoding="utf-8")
-        recv_string = json.loads(recv_json)
+        recv_string = decode_message(recv, self.encoding)
 
-        logging.info("Received: " + str(recv_string))
+        self.server.message_log.received(
+            self.spreadsheet_name, recv_string, msg_length
+        )
         return recv_string
 
     def __receive_length(self, length):
-        """Receive length number of bytes from the client."""
-
-        data = b""
-        while len(data) < length:
+        """Receive length number of bytes from the client. An empty result
+        means that the connection was closed or timed out."""
 
-            ready = select.select([self.request], [], [], TIMEOUT)
-
-            if ready[0]:
-
-                packet = self.request.recv(length - len(data))
-                if not packet:
-                    return b""
-                data += packet
-
-            else:
-                logging.warning("Waited too long to recieve from the client.")
-                return b""
+        try:
+            data = receive_exactly(self.request, length)
+        except socket.timeout:
+            logging.warning("Waited too long to recieve from the client.")
+            return b""
+        except OSError:
+            return b""
 
-        return data
+        return b"" if data is None else data
 
     def __make_connection(self):
         """Handle first request to server and check that it adheres to the
@@ -113,19 +815,17 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
             self.__close_connection()
             return False
 
+        # The handshake is always JSON.
+        self.encoding = JSON
         data = self.__receive()
 
-        if type(data) != list:
+        options = parse_handshake(data)
+        if options is None:
             return protocol_error()
+        self.spreadsheet_name = data[1]
 
-        if len(data) != 2:
-            return protocol_error()
-
-        if data[0] != "SPREADSHEET":
-            return protocol_error()
-
-        # If there is a KeyError when looking up the spreadsheets name, wait
-        # a bit and try again
+        # If the spreadsheet has not been loaded yet, or is being reloaded,
+        # wait a bit and try again
 
         max_attempts = self.server.monitor_frequency + 1
         attempt = 0
@@ -138,36 +838,154 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                 self.__close_connection()
                 return False
 
-            try:
-                self.con = SpreadsheetConnection(
-                    self.server.spreadsheets[data[1]],
-                    self.server.locks[data[1]],
-                    self.server.save_path,
-                )
-                break
+            if self.server.open_spreadsheet is not None:
+                # Spreadsheets are opened when they are first asked for.
+                found = self.server.open_spreadsheet(data[1])
+            else:
+                found = data[1] in self.server.spreadsheets
+
+            if found:
+                try:
+                    response = self.__start_session(data[1], options)
+                finally:
+                    if self.server.unpin_spreadsheet is not None:
+                        # A replica is now locked, so the spreadsheet is not
+                        # closed to make room for others.
+                        self.server.unpin_spreadsheet(data[1])
 
-            except KeyError:
-                pass
+                if response is not None:
+                    break
 
             attempt += 1
             logging.debug("Waiting for spreadsheet")
             sleep(1)
 
-        # If the spreadsheet was sucessfully connected to
-        if attempt != max_attempts:
-            self.__send("OK")
-            self.con.lock_spreadsheet()
-            return True
+        if response != "OK":
+            self.__send(response)
+            self.__close_connection()
+            return False
 
-    def __close_connection(self):
-        """Unlock the spreadsheet and close the connection to the client."""
+        self.__send("OK")
+        self.encoding = options["encoding"]
+        return True
 
+    def __start_session(self, spreadsheet, options):
+        """Lock a replica of the spreadsheet and start the session on it.
+
+        The response to the handshake is returned: "OK", or BUSY if the
+        Scheduler turns the client away. None is returned if the spreadsheet
+        has been closed, or reloaded while the client waited for it.
+        """
+
+        if options["lock_per_request"]:
+            replica = self.__choose_replica(spreadsheet)
+        else:
+            try:
+                with self.server.metrics.time(
+                    "lock_wait", spreadsheet, "SPREADSHEET"
+                ):
+                    replica = self.__acquire_replica(spreadsheet, options)
+            except SchedulerBusy as e:
+                logging.info("Turned away a client: %s", e)
+                return BUSY
+
+        # A lock_per_request session holds no lock yet, so the spreadsheet
+        # may be closed at any time. Its messages check for this.
+        replicas = self.server.spreadsheets.get(spreadsheet)
+        locks = self.server.locks.get(spreadsheet)
+        if replica is None or replicas is None or locks is None:
+            return None
+
+        self.con = SpreadsheetConnection(
+            replicas[replica],
+            locks[replica],
+            self.server.save_path,
+            self.server.track_changes,
+            self.__get_dependencies(spreadsheet),
+            self.__get_sheet_index(spreadsheet, replica),
+            options["read_only"],
+        )
+        self.session = SpreadsheetSession(
+            self.con,
+            self.server,
+            spreadsheet,
+            replica,
+            options["lock_per_request"],
+            options["priority"],
+            self.client_address[0],
+            options["queue_timeout"],
+        )
+        self.server.metrics.open_session(spreadsheet)
+        return "OK"
+
+    def __get_dependencies(self, spreadsheet):
+        if self.server.dependencies is None:
+            return None
+        return self.server.dependencies.get(spreadsheet)
+
+    def __get_sheet_index(self, spreadsheet, replica):
         try:
-            if self.con.lock.locked:
-                self.con.unlock_spreadsheet()
-        except (UnboundLocalError, AttributeError):
-            # con was never created.
-            pass
+            return self.server.sheet_indexes[spreadsheet][replica]
+        except (KeyError, IndexError):
+            return None
+
+    def __choose_replica(self, spreadsheet):
+        """Return the index of a replica for a lock_per_request session,
+        without locking it. One that is not locked is preferred."""
+
+        locks = self.server.locks.get(spreadsheet)
+        if locks is None:
+            return None
+
+        for replica, lock in enumerate(locks):
+            if not lock.locked():
+                return replica
+
+        return random.randrange(len(locks))
+
+    def __acquire_replica(self, spreadsheet, options):
+        """Lock a replica of the spreadsheet and return its index, or None if
+        the spreadsheet has been closed.
+
+        If all of them are busy, the server's Scheduler decides when it is the
+        session's turn, and raises SchedulerBusy if it turns it away. A
+        read-only session locks the replica for reading, so it can share it
+        with other readers.
+        """
+
+        while True:
+            locks = self.server.locks.get(spreadsheet)
+            if locks is None:
+                return None
+
+            replica = self.server.scheduler.acquire(
+                spreadsheet,
+                locks,
+                options["read_only"],
+                priority=options["priority"],
+                client=self.client_address[0],
+                timeout=options["queue_timeout"],
+            )
+
+            # The monitor releases the locks of a spreadsheet it has closed
+            # or reloaded, so the lock may no longer be the replica's.
+            current = self.server.locks.get(spreadsheet)
+            if current is not None and current[replica] is locks[replica]:
+                return replica
+
+            if options["read_only"]:
+                locks[replica].release_read()
+            else:
+                locks[replica].release()
+            self.server.notify_unlocked(spreadsheet, replica)
+
+    def __close_connection(self):
+        """Close the connection to the client and unlock the spreadsheet.
+
+        The spreadsheet is reset or restored first if the server is set up to
+        do so. The client has already been disconnected so it does not wait
+        for this.
+        """
 
         try:
             self.request.shutdown(SHUT_RDWR)
@@ -178,6 +996,18 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
         logging.debug("Closing socket for ThreadedTCPRequestHandler")
         self.request.close()
 
+        try:
+            session = self.session
+        except AttributeError:
+            # The session was never created, or has already been ended.
+            return
+        del self.session
+
+        try:
+            session.end()
+        finally:
+            self.server.metrics.close_session(session.spreadsheet_name)
+
     def __main_loop(self):
         while True:
             data = self.__receive()
@@ -186,39 +1016,33 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                 # The connection has been lost.
                 break
 
-            elif data[0] == "SET":
-                try:
-                    self.con.set_cells(data[1], data[2], data[3])
-                except (ValueError, RuntimeException) as e:
-                    self.__send({"ERROR": str(e)})
-                else:
-                    self.__send("OK")
-
-            elif data[0] == "GET":
-                try:
-                    cells = self.con.get_cells(data[1], data[2])
-                except (ValueError, RuntimeException) as e:
-                    self.__send({"ERROR": str(e)})
-                else:
-                    self.__send(cells)
-
-            elif data[0] == "GET_SHEETS":
-                sheet_names = self.con.get_sheet_names()
-                self.__send(sheet_names)
-
-            elif data[0] == "SAVE":
-                try:
-                    self.con.save_spreadsheet(data[1])
-                except (IOException, OSError) as e:
-                    self.__send({"ERROR": str(e)})
-                else:
-                    self.__send("OK")
+            response = self.session.handle_message(data)
+            command = command_name(data)
+            if isinstance(response, GeneratorType):
+                for frame in response:
+                    self.__send(frame, command)
+            elif response is not None:
+                self.__send(response, command)
 
     def handle(self):
         """Make a connection to the client, run the main protocol loop and
         close the connection.
         """
 
-        if self.__make_connection():
-            self.__main_loop()
+        # Timeouts are raised by the socket rather than checked for with
+        # select before each receive.
+        self.request.settimeout(TIMEOUT)
+
+        # Which spreadsheet the client asked for, once it has.
+        self.spreadsheet_name = None
+
+        # The spreadsheet is unlocked however the connection ends, so that
+        # other clients are not left waiting for it.
+        try:
+            if self.__make_connection():
+                self.__main_loop()
+        except OSError as e:
+            # Sending failed or timed out.
+            logging.warning("Lost the connection to the client: %s", e)
+        finally:
             self.__close_connection()
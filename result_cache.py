@@ -0,0 +1,114 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+# The state of a replica that has not been written to since it was opened.
+PRISTINE = ""
+
+
+class ResultCache:
+    """A least recently used cache of the responses to transactions.
+
+    Entries are keyed on the spreadsheet, the hash of its file, the state of
+    the replica and the operations in the transaction. The oldest entries are
+    dropped once there are more than 'max_size' of them.
+
+    The state of a replica is a digest of the writes made to it since it was
+    opened or restored, in order, or None if they are not known. A response
+    is therefore only reused for a replica holding the same cell values.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.states = {}  # (spreadsheet, replica): state, if not PRISTINE
+        self.lock = threading.Lock()
+
+    def __dumps(self, operations):
+        return json.dumps(operations, default=self.__digest)
+
+    def __key(self, spreadsheet, file_hash, operations, state):
+        return (spreadsheet, file_hash, state, self.__dumps(operations))
+
+    def __digest(self, obj):
+        """Stand in for the raw bytes of a SET_ARRAY in the key."""
+
+        return hashlib.md5(obj).hexdigest()
+
+    def get(self, spreadsheet, file_hash, operations, state=PRISTINE):
+        """Return the cached responses for the transaction on a replica in
+        'state' or None if they are not cached."""
+
+        key = self.__key(spreadsheet, file_hash, operations, state)
+
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self.entries[key]
+
+    def put(
+        self, spreadsheet, file_hash, operations, responses, state=PRISTINE
+    ):
+        """Cache the responses to the transaction on a replica in 'state'."""
+
+        key = self.__key(spreadsheet, file_hash, operations, state)
+
+        with self.lock:
+            self.entries[key] = responses
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def state(self, spreadsheet, replica):
+        """Return the state of a replica of the spreadsheet."""
+
+        with self.lock:
+            return self.states.get((spreadsheet, replica), PRISTINE)
+
+    def set_state(self, spreadsheet, replica, state):
+        with self.lock:
+            if state == PRISTINE:
+                self.states.pop((spreadsheet, replica), None)
+            else:
+                self.states[(spreadsheet, replica)] = state
+
+    def advance(self, state, writes):
+        """Return the state of a replica in 'state' once the 'writes', a list
+        of operations, have been made to it."""
+
+        if state is None:
+            return None
+
+        digest = hashlib.md5(state.encode("utf-8"))
+        digest.update(self.__dumps(writes).encode("utf-8"))
+        return digest.hexdigest()
+
+    def invalidate(self, spreadsheet):
+        """Remove all the cached responses and states for the spreadsheet."""
+
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == spreadsheet]:
+                del self.entries[key]
+            for key in [k for k in self.states if k[0] == spreadsheet]:
+                del self.states[key]
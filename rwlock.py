@@ -0,0 +1,119 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import threading
+from collections import deque
+
+
+class ReaderWriterLock:
+    """A lock that can be held by many readers at once, or by one writer.
+
+    Waiting readers and writers are served in the order they arrived, with the
+    readers at the front of the queue let in together. Writers are therefore
+    not starved by a stream of readers, nor readers by writers.
+
+    'acquire', 'release' and 'locked' are for writers and behave as those of
+    threading.Lock, so this can be used in its place.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting = deque()  # A ticket for each waiting thread, in order
+
+    def __can_enter(self, write):
+        if write:
+            return not self.writer and self.readers == 0
+        return not self.writer
+
+    def __enter(self, write):
+        if write:
+            self.writer = True
+        else:
+            self.readers += 1
+
+    def __acquire(self, write, blocking, timeout):
+        with self.condition:
+            if not self.waiting and self.__can_enter(write):
+                self.__enter(write)
+                return True
+
+            if not blocking:
+                return False
+
+            ticket = object()
+            self.waiting.append(ticket)
+
+            entered = self.condition.wait_for(
+                lambda: self.waiting[0] is ticket and self.__can_enter(write),
+                None if timeout < 0 else timeout,
+            )
+
+            if not entered:
+                # Gave up. Whoever is now at the front may be able to enter.
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+                return False
+
+            self.waiting.popleft()
+            self.__enter(write)
+
+            # Let the next reader in the queue in too.
+            self.condition.notify_all()
+            return True
+
+    def acquire(self, blocking=True, timeout=-1):
+        """Acquire the lock for writing. False is returned if it was not
+        acquired because 'blocking' is False or 'timeout' seconds passed."""
+
+        return self.__acquire(True, blocking, timeout)
+
+    def acquire_read(self, blocking=True, timeout=-1):
+        """Acquire the lock for reading. See 'acquire'."""
+
+        return self.__acquire(False, blocking, timeout)
+
+    def release(self):
+        """Release the lock held for writing."""
+
+        with self.condition:
+            if not self.writer:
+                raise RuntimeError("release unlocked lock")
+            self.writer = False
+            self.condition.notify_all()
+
+    def release_read(self):
+        """Release the lock held for reading."""
+
+        with self.condition:
+            if self.readers == 0:
+                raise RuntimeError("release unlocked lock")
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def locked(self):
+        """Whether the lock is held by a writer or by any readers."""
+
+        return self.writer or self.readers > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.release()
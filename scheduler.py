@@ -0,0 +1,221 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import heapq
+import itertools
+import threading
+import time
+
+# Waiting requests are woken when a replica they may lock is unlocked through
+# the scheduler. Locks released outside it, e.g. by the monitor thread when
+# it closes a spreadsheet, do not wake them, so they also check this often,
+# in seconds.
+POLL_INTERVAL = 1.0
+
+
+class SchedulerBusy(Exception):
+    """Raised when a request is turned away instead of waiting for a turn:
+    the spreadsheet's queue or the client's quota is full, or its queue
+    deadline has passed."""
+
+
+class Scheduler:
+    """Decides the order in which waiting requests lock the replicas of a
+    spreadsheet.
+
+    Each replica of a spreadsheet has a queue of the requests waiting for it.
+    Requests with a higher priority go first, and requests of the same
+    priority go in the order they arrived. A request only locks a replica
+    once it is first in the replica's queue, that is once no request ahead
+    of it wants the same replica, and only the first request in a queue is
+    woken when the replica is unlocked.
+
+    A request is turned away with SchedulerBusy, rather than queued, if
+    'max_queue_depth' requests are already waiting for the spreadsheet, or
+    'max_queued_per_client' requests from the same client are waiting. A
+    queued request is turned away once it has waited 'queue_timeout' seconds.
+    None means no limit.
+    """
+
+    def __init__(
+        self,
+        max_queue_depth=None,
+        max_queued_per_client=None,
+        queue_timeout=None,
+    ):
+        self.max_queue_depth = max_queue_depth
+        self.max_queued_per_client = max_queued_per_client
+        self.queue_timeout = queue_timeout
+
+        self.lock = threading.Lock()
+        self.queues = {}  # spreadsheet: {replica: a heap of waiting requests}
+        self.waiting = {}  # spreadsheet: the number of its waiting requests
+        self.queued = {}  # client: the number of its waiting requests
+        self.order = itertools.count()
+
+    def __try_lock(self, locks, replicas, read_only):
+        """Lock the first of 'replicas' that is free and return its index, or
+        None if they are all locked."""
+
+        for replica in replicas:
+            lock = locks[replica]
+            if read_only:
+                acquired = lock.acquire_read(blocking=False)
+            else:
+                acquired = lock.acquire(blocking=False)
+            if acquired:
+                return replica
+        return None
+
+    def __wake(self, queues, replicas):
+        """Wake the first request waiting for each of 'replicas'."""
+
+        for replica in replicas:
+            queue = queues.get(replica)
+            if queue:
+                queue[0][3].notify()
+
+    def __dequeue(self, spreadsheet, request):
+        """Remove 'request' from the queues of its replicas and wake the
+        requests that are now first."""
+
+        queues = self.queues[spreadsheet]
+        for replica in request[2]:
+            queue = queues[replica]
+            if queue[0] is request:
+                heapq.heappop(queue)
+            else:
+                queue.remove(request)
+                heapq.heapify(queue)
+            if not queue:
+                del queues[replica]
+        if not queues:
+            del self.queues[spreadsheet]
+
+        self.waiting[spreadsheet] -= 1
+        if self.waiting[spreadsheet] == 0:
+            del self.waiting[spreadsheet]
+
+        self.__wake(queues, request[2])
+
+    def acquire(
+        self,
+        spreadsheet,
+        locks,
+        read_only=False,
+        replica=None,
+        priority=0,
+        client=None,
+        timeout=None,
+    ):
+        """Wait for a turn to lock a replica of the spreadsheet, lock it and
+        return its index.
+
+        'locks' are the ReaderWriterLocks of the replicas, which are locked
+        for reading if 'read_only'. 'replica' is the index of the only replica
+        to lock, or None for any. 'timeout' is a queue deadline, in seconds,
+        that is used if it is sooner than 'queue_timeout'.
+
+        SchedulerBusy is raised if the request is turned away.
+        """
+
+        replicas = range(len(locks)) if replica is None else [replica]
+
+        if self.queue_timeout is not None:
+            if timeout is None or self.queue_timeout < timeout:
+                timeout = self.queue_timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.lock:
+            queues = self.queues.get(spreadsheet, {})
+
+            # Replicas that no request is waiting for can be locked at once.
+            free = [replica for replica in replicas if replica not in queues]
+            locked = self.__try_lock(locks, free, read_only)
+            if locked is not None:
+                return locked
+
+            if (
+                self.max_queue_depth is not None
+                and self.waiting.get(spreadsheet, 0) >= self.max_queue_depth
+            ):
+                raise SchedulerBusy("The queue for the spreadsheet is full.")
+
+            if (
+                self.max_queued_per_client is not None
+                and self.queued.get(client, 0) >= self.max_queued_per_client
+            ):
+                raise SchedulerBusy("Too many requests from the client.")
+
+            condition = threading.Condition(self.lock)
+            request = (-priority, next(self.order), tuple(replicas), condition)
+            queues = self.queues.setdefault(spreadsheet, queues)
+            for replica in request[2]:
+                heapq.heappush(queues.setdefault(replica, []), request)
+            self.waiting[spreadsheet] = self.waiting.get(spreadsheet, 0) + 1
+            self.queued[client] = self.queued.get(client, 0) + 1
+
+            try:
+                while True:
+                    # It is the request's turn for the replicas whose queues
+                    # it is first in.
+                    turn = [
+                        replica
+                        for replica in request[2]
+                        if queues[replica][0] is request
+                    ]
+                    locked = self.__try_lock(locks, turn, read_only)
+                    if locked is not None:
+                        return locked
+
+                    wait = POLL_INTERVAL
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise SchedulerBusy(
+                                "Waited too long for the spreadsheet."
+                            )
+                        wait = min(wait, remaining)
+
+                    condition.wait(wait)
+            finally:
+                self.__dequeue(spreadsheet, request)
+
+                self.queued[client] -= 1
+                if self.queued[client] == 0:
+                    del self.queued[client]
+
+    def depths(self):
+        """Return the number of requests waiting for each spreadsheet."""
+
+        with self.lock:
+            return dict(self.waiting)
+
+    def notify(self, spreadsheet=None, replica=None):
+        """Wake the requests whose turn it is after a replica has been
+        unlocked. 'spreadsheet' and 'replica' are the spreadsheet and the
+        index of the replica, or None for all of them."""
+
+        with self.lock:
+            if spreadsheet is None:
+                spreadsheets = list(self.queues)
+            else:
+                spreadsheets = [spreadsheet]
+
+            for name in spreadsheets:
+                queues = self.queues.get(name, {})
+                replicas = list(queues) if replica is None else [replica]
+                self.__wake(queues, replicas)
@@ -25,7 +25,12 @@ import subprocess
 import threading
 from time import sleep
 from request_handler import ThreadedTCPRequestHandler, ThreadedTCPServer
+from async_server import AsyncTCPServer
+from message_log import MessageLog
+from metrics import MetricsHTTPServer
 from monitor import MonitorThread
+from result_cache import ResultCache
+from scheduler import Scheduler
 from signal import SIGTERM
 import fileinput
 import psutil
@@ -39,9 +44,15 @@ LOG_FILE = os.path.join(this_dir, "log", "server.log")
 
 SOFFICE_PROCNAME = "soffice.bin"
 HOST, PORT = "localhost", 5555
+METRICS_HOST = "localhost"  # Where the Prometheus metrics are served
 SOFFICE_PIPE = "soffice_headless"
+SOFFICE_INSTANCES = 1  # The number of LibreOffice processes to run
 MONITOR_FREQ = 5  # In seconds
-LOG_LEVEL = logging.DEBUG
+MONITOR_MODE = "poll"  # "poll" or "inotify"
+SERVER_MODE = "threaded"  # "threaded" or "asyncio"
+ASYNC_WORKERS = 4  # Threads calling LibreOffice in the "asyncio" mode
+RESULT_CACHE_SIZE = 0  # The number of cached transactions, 0 to disable
+LOG_LEVEL = logging.INFO
 
 
 class SpreadsheetServer:
@@ -51,13 +62,31 @@ class SpreadsheetServer:
         host=HOST,
         port=PORT,
         soffice_pipe=SOFFICE_PIPE,
+        soffice_instances=SOFFICE_INSTANCES,
         spreadsheets_path=SPREADSHEETS_PATH,
         monitor_frequency=MONITOR_FREQ,
+        monitor_mode=MONITOR_MODE,
+        lazy_load=False,
+        restore_after_session=False,
+        track_changes=False,
+        reset_after_session=False,
+        index_dependencies=False,
+        max_loaded_spreadsheets=None,
+        max_soffice_memory=None,
         reload_on_disk_change=True,
+        result_cache_size=RESULT_CACHE_SIZE,
+        server_mode=SERVER_MODE,
+        async_workers=ASYNC_WORKERS,
+        max_queue_depth=None,
+        max_queued_per_client=None,
+        queue_timeout=None,
+        metrics_port=None,
         ask_kill=False,
         save_path=SAVE_PATH,
         log_level=LOG_LEVEL,
         log_file=LOG_FILE,
+        log_payloads=False,
+        payload_sample_rate=0.0,
     ):
 
         # Where the output from LibreOffice is logged to
@@ -69,14 +98,88 @@ class SpreadsheetServer:
         # The name of the pipe set up by LibreOffice that pyoo will connect to.
         self.soffice_pipe = soffice_pipe
 
+        # How many LibreOffice processes to start. Every spreadsheet is opened
+        # in each of them so that concurrent clients of the same spreadsheet
+        # can be served by different processes. Each process gets its own pipe
+        # and user installation directory.
+        self.soffice_instances = soffice_instances
+        self.soffice_pipes = [soffice_pipe] + [
+            soffice_pipe + "_" + str(i) for i in range(1, soffice_instances)
+        ]
+
         # The frequency, in seconds, at which the directory containing the
         # spreadsheets is polled.
         self.monitor_frequency = monitor_frequency
 
+        # How changes to the spreadsheets directory are found. "poll" rescans
+        # it every monitor_frequency seconds. "inotify" handles each changed
+        # file as soon as it has been written, falling back to polling where
+        # inotify is not available.
+        self.monitor_mode = monitor_mode
+
+        # Whether to only open a spreadsheet when a client first asks for it.
+        # The least recently used spreadsheets are then closed once more than
+        # max_loaded_spreadsheets are open or LibreOffice uses more than
+        # max_soffice_memory bytes. None means no limit.
+        self.lazy_load = lazy_load
+        self.max_loaded_spreadsheets = max_loaded_spreadsheets
+        self.max_soffice_memory = max_soffice_memory
+
+        # Whether to reopen a replica of a spreadsheet from its file after each
+        # client session so that every session starts from the same state.
+        # This happens after the client has disconnected.
+        self.restore_after_session = restore_after_session
+
+        # Whether to record the original contents of the cells that clients
+        # set so that they can be put back with a RESET message. With
+        # reset_after_session, this is also done when a client disconnects.
+        self.reset_after_session = reset_after_session
+        self.track_changes = track_changes or reset_after_session
+
+        # Whether to index which formulas depend on which cells when a
+        # spreadsheet is opened. With deferred calculation, the index lets a
+        # read skip recalculating when the cells read are not affected, and
+        # clients can ask which cells are affected by what they have set.
+        self.dependencies = {} if index_dependencies else None
+
         # Whether or not to close and open a spreadsheet with the file changes on
         # disk
         self.reload_on_disk_change = reload_on_disk_change
 
+        # How many transaction responses to cache. A cached response is
+        # returned for a repeated transaction, without running it in
+        # LibreOffice, when the replica has had the same writes made to it
+        # since it was opened. Formulas using functions such as RAND or NOW
+        # are not recalculated for a cached response.
+        self.result_cache = None
+        if result_cache_size > 0:
+            self.result_cache = ResultCache(result_cache_size)
+
+        # How client connections are served. "threaded" starts a thread for
+        # each connection. "asyncio" serves them all from one event loop and
+        # runs the calls to LibreOffice in a pool of 'async_workers' threads.
+        if server_mode not in ("threaded", "asyncio"):
+            raise ValueError("Unknown server mode: " + str(server_mode))
+        self.server_mode = server_mode
+        self.async_workers = async_workers
+
+        # How clients waiting for a busy spreadsheet are queued in the
+        # "threaded" mode. Each spreadsheet has a queue, ordered by the
+        # priority the clients ask for and then by arrival. A client is told
+        # the server is busy, rather than queued, once max_queue_depth clients
+        # are waiting for the spreadsheet or max_queued_per_client of its own
+        # requests are waiting. It is also told once it has waited
+        # queue_timeout seconds. None means no limit.
+        self.scheduler = Scheduler(
+            max_queue_depth, max_queued_per_client, queue_timeout
+        )
+
+        # The port on which the metrics are served over HTTP in the Prometheus
+        # text format, or None not to serve them. They can also be asked for
+        # by clients with a STATS message.
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+
         # Whether or not to interactively ask the user if they want to kill an
         # existing LibreOffice process.
         self.ask_kill = ask_kill
@@ -87,14 +190,29 @@ class SpreadsheetServer:
         # Where to look for spreadsheets to load.
         self.spreadsheets_path = spreadsheets_path
 
-        self.spreadsheets = {}  # Each pyoo spreadsheet object.
-        self.locks = {}  # A lock for each spreadsheet.
+        # A list of pyoo spreadsheet objects for each spreadsheet, one replica
+        # per soffice instance.
+        self.spreadsheets = {}
+        # A list of ReaderWriterLocks for each spreadsheet, one per replica.
+        self.locks = {}
         self.hashes = {}  # A hash of the file contents for each spreadsheet.
 
+        # A list of SheetIndexes for each spreadsheet, one per replica.
+        self.sheet_indexes = {}
+
         self.log_level = log_level
         self.log_file = log_file  # Where 'logging' logs to
 
-        self.libreoffice_temp_dir = tempfile.TemporaryDirectory()
+        # With the DEBUG log level, a line is logged for each message sent or
+        # received with its command, spreadsheet, cell range, size and timing.
+        # The messages themselves are logged at INFO, but only with
+        # log_payloads, or for a payload_sample_rate fraction of them, as they
+        # can be large.
+        self.message_log = MessageLog(log_payloads, payload_sample_rate)
+
+        self.libreoffice_temp_dirs = [
+            tempfile.TemporaryDirectory() for pipe in self.soffice_pipes
+        ]
 
     def __logging(self):
         """Set up logging."""
@@ -135,22 +253,44 @@ class SpreadsheetServer:
 
         soffice_path = get_soffice_binay_path()
 
-        command = (
-            soffice_path
-            + " -env:UserInstallation=file://"
-            + self.libreoffice_temp_dir.name
-            + ' --accept="pipe,name='
-            + self.soffice_pipe
-            + ';urp;" --norestore --nologo --nodefault --headless --invisible --nocrashreport --nofirststartwizard'
-        )
-
         self.logfile = open(self.soffice_log, "w")
-        self.soffice_process = subprocess.Popen(
-            command, shell=True, stdout=self.logfile, stderr=self.logfile
-        )
+        self.soffice_processes = []
+
+        for pipe, temp_dir in zip(
+            self.soffice_pipes, self.libreoffice_temp_dirs
+        ):
+            command = (
+                soffice_path
+                + " -env:UserInstallation=file://"
+                + temp_dir.name
+                + ' --accept="pipe,name='
+                + pipe
+                + ';urp;" --norestore --nologo --nodefault --headless --invisible --nocrashreport --nofirststartwizard'
+            )
+
+            self.soffice_processes.append(
+                subprocess.Popen(
+                    command,
+                    shell=True,
+                    stdout=self.logfile,
+                    stderr=self.logfile,
+                )
+            )
 
     def __connect_to_soffice(self):
-        """Make a connection to soffice and fail if it can not connect."""
+        """Make a connection to each soffice process and fail if it can not
+        connect.
+        """
+
+        self.soffices = [self.__connect_to_pipe(p) for p in self.soffice_pipes]
+
+        # The first soffice process is used where only one is needed.
+        self.soffice = self.soffices[0]
+
+    def __connect_to_pipe(self, pipe):
+        """Make a connection to the soffice listening on 'pipe' and return the
+        pyoo desktop.
+        """
 
         MAX_ATTEMPTS = 10
 
@@ -162,9 +302,9 @@ class SpreadsheetServer:
                 )
 
             try:
-                self.soffice = pyoo.Desktop(pipe=SOFFICE_PIPE)
-                logging.info("Connected to soffice.")
-                break
+                soffice = pyoo.Desktop(pipe=pipe)
+                logging.info("Connected to soffice on pipe " + pipe + ".")
+                return soffice
 
             except (OSError, IOError):
                 attempt += 1
@@ -187,11 +327,18 @@ class SpreadsheetServer:
 
         def start_threaded_tcp_server(attempt):
             try:
-                self.server = ThreadedTCPServer(
-                    self.save_path,
-                    (self.host, self.port),
-                    ThreadedTCPRequestHandler,
-                )
+                if self.server_mode == "asyncio":
+                    self.server = AsyncTCPServer(
+                        self.save_path,
+                        (self.host, self.port),
+                        self.async_workers,
+                    )
+                else:
+                    self.server = ThreadedTCPServer(
+                        self.save_path,
+                        (self.host, self.port),
+                        ThreadedTCPRequestHandler,
+                    )
 
             except (OSError, socket.error):
                 attempt += 1
@@ -215,9 +362,24 @@ class SpreadsheetServer:
         self.server.locks = self.locks
         self.server.hashes = self.hashes
         self.server.monitor_frequency = self.monitor_frequency
+        self.server.result_cache = self.result_cache
+        self.server.track_changes = self.track_changes
+        self.server.reset_after_session = self.reset_after_session
+        self.server.dependencies = self.dependencies
+        self.server.sheet_indexes = self.sheet_indexes
+        self.server.message_log = self.message_log
+        if self.server_mode == "threaded":
+            self.server.scheduler = self.scheduler
+
+        if self.lazy_load:
+            self.server.open_spreadsheet = self.__open_spreadsheet
+            self.server.unpin_spreadsheet = self.__unpin_spreadsheet
 
-        # Start the main server thread. This server thread will start a
-        # new thread to handle each client connection.
+        if self.restore_after_session:
+            self.server.restore_replica = self.__restore_replica
+
+        # Start the main server thread. In the "threaded" mode, this server
+        # thread will start a new thread to handle each client connection.
 
         self.server_thread = threading.Thread(target=self.server.serve_forever)
 
@@ -226,6 +388,49 @@ class SpreadsheetServer:
 
         logging.info("Server thread running. Waiting on connections...")
 
+    def __start_metrics_server(self):
+        """Serve the metrics of the TCP server over HTTP, if a port was
+        given."""
+
+        if self.metrics_port is None:
+            return
+
+        self.metrics_server = MetricsHTTPServer(
+            self.server.metrics, (METRICS_HOST, self.metrics_port)
+        )
+
+        self.metrics_thread = threading.Thread(
+            target=self.metrics_server.serve_forever
+        )
+        self.metrics_thread.daemon = True
+        self.metrics_thread.start()
+
+        logging.info("Serving metrics on port %s.", self.metrics_port)
+
+    def __stop_metrics_server(self):
+        """Stop the MetricsHTTPServer, if it was started."""
+
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+
+    def __open_spreadsheet(self, doc_path):
+        """Open a spreadsheet that has only been registered by the monitor
+        thread."""
+
+        return self.monitor_thread.open_spreadsheet(doc_path)
+
+    def __unpin_spreadsheet(self, doc_path):
+        """Let a spreadsheet opened by '__open_spreadsheet' be closed again
+        once a client has locked a replica of it."""
+
+        self.monitor_thread.unpin_spreadsheet(doc_path)
+
+    def __restore_replica(self, doc_path, replica):
+        """Replace a replica of a spreadsheet with a pristine copy."""
+
+        self.monitor_thread.restore_replica(doc_path, replica)
+
     def __start_monitor_thread(self):
         """This thread monitors the SPREADSHEETS directory to add or remove.
         """
@@ -234,10 +439,19 @@ class SpreadsheetServer:
             self.spreadsheets,
             self.locks,
             self.hashes,
-            self.soffice,
+            self.soffices,
             self.spreadsheets_path,
             self.monitor_frequency,
             self.reload_on_disk_change,
+            self.result_cache,
+            self.monitor_mode,
+            self.lazy_load,
+            self.max_loaded_spreadsheets,
+            self.max_soffice_memory,
+            [process.pid for process in self.soffice_processes],
+            self.dependencies,
+            self.sheet_indexes,
+            self.restore_after_session,
         )
 
         self.monitor_thread.daemon = True
@@ -261,11 +475,14 @@ class SpreadsheetServer:
             pass
 
     def __kill_libreoffice(self):
-        """Terminate the soffice.bin process."""
+        """Terminate the soffice.bin processes."""
+
+        for process in self.soffice_processes:
+            process.terminate()
+            process.wait()
 
-        self.soffice_process.terminate()
-        self.soffice_process.wait()
-        self.libreoffice_temp_dir.cleanup()
+        for temp_dir in self.libreoffice_temp_dirs:
+            temp_dir.cleanup()
 
     def __close_logfile(self):
         """Close the logfile."""
@@ -276,6 +493,7 @@ class SpreadsheetServer:
         """Stop all the threads and shutdown LibreOffice."""
 
         self.__stop_monitor_thread()
+        self.__stop_metrics_server()
         self.__stop_threaded_tcp_server()
         self.__kill_libreoffice()
         self.__close_logfile()
@@ -286,6 +504,7 @@ class SpreadsheetServer:
         self.__connect_to_soffice()
         self.__start_monitor_thread()
         self.__start_threaded_tcp_server()
+        self.__start_metrics_server()
 
 
 if __name__ == "__main__":
@@ -3,8 +3,26 @@ import sys
 
 sys.path.insert(0, os.path.abspath(".."))
 
-from connection import SpreadsheetConnection
+from connection import SheetIndex, SpreadsheetConnection
 from server import SpreadsheetServer
 from monitor import MonitorThread
 from request_handler import ThreadedTCPServer, ThreadedTCPRequestHandler
-from client import SpreadsheetClient
+from client import (
+    AsyncSpreadsheetClient,
+    ServerBusyError,
+    SpreadsheetClient,
+    SpreadsheetClientPool,
+)
+from result_cache import ResultCache
+from dependencies import DependencyIndex
+from message_log import MessageLog
+from metrics import Histogram, Metrics, MetricsHTTPServer
+from rwlock import ReaderWriterLock
+from scheduler import Scheduler, SchedulerBusy
+from watcher import EVENT_HEADER, IN_Q_OVERFLOW, OVERFLOW, InotifyWatcher
+from wire import (
+    decode_message,
+    encode_message,
+    receive_exactly,
+    send_frame,
+)
@@ -1,10 +1,24 @@
+import asyncio
 import unittest
-from .context import SpreadsheetServer, SpreadsheetClient
+from .context import (
+    AsyncSpreadsheetClient,
+    ResultCache,
+    ServerBusyError,
+    SpreadsheetServer,
+    SpreadsheetClient,
+    SpreadsheetClientPool,
+)
 from time import sleep
 import os
 import shutil
 import sys
 import logging
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 EXAMPLE_SPREADSHEET = "example.ods"
 SOFFICE_PIPE = "soffice_headless"
@@ -148,6 +162,27 @@ class TestClient(unittest.TestCase):
         except RuntimeError as e:
             self.assertEqual(str(e), "Cell range is invalid.")
 
+    def test_get_invalid_cell_list(self):
+        try:
+            self.sc.get_cells(SHEET_NAME, ["A1"])
+            self.assertTrue(False)
+        except RuntimeError as e:
+            self.assertEqual(str(e), "Cell range is invalid.")
+
+        try:
+            self.sc.get_many(SHEET_NAME, ["A1", ["B2"]])
+            self.assertTrue(False)
+        except RuntimeError as e:
+            self.assertEqual(str(e), "Cell range is invalid.")
+
+    def test_short_request(self):
+        self.sc._SpreadsheetClient__send(["REQUEST", 1])
+        self.assertEqual(
+            self.sc._SpreadsheetClient__receive(),
+            {"ERROR": "Expecting an id and a message."},
+        )
+        self.assertTrue(self.sc.ping())
+
     def test_set_cell_row(self):
         cell_values = [4, 5, 6]
         self.sc.set_cells(SHEET_NAME, "A1:A3", cell_values)
@@ -170,6 +205,225 @@ class TestClient(unittest.TestCase):
         saved_values = self.sc.get_cells(SHEET_NAME, "A1:C3")
         self.assertEqual(cell_values, saved_values)
 
+    def test_get_cells_stream(self):
+        cell_values = [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+        self.sc.set_cells(SHEET_NAME, "A1:C3", cell_values)
+
+        blocks = list(self.sc.get_cells_stream(SHEET_NAME, "A1:C3", 2))
+        self.assertEqual(blocks, [cell_values[:2], cell_values[2:]])
+
+    def test_get_cells_stream_closed_early(self):
+        blocks = self.sc.get_cells_stream(SHEET_NAME, "A1:C3", 1)
+        next(blocks)
+        blocks.close()
+        self.assertEqual(self.sc.get_cells(SHEET_NAME, "C3"), 6)
+
+    def test_get_cells_stream_invalid_sheet(self):
+        try:
+            list(self.sc.get_cells_stream(SHEET_NAME + "z", "A1:C3"))
+            self.assertTrue(False)
+        except RuntimeError as e:
+            self.assertEqual(str(e), "Sheet name is invalid.")
+
+    def test_set_many(self):
+        self.sc.set_many(SHEET_NAME, {"A1": 1, "B3": 2})
+        cells = self.sc.get_many(SHEET_NAME, ["A1", "B3", "C3"])
+        self.assertEqual(cells, {"A1": 1, "B3": 2, "C3": 6})
+
+    def test_transaction(self):
+        results = self.sc.transaction(
+            [
+                ["SET", SHEET_NAME, "A1:A3", [4, 5, 6]],
+                ["GET", SHEET_NAME, "A1:A3"],
+                ["GET_SHEETS"],
+            ]
+        )
+        self.assertEqual(results, [None, [4, 5, 6], ["Sheet1"]])
+
+    def test_transaction_error(self):
+        try:
+            self.sc.transaction([["GET", SHEET_NAME + "z", "C3"]])
+            self.assertTrue(False)
+        except RuntimeError as e:
+            self.assertEqual(str(e), "Sheet name is invalid.")
+
+    def test_result_cache_after_set(self):
+        # Serve transactions from a result cache for this test only.
+        self.server.server.result_cache = ResultCache(10)
+        try:
+            transaction = [["GET", SHEET_NAME, "A1"]]
+
+            self.sc.set_cells(SHEET_NAME, "A1", 1)
+            self.assertEqual(self.sc.transaction(transaction), [1])
+            self.assertEqual(self.sc.transaction(transaction), [1])
+
+            # The cached response no longer applies.
+            self.sc.set_cells(SHEET_NAME, "A1", 2)
+            self.assertEqual(self.sc.transaction(transaction), [2])
+        finally:
+            self.server.server.result_cache = None
+
+    def test_batch(self):
+        with self.sc.batch() as batch:
+            batch.set_cells(SHEET_NAME, "A1", 5)
+            a1 = batch.get_cells(SHEET_NAME, "A1")
+            c3 = batch.get_cells(SHEET_NAME, "C3")
+
+        self.assertEqual(a1.value, 5)
+        self.assertEqual(c3.value, 6)
+
+    def test_defer_calculation(self):
+        # C1 is =SUM(A1:B1). Reading cells through the client recalculates
+        # first, so the replica is read directly to see the deferred value.
+        replica = self.server.spreadsheets[EXAMPLE_SPREADSHEET][0]
+        self.sc.set_cells(SHEET_NAME, "A1:B1", [1, 1])
+        self.assertEqual(replica.sheets[SHEET_NAME][0, 2].value, 2)
+
+        self.sc.defer_calculation()
+        self.sc.set_cells(SHEET_NAME, "A1", 5)
+        self.assertEqual(replica.sheets[SHEET_NAME][0, 2].value, 2)
+
+        self.sc.recalculate()
+        self.assertEqual(replica.sheets[SHEET_NAME][0, 2].value, 6)
+        self.assertEqual(self.sc.get_cells(SHEET_NAME, "C1"), 6)
+        self.sc.defer_calculation(False)
+
+    def test_ping(self):
+        self.assertTrue(self.sc.ping())
+
+    def test_reload_while_queued(self):
+        # The test holds the locks, as the monitor does while it reloads the
+        # spreadsheet, and a client queues for them.
+        self.sc.disconnect()
+        monitor = self.server.monitor_thread
+        doc = {
+            "path": EXAMPLE_SPREADSHEET,
+            "hash": self.server.hashes[EXAMPLE_SPREADSHEET],
+        }
+        for lock in self.server.locks[EXAMPLE_SPREADSHEET]:
+            lock.acquire()
+
+        clients = []
+        queued = threading.Thread(
+            target=lambda: clients.append(
+                SpreadsheetClient(EXAMPLE_SPREADSHEET)
+            )
+        )
+        queued.start()
+        while not self.server.server.queue_depths():
+            sleep(0.01)
+
+        with monitor.load_lock:
+            monitor._MonitorThread__close_spreadsheet(EXAMPLE_SPREADSHEET)
+            monitor._MonitorThread__open_spreadsheet(doc)
+        queued.join()
+
+        # The client waits for the reopened replica and locks it, rather than
+        # using it under the lock it queued for.
+        self.sc = clients[0]
+        self.assertTrue(self.server.locks[EXAMPLE_SPREADSHEET][0].locked())
+        self.assertEqual(self.sc.get_sheet_names(), [SHEET_NAME])
+
+    def test_get_stats(self):
+        self.sc.get_cells(SHEET_NAME, "A1")
+        stats = self.sc.get_stats()
+
+        counts = stats["requests"][EXAMPLE_SPREADSHEET]["GET"]
+        self.assertGreaterEqual(counts["count"], 1)
+        latency = stats["latency"][EXAMPLE_SPREADSHEET]["GET"]
+        self.assertEqual(set(latency), {"execute", "serialize", "send"})
+        self.assertEqual(stats["sessions"][EXAMPLE_SPREADSHEET], 1)
+
+    def test_binary_encoding(self):
+        # self.sc holds the only replica of the spreadsheet
+        self.sc.disconnect()
+        sc = SpreadsheetClient(EXAMPLE_SPREADSHEET, encoding="binary")
+
+        cell_values = [
+            [float(row * 3 + col) for col in range(3)] for row in range(40)
+        ]
+        sc.set_cells(SHEET_NAME, "A1:C40", cell_values)
+        self.assertEqual(sc.get_cells(SHEET_NAME, "A1:C40"), cell_values)
+        self.assertEqual(sc.get_cells(SHEET_NAME, "C3"), 8)
+
+        sc.disconnect()
+        self.sc = SpreadsheetClient(EXAMPLE_SPREADSHEET)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_array(self):
+        values = numpy.array([[1.0, 2.0], [numpy.nan, 4.0]])
+        self.sc.set_array(SHEET_NAME, "A1:B2", values)
+
+        received = self.sc.get_array(SHEET_NAME, "A1:B2")
+        numpy.testing.assert_array_equal(received, values)
+
+    def test_read_only_sessions_share_the_spreadsheet(self):
+        # self.sc holds the only replica of the spreadsheet
+        self.sc.set_cells(SHEET_NAME, "A1", 5)
+        self.sc.disconnect()
+
+        first = SpreadsheetClient(EXAMPLE_SPREADSHEET, read_only=True)
+        second = SpreadsheetClient(EXAMPLE_SPREADSHEET, read_only=True)
+        self.assertEqual(first.get_cells(SHEET_NAME, "A1"), 5)
+        self.assertEqual(second.get_cells(SHEET_NAME, "A1"), 5)
+
+        try:
+            first.set_cells(SHEET_NAME, "A1", 6)
+            self.assertTrue(False)
+        except RuntimeError as e:
+            self.assertEqual(str(e), "The spreadsheet is open read-only.")
+
+        first.disconnect()
+        second.disconnect()
+        self.sc = SpreadsheetClient(EXAMPLE_SPREADSHEET)
+
+    def test_read_only_defer_calculation(self):
+        # self.sc holds the only replica of the spreadsheet
+        self.sc.disconnect()
+
+        sc = SpreadsheetClient(EXAMPLE_SPREADSHEET, read_only=True)
+        try:
+            sc.defer_calculation()
+            self.assertTrue(False)
+        except RuntimeError as e:
+            self.assertEqual(str(e), "The spreadsheet is open read-only.")
+
+        # The session is still usable and releases the replica.
+        self.assertTrue(sc.ping())
+        sc.disconnect()
+        self.sc = SpreadsheetClient(EXAMPLE_SPREADSHEET)
+
+    def test_lock_per_request(self):
+        # self.sc holds the only replica of the spreadsheet
+        self.sc.disconnect()
+
+        first = SpreadsheetClient(EXAMPLE_SPREADSHEET, lock_per_request=True)
+        second = SpreadsheetClient(EXAMPLE_SPREADSHEET, lock_per_request=True)
+        first.set_cells(SHEET_NAME, "A1", 5)
+        self.assertEqual(second.get_cells(SHEET_NAME, "A1"), 5)
+
+        # The spreadsheet is not locked between their messages.
+        self.sc = SpreadsheetClient(EXAMPLE_SPREADSHEET)
+        first.disconnect()
+        second.disconnect()
+        self.assertEqual(self.sc.get_cells(SHEET_NAME, "A1"), 5)
+
+    def test_pool_reuses_connection(self):
+        # self.sc holds the only replica of the spreadsheet
+        self.sc.disconnect()
+        pool = SpreadsheetClientPool(max_size=1)
+
+        with pool.connection(EXAMPLE_SPREADSHEET) as sc:
+            first = sc
+            sc.set_cells(SHEET_NAME, "A1", 5)
+
+        with pool.connection(EXAMPLE_SPREADSHEET) as sc:
+            self.assertIs(sc, first)
+            self.assertEqual(sc.get_cells(SHEET_NAME, "A1"), 5)
+
+        pool.close()
+        self.sc = SpreadsheetClient(EXAMPLE_SPREADSHEET)
+
     def test_save_spreadsheet(self):
         filename = "test.ods"
         self.sc.save_spreadsheet(filename)
@@ -194,5 +448,137 @@ class TestClient(unittest.TestCase):
             self.assertEqual(chr(i), cell)
 
 
+class TestClientAsyncServer(unittest.TestCase):
+    PORT = 5556
+
+    @classmethod
+    def setUpClass(cls):
+        shutil.copyfile(
+            TESTS_PATH + "/" + EXAMPLE_SPREADSHEET,
+            SPREADSHEETS_PATH + "/" + EXAMPLE_SPREADSHEET,
+        )
+
+        cls.server = SpreadsheetServer(
+            port=cls.PORT, server_mode="asyncio", log_level=logging.CRITICAL
+        )
+        cls.server.run()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        os.remove(SPREADSHEETS_PATH + "/" + EXAMPLE_SPREADSHEET)
+
+    def setUp(self):
+        self.sc = SpreadsheetClient(EXAMPLE_SPREADSHEET, port=self.PORT)
+
+    def tearDown(self):
+        self.sc.disconnect()
+
+    def test_set_cell(self):
+        self.sc.set_cells(SHEET_NAME, "A1", 5)
+        a1 = self.sc.get_cells(SHEET_NAME, "A1")
+        self.assertEqual(a1, 5)
+
+    def test_get_cell_invalid_sheet(self):
+        try:
+            self.sc.get_cells(SHEET_NAME + "z", "C3")
+            self.assertTrue(False)
+        except RuntimeError as e:
+            self.assertEqual(str(e), "Sheet name is invalid.")
+
+    def test_connect_invalid_spreadsheet(self):
+        try:
+            SpreadsheetClient(EXAMPLE_SPREADSHEET + "z", port=self.PORT)
+            self.assertTrue(False)
+        except RuntimeError as e:
+            self.assertEqual(
+                str(e), "The requested spreadsheet was not found."
+            )
+
+    def test_queue_timeout(self):
+        # self.sc holds the only replica, so the client is turned away once
+        # it has waited for it, rather than told "OK" while it waits.
+        self.assertRaises(
+            ServerBusyError,
+            SpreadsheetClient,
+            EXAMPLE_SPREADSHEET,
+            port=self.PORT,
+            queue_timeout=0.1,
+        )
+
+        # It is answered as soon as the replica is free.
+        self.sc.disconnect()
+        self.sc = SpreadsheetClient(
+            EXAMPLE_SPREADSHEET, port=self.PORT, queue_timeout=5
+        )
+        self.assertTrue(self.sc.ping())
+
+    def test_reload_while_queued(self):
+        # As for the threaded server. The client waits for the lock in turn.
+        self.sc.disconnect()
+        monitor = self.server.monitor_thread
+        doc = {
+            "path": EXAMPLE_SPREADSHEET,
+            "hash": self.server.hashes[EXAMPLE_SPREADSHEET],
+        }
+        for lock in self.server.locks[EXAMPLE_SPREADSHEET]:
+            lock.acquire()
+
+        clients = []
+        queued = threading.Thread(
+            target=lambda: clients.append(
+                SpreadsheetClient(EXAMPLE_SPREADSHEET, port=self.PORT)
+            )
+        )
+        queued.start()
+        while not self.server.server.lock_queues:
+            sleep(0.01)
+
+        with monitor.load_lock:
+            monitor._MonitorThread__close_spreadsheet(EXAMPLE_SPREADSHEET)
+            monitor._MonitorThread__open_spreadsheet(doc)
+        queued.join()
+
+        self.sc = clients[0]
+        self.assertTrue(self.server.locks[EXAMPLE_SPREADSHEET][0].locked())
+        self.assertEqual(self.sc.get_sheet_names(), [SHEET_NAME])
+
+    def test_async_client(self):
+        async def get_cells():
+            sc = await AsyncSpreadsheetClient.connect(
+                EXAMPLE_SPREADSHEET, port=self.PORT
+            )
+            await sc.set_cells(SHEET_NAME, "A1", 5)
+            cells = await asyncio.gather(
+                sc.get_cells(SHEET_NAME, "A1"),
+                sc.get_cells(SHEET_NAME, "C3"),
+                sc.get_sheet_names(),
+            )
+            await sc.disconnect()
+            return cells
+
+        # The synchronous client holds the only replica
+        self.sc.disconnect()
+        cells = asyncio.run(get_cells())
+        self.sc = SpreadsheetClient(EXAMPLE_SPREADSHEET, port=self.PORT)
+
+        self.assertEqual(cells, [5, 6, ["Sheet1"]])
+
+    def test_async_client_error(self):
+        async def get_invalid_cell():
+            async with await AsyncSpreadsheetClient.connect(
+                EXAMPLE_SPREADSHEET, port=self.PORT
+            ) as sc:
+                await sc.get_cells(SHEET_NAME, "A")
+
+        self.sc.disconnect()
+        try:
+            asyncio.run(get_invalid_cell())
+            self.assertTrue(False)
+        except RuntimeError as e:
+            self.assertEqual(str(e), "Cell range is invalid.")
+        self.sc = SpreadsheetClient(EXAMPLE_SPREADSHEET, port=self.PORT)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,12 @@
 import os
 import shutil
+import sys
 import threading
 import unittest
+from array import array
 from signal import SIGTERM
 
-from .context import SpreadsheetConnection, SpreadsheetServer
+from .context import SheetIndex, SpreadsheetConnection, SpreadsheetServer
 
 EXAMPLE_SPREADSHEET = "example.ods"
 SOFFICE_PIPE = "soffice_headless"
@@ -127,6 +129,31 @@ class TestConnection(unittest.TestCase):
         self.assertEqual(alpha_index, 1023)
         self.assertEqual(num_index, 1048575)
 
+    def test_get_xy_index_absolute(self):
+        (
+            alpha_index,
+            num_index,
+        ) = self.ss_con._SpreadsheetConnection__get_xy_index(u"$AB$12")
+        self.assertEqual(alpha_index, 27)
+        self.assertEqual(num_index, 11)
+
+    def test_cell_range_to_index_reversed(self):
+        d = self.ss_con._SpreadsheetConnection__cell_range_to_index(u"Z26:C9")
+        self.assertEqual(d["row_start"], 8)
+        self.assertEqual(d["row_end"], 25)
+        self.assertEqual(d["column_start"], 2)
+        self.assertEqual(d["column_end"], 25)
+
+    def test_is_single_cell_range_of_one(self):
+        status = self.ss_con._SpreadsheetConnection__is_single_cell(u"B2:B2")
+        self.assertTrue(status)
+
+    def test_get_cells_sheet_in_cell_ref(self):
+        self.assertEqual(
+            self.ss_con.get_cells(0, u"Sheet1!C3"),
+            self.ss_con.get_cells(u"Sheet1", u"C3"),
+        )
+
     def test_is_single_cell(self):
         status = self.ss_con._SpreadsheetConnection__is_single_cell(u"AMJ1")
         self.assertTrue(status)
@@ -262,6 +289,32 @@ class TestConnection(unittest.TestCase):
         )
         self.ss_con.unlock_spreadsheet()
 
+    def test_iter_cell_range(self):
+        self.ss_con.lock_spreadsheet()
+        self.ss_con.set_cells(u"Sheet1", u"A1:A3", [1, 2, 3])
+        blocks = list(self.ss_con.iter_cell_range(u"Sheet1", u"A1:A3", 2))
+        self.assertEqual(blocks, [[[1.0], [2.0]], [[3.0]]])
+        self.ss_con.unlock_spreadsheet()
+
+    def test_set_get_array(self):
+        self.ss_con.lock_spreadsheet()
+        data = array("d", [1, 2, float("nan"), 4])
+        if sys.byteorder == "big":
+            data.byteswap()
+        values = {"dtype": "<f8", "shape": [2, 2], "data": data.tobytes()}
+        self.ss_con.set_array(u"Sheet1", u"A1:B2", values)
+
+        self.assertEqual(self.ss_con.get_array(u"Sheet1", u"A1:B2"), values)
+        self.assertEqual(self.ss_con.get_cells(u"Sheet1", u"A2"), "")
+        self.ss_con.unlock_spreadsheet()
+
+    def test_set_array_wrong_shape(self):
+        self.ss_con.lock_spreadsheet()
+        values = {"dtype": "<f8", "data": bytes(24)}
+        with self.assertRaises(ValueError):
+            self.ss_con.set_array(u"Sheet1", u"A1:B2", values)
+        self.ss_con.unlock_spreadsheet()
+
     def test_set_cell_range_2D_incorrect_data(self):
         self.ss_con.lock_spreadsheet()
         status = False
@@ -278,10 +331,104 @@ class TestConnection(unittest.TestCase):
         )
         self.ss_con.unlock_spreadsheet()
 
+    def test_group_cells(self):
+        cells = [(0, 0), (0, 1), (1, 0), (1, 1), (1, 3), (5, 2)]
+        ranges = self.ss_con._SpreadsheetConnection__group_cells(cells)
+        self.assertEqual(ranges, [(0, 1, 0, 1), (1, 1, 3, 3), (5, 5, 2, 2)])
+
+    def test_set_many(self):
+        self.ss_con.lock_spreadsheet()
+        self.ss_con.set_many(u"Sheet1", {u"A1": 1, u"B1": 2, u"D4": u"a"})
+        self.assertEqual(
+            self.ss_con.get_many(u"Sheet1", [u"A1", u"B1", u"D4"]),
+            {u"A1": 1.0, u"B1": 2.0, u"D4": u"a"},
+        )
+        self.ss_con.unlock_spreadsheet()
+
+    def test_set_many_cell_range(self):
+        self.ss_con.lock_spreadsheet()
+        status = False
+        try:
+            self.ss_con.set_many(u"Sheet1", {u"A1:B2": 1})
+        except ValueError:
+            status = True
+        self.ss_con.unlock_spreadsheet()
+
+        self.assertTrue(status)
+
+    def test_reset(self):
+        lock = threading.Lock()
+        ss_con = SpreadsheetConnection(
+            self.spreadsheet,
+            lock,
+            self.spreadsheet_server.save_path,
+            track_changes=True,
+        )
+        ss_con.lock_spreadsheet()
+        original = ss_con.get_cells(u"Sheet1", u"A1:C3")
+
+        ss_con.set_cells(u"Sheet1", u"A1", 99)
+        ss_con.set_cells(
+            u"Sheet1", u"A1:C3", [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+        )
+        ss_con.set_many(u"Sheet1", {u"B2": 0, u"D4": 1})
+
+        self.assertEqual(ss_con.reset(), 10)
+        self.assertEqual(ss_con.get_cells(u"Sheet1", u"A1:C3"), original)
+        ss_con.unlock_spreadsheet()
+
+    def test_reset_not_tracking(self):
+        self.ss_con.lock_spreadsheet()
+        status = False
+        try:
+            self.ss_con.reset()
+        except ValueError:
+            status = True
+        self.ss_con.unlock_spreadsheet()
+
+        self.assertTrue(status)
+
+    def test_deferred_calculation(self):
+        self.ss_con.lock_spreadsheet()
+        self.ss_con.defer_calculation(True)
+        self.ss_con.set_cells(u"Sheet1", u"A1", 1)
+        self.assertTrue(self.ss_con.calculation_pending)
+
+        self.ss_con.get_cells(u"Sheet1", u"C3")
+        self.assertFalse(self.ss_con.calculation_pending)
+
+        self.ss_con.defer_calculation(False)
+        self.ss_con.unlock_spreadsheet()
+
     def test_get_sheet_names(self):
         sheet_names = self.ss_con.get_sheet_names()
         self.assertEqual(sheet_names, [u"Sheet1"])
 
+    def test_sheet_index(self):
+        sheet_index = SheetIndex(self.spreadsheet)
+        ss_con = SpreadsheetConnection(
+            self.spreadsheet,
+            threading.Lock(),
+            self.spreadsheet_server.save_path,
+            sheet_index=sheet_index,
+        )
+        self.assertIs(ss_con.sheet_index, sheet_index)
+        self.assertEqual(sheet_index.names, ["Sheet1"])
+        self.assertIs(sheet_index.get("Sheet1"), sheet_index.get(0))
+        sheet = sheet_index.get(0)
+        self.assertEqual(sheet_index.name_of[id(sheet)], "Sheet1")
+
+    def test_sheet_index_refreshed_for_new_sheet(self):
+        sheet_index = self.ss_con.sheet_index
+        self.spreadsheet.sheets.create("Sheet2")
+        self.assertNotIn("Sheet2", sheet_index)
+
+        self.ss_con.lock_spreadsheet()
+        self.ss_con.set_cells("Sheet2", "A1", 5)
+        self.assertEqual(self.ss_con.get_cells("Sheet2", "A1"), 5)
+        self.assertEqual(self.ss_con.get_sheet_names(), ["Sheet1", "Sheet2"])
+        self.ss_con.unlock_spreadsheet()
+
     def test_save_spreadsheet(self):
         path = "./saved_spreadsheets/" + EXAMPLE_SPREADSHEET + ".new"
 
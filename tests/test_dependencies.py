@@ -0,0 +1,84 @@
+import unittest
+
+from .context import DependencyIndex
+
+SHEET_NAME = "Sheet1"
+
+
+class TestDependencies(unittest.TestCase):
+    def setUp(self):
+        # Build an empty index without a spreadsheet and add formulas to it.
+        self.index = DependencyIndex.__new__(DependencyIndex)
+        self.index.precedents = {}
+        self.index.unknown = set()
+        self.index.ranges = {}
+
+    def add(self, row, column, formula, names=()):
+        self.index._DependencyIndex__add_formula(
+            (SHEET_NAME, row, column), formula, set(names)
+        )
+
+    def test_references(self):
+        self.add(2, 2, "=A1+$B$2*LOG10(Sheet2.C3:D4)")
+        self.assertEqual(
+            self.index.precedents[(SHEET_NAME, 2, 2)],
+            [
+                (SHEET_NAME, 0, 0, 0, 0),
+                (SHEET_NAME, 1, 1, 1, 1),
+                ("Sheet2", 2, 3, 2, 3),
+            ],
+        )
+
+    def test_quoted_sheet_and_whole_column(self):
+        self.add(0, 0, "=SUM($'My sheet'.B:B)")
+        self.assertEqual(
+            self.index.precedents[(SHEET_NAME, 0, 0)],
+            [("My sheet", 0, 1048575, 1, 1)],
+        )
+
+    def test_string_is_not_a_reference(self):
+        self.add(0, 0, '="A5"')
+        self.assertEqual(self.index.precedents[(SHEET_NAME, 0, 0)], [])
+
+    def test_unknown_precedents(self):
+        self.add(0, 0, '=INDIRECT("A1")')
+        self.add(1, 0, "=rate*2", names=["rate"])
+        self.assertEqual(
+            self.index.unknown, {(SHEET_NAME, 0, 0), (SHEET_NAME, 1, 0)}
+        )
+
+    def test_dependents(self):
+        self.add(2, 2, "=A1+1")  # C3
+        self.add(3, 3, "=C3*2")  # D4
+        self.add(4, 4, "=B1")  # E5
+
+        dependents = self.index.dependents([(SHEET_NAME, 0, 0)])
+        self.assertEqual(dependents, {(SHEET_NAME, 2, 2), (SHEET_NAME, 3, 3)})
+
+    def test_dependents_of_unknown_precedents(self):
+        self.add(0, 3, '=INDIRECT("A1")')  # D1
+        self.add(0, 4, "=D1*2")  # E1
+
+        changed = [(SHEET_NAME, 0, 0)]
+        self.assertEqual(
+            self.index.dependents(changed),
+            {(SHEET_NAME, 0, 3), (SHEET_NAME, 0, 4)},
+        )
+        self.assertTrue(
+            self.index.any_affected(changed, [(SHEET_NAME, 0, 0, 4, 4)])
+        )
+
+    def test_any_affected(self):
+        self.add(2, 2, "=A1+1")  # C3
+
+        changed = [(SHEET_NAME, 0, 0)]
+        self.assertTrue(
+            self.index.any_affected(changed, [(SHEET_NAME, 0, 5, 2, 2)])
+        )
+        self.assertFalse(
+            self.index.any_affected(changed, [(SHEET_NAME, 0, 5, 4, 4)])
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
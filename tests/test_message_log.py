@@ -0,0 +1,96 @@
+import logging
+import unittest
+
+from .context import MessageLog
+
+EXAMPLE_SPREADSHEET = "example.ods"
+
+
+class Payload:
+    """Counts how many times it is formatted for the log."""
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "payload"
+
+
+class TestMessageLog(unittest.TestCase):
+    def test_summary(self):
+        log = MessageLog()
+        msg = ["GET", "Sheet1", "A1:C3"]
+
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            log.received(EXAMPLE_SPREADSHEET, msg, 30)
+            log.sent(EXAMPLE_SPREADSHEET, "GET", [[1, 2, 3]], 14, 0.0015)
+
+        self.assertEqual(
+            logs.output,
+            [
+                "DEBUG:root:Received GET example.ods Sheet1!A1:C3 30 bytes",
+                "DEBUG:root:Sent GET example.ods 14 bytes 1.500 ms",
+            ],
+        )
+
+    def test_request(self):
+        log = MessageLog()
+        msg = ["REQUEST", 1, ["SET", "Sheet1", "B2", 5]]
+
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            log.received(None, msg, 40)
+
+        self.assertEqual(
+            logs.output,
+            ["DEBUG:root:Received REQUEST:SET - Sheet1!B2 40 bytes"],
+        )
+
+    def test_payloads(self):
+        log = MessageLog(payloads=True)
+        payload = Payload()
+
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            log.sent(EXAMPLE_SPREADSHEET, "GET", payload, 7, 0.001)
+
+        self.assertEqual(logs.output[-1], "INFO:root:Sent: payload")
+        self.assertEqual(payload.formatted, 1)
+
+    def test_payloads_without_summary(self):
+        log = MessageLog(payloads=True)
+
+        with self.assertLogs(level=logging.INFO) as logs:
+            log.received(EXAMPLE_SPREADSHEET, ["PING"], 10)
+
+        self.assertEqual(logs.output, ["INFO:root:Received: ['PING']"])
+
+    def test_payloads_not_formatted_unless_logged(self):
+        log = MessageLog(payloads=True)
+        payload = Payload()
+
+        root = logging.getLogger()
+        level = root.level
+        root.setLevel(logging.WARNING)
+        try:
+            log.sent(EXAMPLE_SPREADSHEET, "GET", payload, 7, 0.001)
+        finally:
+            root.setLevel(level)
+
+        self.assertEqual(payload.formatted, 0)
+
+    def test_sample_rate(self):
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            MessageLog(sample_rate=1.0).received(None, ["PING"], 10)
+            MessageLog(sample_rate=0.0).received(None, ["PING"], 10)
+
+        self.assertEqual(
+            logs.output,
+            [
+                "DEBUG:root:Received PING - - 10 bytes",
+                "INFO:root:Received: ['PING']",
+                "DEBUG:root:Received PING - - 10 bytes",
+            ],
+        )
+
+    def test_invalid_sample_rate(self):
+        self.assertRaises(ValueError, MessageLog, sample_rate=2)
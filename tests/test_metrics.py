@@ -0,0 +1,84 @@
+import unittest
+from threading import Thread
+from urllib.request import urlopen
+
+from .context import Histogram, Metrics, MetricsHTTPServer
+
+EXAMPLE_SPREADSHEET = "example.ods"
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        self.assertEqual(
+            histogram.cumulative(), [(0.1, 2), (1.0, 3), ("+Inf", 4)]
+        )
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+
+    def test_snapshot(self):
+        self.metrics.count(EXAMPLE_SPREADSHEET, "GET")
+        self.metrics.count(EXAMPLE_SPREADSHEET, "GET", error=True)
+        self.metrics.observe("execute", EXAMPLE_SPREADSHEET, "GET", 0.002)
+        self.metrics.open_session(EXAMPLE_SPREADSHEET)
+        self.metrics.queue_depths = lambda: {EXAMPLE_SPREADSHEET: 3}
+
+        stats = self.metrics.snapshot()
+        self.assertEqual(
+            stats["requests"][EXAMPLE_SPREADSHEET]["GET"],
+            {"count": 2, "errors": 1},
+        )
+        execute = stats["latency"][EXAMPLE_SPREADSHEET]["GET"]["execute"]
+        self.assertEqual(execute["count"], 1)
+        self.assertEqual(execute["buckets"][-1], ["+Inf", 1])
+        self.assertEqual(stats["sessions"], {EXAMPLE_SPREADSHEET: 1})
+        self.assertEqual(stats["queue_depth"], {EXAMPLE_SPREADSHEET: 3})
+
+        self.metrics.close_session(EXAMPLE_SPREADSHEET)
+        self.assertEqual(self.metrics.snapshot()["sessions"], {})
+
+    def test_time(self):
+        with self.metrics.time("lock_wait", EXAMPLE_SPREADSHEET, "SET"):
+            pass
+
+        stats = self.metrics.snapshot()
+        lock_wait = stats["latency"][EXAMPLE_SPREADSHEET]["SET"]["lock_wait"]
+        self.assertEqual(lock_wait["count"], 1)
+
+    def test_prometheus(self):
+        self.metrics.count('say "hi".ods', "GET")
+        self.metrics.observe("send", 'say "hi".ods', "GET", 0.3)
+
+        text = self.metrics.prometheus()
+        self.assertIn(
+            "spreadsheet_server_requests_total"
+            '{spreadsheet="say \\"hi\\".ods",command="GET"} 1\n',
+            text,
+        )
+        self.assertIn('stage="send",le="0.5"} 1\n', text)
+        self.assertIn('stage="send",le="+Inf"} 1\n', text)
+        self.assertIn("# TYPE spreadsheet_server_sessions gauge\n", text)
+
+    def test_http_server(self):
+        self.metrics.count(EXAMPLE_SPREADSHEET, "GET")
+
+        server = MetricsHTTPServer(self.metrics, ("localhost", 0))
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            url = "http://localhost:%d/metrics" % server.server_address[1]
+            with urlopen(url) as response:
+                text = response.read().decode("utf-8")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertEqual(text, self.metrics.prometheus())
@@ -75,6 +75,154 @@ class TestMonitor(unittest.TestCase):
         self.assertTrue(EXAMPLE_SPREADSHEET in spreadsheets)
         self.assertTrue(EXAMPLE_SPREADSHEET in locks)
 
+    def test_replica_per_soffice(self):
+        replicas = self.monitor_thread.spreadsheets[EXAMPLE_SPREADSHEET]
+        locks = self.monitor_thread.locks[EXAMPLE_SPREADSHEET]
+
+        self.assertEqual(len(replicas), len(self.spreadsheet_server.soffices))
+        self.assertEqual(len(locks), len(replicas))
+
+    def test_open_spreadsheet(self):
+        self.assertTrue(
+            self.monitor_thread.open_spreadsheet(EXAMPLE_SPREADSHEET)
+        )
+        self.assertFalse(
+            self.monitor_thread.open_spreadsheet(EXAMPLE_SPREADSHEET + "z")
+        )
+
+    def test_lazy_load_closes_least_recently_used(self):
+        current_loc = SPREADSHEETS_PATH + "/" + EXAMPLE_SPREADSHEET
+        copied_loc = SPREADSHEETS_PATH + "/" + EXAMPLE_SPREADSHEET_MOVED
+        shutil.copyfile(current_loc, copied_loc)
+
+        monitor = MonitorThread(
+            {},
+            {},
+            {},
+            self.spreadsheet_server.soffices,
+            SPREADSHEETS_PATH,
+            1,
+            True,
+            lazy_load=True,
+            max_loaded=1,
+        )
+
+        try:
+            monitor._MonitorThread__full_scan()
+            self.assertEqual(monitor.spreadsheets, {})
+
+            # Registered files are only logged when they are first found.
+            with self.assertLogs(level="DEBUG") as logs:
+                monitor._MonitorThread__full_scan()
+            self.assertFalse(
+                any("Registering" in line for line in logs.output)
+            )
+
+            self.assertTrue(monitor.open_spreadsheet(EXAMPLE_SPREADSHEET))
+            monitor.unpin_spreadsheet(EXAMPLE_SPREADSHEET)
+            self.assertTrue(
+                monitor.open_spreadsheet(EXAMPLE_SPREADSHEET_MOVED)
+            )
+            self.assertEqual(
+                list(monitor.spreadsheets), [EXAMPLE_SPREADSHEET_MOVED]
+            )
+
+            # A pinned spreadsheet is not closed, even over budget.
+            self.assertTrue(monitor.open_spreadsheet(EXAMPLE_SPREADSHEET))
+            self.assertEqual(
+                set(monitor.spreadsheets),
+                {EXAMPLE_SPREADSHEET, EXAMPLE_SPREADSHEET_MOVED},
+            )
+            monitor.unpin_spreadsheet(EXAMPLE_SPREADSHEET)
+            monitor.unpin_spreadsheet(EXAMPLE_SPREADSHEET_MOVED)
+        finally:
+            for doc_path in list(monitor.spreadsheets):
+                monitor._MonitorThread__unload_spreadsheet(doc_path)
+            os.remove(copied_loc)
+
+    def test_lazy_load_closes_one_per_open(self):
+        current_loc = SPREADSHEETS_PATH + "/" + EXAMPLE_SPREADSHEET
+        copies = ["example_1.ods", "example_2.ods"]
+        for copy in copies:
+            shutil.copyfile(current_loc, SPREADSHEETS_PATH + "/" + copy)
+
+        monitor = MonitorThread(
+            {},
+            {},
+            {},
+            self.spreadsheet_server.soffices,
+            SPREADSHEETS_PATH,
+            1,
+            True,
+            lazy_load=True,
+        )
+
+        try:
+            monitor._MonitorThread__full_scan()
+            for doc_path in [EXAMPLE_SPREADSHEET] + copies:
+                self.assertTrue(monitor.open_spreadsheet(doc_path))
+                monitor.unpin_spreadsheet(doc_path)
+
+            # Opening a spreadsheet makes room for only itself, even though
+            # two must go to be within budget.
+            monitor.max_loaded = 1
+            self.assertTrue(monitor.open_spreadsheet(EXAMPLE_SPREADSHEET))
+            monitor.unpin_spreadsheet(EXAMPLE_SPREADSHEET)
+            self.assertEqual(
+                set(monitor.spreadsheets), {EXAMPLE_SPREADSHEET, copies[1]}
+            )
+        finally:
+            for doc_path in list(monitor.spreadsheets):
+                monitor._MonitorThread__unload_spreadsheet(doc_path)
+            for copy in copies:
+                os.remove(SPREADSHEETS_PATH + "/" + copy)
+
+    def test_restore_replica(self):
+        replica = self.monitor_thread.spreadsheets[EXAMPLE_SPREADSHEET][0]
+        lock = self.monitor_thread.locks[EXAMPLE_SPREADSHEET][0]
+
+        lock.acquire()
+        replica.sheets[SHEET_NAME][0, 0].value = 99
+        self.monitor_thread.restore_replica(EXAMPLE_SPREADSHEET, 0)
+        lock.release()
+
+        restored = self.monitor_thread.spreadsheets[EXAMPLE_SPREADSHEET][0]
+        self.assertNotEqual(restored.sheets[SHEET_NAME][0, 0].value, 99)
+
+    def test_restore_replica_from_spare(self):
+        monitor = MonitorThread(
+            {},
+            {},
+            {},
+            self.spreadsheet_server.soffices,
+            SPREADSHEETS_PATH,
+            1,
+            True,
+            spare_replicas=True,
+        )
+
+        try:
+            monitor._MonitorThread__full_scan()
+            spares = monitor.spares[EXAMPLE_SPREADSHEET]
+            while spares[0] is None:
+                sleep(0.1)
+            spare = spares[0][0]
+
+            replica = monitor.spreadsheets[EXAMPLE_SPREADSHEET][0]
+            replica.sheets[SHEET_NAME][0, 0].value = 99
+            monitor.restore_replica(EXAMPLE_SPREADSHEET, 0)
+
+            # The spare is swapped in and the next one opened.
+            restored = monitor.spreadsheets[EXAMPLE_SPREADSHEET][0]
+            self.assertIs(restored, spare)
+            self.assertNotEqual(restored.sheets[SHEET_NAME][0, 0].value, 99)
+            while spares[0] is None:
+                sleep(0.1)
+            self.assertIsNot(spares[0][0], spare)
+        finally:
+            for doc_path in list(monitor.spreadsheets):
+                monitor._MonitorThread__unload_spreadsheet(doc_path)
+
     def test_check_removed_when_renamed(self):
         # Rename example.ods to example_moved.ods
 
@@ -102,6 +250,32 @@ class TestMonitor(unittest.TestCase):
         # Move it back to where it was
         os.rename(moved_loc, current_loc)
 
+    def test_update_spreadsheet_when_renamed(self):
+        current_loc = SPREADSHEETS_PATH + "/" + EXAMPLE_SPREADSHEET
+        moved_loc = SPREADSHEETS_PATH + "/" + EXAMPLE_SPREADSHEET_MOVED
+
+        os.rename(current_loc, moved_loc)
+
+        update = self.monitor_thread._MonitorThread__update_spreadsheet
+        update(EXAMPLE_SPREADSHEET)
+        update(EXAMPLE_SPREADSHEET_MOVED)
+
+        self.assertTrue(
+            EXAMPLE_SPREADSHEET not in self.monitor_thread.spreadsheets
+        )
+        self.assertTrue(
+            EXAMPLE_SPREADSHEET_MOVED in self.monitor_thread.spreadsheets
+        )
+
+        # Move it back to where it was
+        os.rename(moved_loc, current_loc)
+        update(EXAMPLE_SPREADSHEET_MOVED)
+        update(EXAMPLE_SPREADSHEET)
+
+    def test_unchanged_file_not_rehashed(self):
+        self.monitor_thread._MonitorThread__full_scan()
+        self.assertEqual(self.monitor_thread.last_scan_rehashed, 0)
+
     def test_change_file_hash(self):
         # Save the example file with a modification
 
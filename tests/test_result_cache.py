@@ -0,0 +1,67 @@
+import unittest
+
+from .context import ResultCache
+
+EXAMPLE_SPREADSHEET = "example.ods"
+OPERATIONS = [["SET", "Sheet1", "A1", 5], ["GET", "Sheet1", "C3"]]
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResultCache(2)
+
+    def test_get_missing(self):
+        self.assertIsNone(self.cache.get(EXAMPLE_SPREADSHEET, "a", OPERATIONS))
+
+    def test_put_get(self):
+        self.cache.put(EXAMPLE_SPREADSHEET, "a", OPERATIONS, ["OK", 6])
+        responses = self.cache.get(EXAMPLE_SPREADSHEET, "a", OPERATIONS)
+        self.assertEqual(responses, ["OK", 6])
+
+    def test_different_hash(self):
+        self.cache.put(EXAMPLE_SPREADSHEET, "a", OPERATIONS, ["OK", 6])
+        self.assertIsNone(self.cache.get(EXAMPLE_SPREADSHEET, "b", OPERATIONS))
+
+    def test_least_recently_used_dropped(self):
+        self.cache.put(EXAMPLE_SPREADSHEET, "a", OPERATIONS, ["OK", 1])
+        self.cache.put(EXAMPLE_SPREADSHEET, "b", OPERATIONS, ["OK", 2])
+        self.cache.get(EXAMPLE_SPREADSHEET, "a", OPERATIONS)
+        self.cache.put(EXAMPLE_SPREADSHEET, "c", OPERATIONS, ["OK", 3])
+
+        self.assertIsNotNone(
+            self.cache.get(EXAMPLE_SPREADSHEET, "a", OPERATIONS)
+        )
+        self.assertIsNone(self.cache.get(EXAMPLE_SPREADSHEET, "b", OPERATIONS))
+
+    def test_state(self):
+        self.cache.put(EXAMPLE_SPREADSHEET, "a", OPERATIONS, ["OK", 6])
+        state = self.cache.state(EXAMPLE_SPREADSHEET, 0)
+
+        written = self.cache.advance(state, [OPERATIONS[0]])
+        self.assertNotEqual(written, state)
+        self.assertEqual(written, self.cache.advance(state, [OPERATIONS[0]]))
+        self.assertIsNone(
+            self.cache.get(EXAMPLE_SPREADSHEET, "a", OPERATIONS, written)
+        )
+
+        self.cache.set_state(EXAMPLE_SPREADSHEET, 0, written)
+        self.assertEqual(self.cache.state(EXAMPLE_SPREADSHEET, 0), written)
+        self.assertEqual(self.cache.state(EXAMPLE_SPREADSHEET, 1), state)
+        self.assertIsNone(self.cache.advance(None, [OPERATIONS[0]]))
+
+    def test_invalidate(self):
+        self.cache.put(EXAMPLE_SPREADSHEET, "a", OPERATIONS, ["OK", 6])
+        self.cache.set_state(EXAMPLE_SPREADSHEET, 0, None)
+        self.cache.invalidate(EXAMPLE_SPREADSHEET)
+        self.assertIsNone(self.cache.get(EXAMPLE_SPREADSHEET, "a", OPERATIONS))
+        self.assertEqual(self.cache.state(EXAMPLE_SPREADSHEET, 0), "")
+
+    def test_operations_with_bytes(self):
+        operations = [["SET_ARRAY", "Sheet1", "A1", {"data": bytes(8)}]]
+        self.cache.put(EXAMPLE_SPREADSHEET, "a", operations, ["OK"])
+        responses = self.cache.get(EXAMPLE_SPREADSHEET, "a", operations)
+        self.assertEqual(responses, ["OK"])
+
+
+if __name__ == "__main__":
+    unittest.main()
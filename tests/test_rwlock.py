@@ -0,0 +1,65 @@
+import threading
+import time
+import unittest
+
+from .context import ReaderWriterLock
+
+
+class TestReaderWriterLock(unittest.TestCase):
+    def setUp(self):
+        self.lock = ReaderWriterLock()
+
+    def test_many_readers(self):
+        self.assertTrue(self.lock.acquire_read())
+        self.assertTrue(self.lock.acquire_read(blocking=False))
+        self.assertTrue(self.lock.locked())
+        self.assertFalse(self.lock.acquire(blocking=False))
+
+        self.lock.release_read()
+        self.lock.release_read()
+        self.assertFalse(self.lock.locked())
+
+    def test_one_writer(self):
+        self.assertTrue(self.lock.acquire())
+        self.assertFalse(self.lock.acquire(blocking=False))
+        self.assertFalse(self.lock.acquire_read(blocking=False))
+        self.assertFalse(self.lock.acquire_read(timeout=0.01))
+
+        self.lock.release()
+        self.assertTrue(self.lock.acquire_read(blocking=False))
+
+    def test_release_unlocked(self):
+        self.assertRaises(RuntimeError, self.lock.release)
+        self.assertRaises(RuntimeError, self.lock.release_read)
+
+    def test_waiting_writer_blocks_new_readers(self):
+        self.lock.acquire_read()
+
+        writer = threading.Thread(target=self.lock.acquire)
+        writer.start()
+        while not self.lock.waiting:
+            time.sleep(0.001)
+
+        # A reader that arrives after the writer waits for it.
+        self.assertFalse(self.lock.acquire_read(blocking=False))
+
+        self.lock.release_read()
+        writer.join()
+        self.assertTrue(self.lock.writer)
+        self.lock.release()
+
+    def test_waiting_readers_enter_together(self):
+        self.lock.acquire()
+
+        readers = [
+            threading.Thread(target=self.lock.acquire_read) for i in range(3)
+        ]
+        for reader in readers:
+            reader.start()
+        while len(self.lock.waiting) < 3:
+            time.sleep(0.001)
+
+        self.lock.release()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(self.lock.readers, 3)
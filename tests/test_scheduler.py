@@ -0,0 +1,126 @@
+import threading
+import time
+import unittest
+
+from .context import ReaderWriterLock, Scheduler, SchedulerBusy
+
+EXAMPLE_SPREADSHEET = "example.ods"
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.locks = [ReaderWriterLock(), ReaderWriterLock()]
+
+    def wait_for_queue(self, scheduler, length):
+        while scheduler.depths().get(EXAMPLE_SPREADSHEET, 0) < length:
+            time.sleep(0.001)
+
+    def test_free_replica(self):
+        scheduler = Scheduler()
+        self.locks[0].acquire()
+        replica = scheduler.acquire(EXAMPLE_SPREADSHEET, self.locks)
+        self.assertEqual(replica, 1)
+        self.assertTrue(self.locks[1].locked())
+
+    def test_queue_full(self):
+        scheduler = Scheduler(max_queue_depth=0)
+        for lock in self.locks:
+            lock.acquire()
+        self.assertRaises(
+            SchedulerBusy, scheduler.acquire, EXAMPLE_SPREADSHEET, self.locks
+        )
+
+    def test_client_quota(self):
+        scheduler = Scheduler(max_queued_per_client=1)
+        for lock in self.locks:
+            lock.acquire()
+        served = []
+
+        def acquire():
+            served.append(
+                scheduler.acquire(EXAMPLE_SPREADSHEET, self.locks, client="a")
+            )
+
+        waiter = threading.Thread(target=acquire)
+        waiter.start()
+        self.wait_for_queue(scheduler, 1)
+
+        self.assertRaises(
+            SchedulerBusy,
+            scheduler.acquire,
+            EXAMPLE_SPREADSHEET,
+            self.locks,
+            client="a",
+        )
+
+        # The waiter is still served once a replica is free.
+        self.locks[1].release()
+        scheduler.notify()
+        waiter.join()
+        self.assertEqual(served, [1])
+        self.assertEqual(scheduler.queued, {})
+
+    def test_queue_timeout(self):
+        scheduler = Scheduler(queue_timeout=0.05)
+        for lock in self.locks:
+            lock.acquire()
+        self.assertRaises(
+            SchedulerBusy, scheduler.acquire, EXAMPLE_SPREADSHEET, self.locks
+        )
+        self.assertEqual(scheduler.depths(), {})
+        self.assertEqual(scheduler.queues, {})
+
+    def test_priority(self):
+        scheduler = Scheduler()
+        locks = self.locks[:1]
+        locks[0].acquire()
+        served = []
+
+        def acquire(name, priority):
+            scheduler.acquire(EXAMPLE_SPREADSHEET, locks, priority=priority)
+            served.append(name)
+            locks[0].release()
+            scheduler.notify()
+
+        low = threading.Thread(target=acquire, args=("low", 0))
+        low.start()
+        self.wait_for_queue(scheduler, 1)
+        high = threading.Thread(target=acquire, args=("high", 1))
+        high.start()
+        self.wait_for_queue(scheduler, 2)
+
+        locks[0].release()
+        scheduler.notify()
+        low.join()
+        high.join()
+        self.assertEqual(served, ["high", "low"])
+
+    def test_replica_queues(self):
+        scheduler = Scheduler()
+        for lock in self.locks:
+            lock.acquire()
+        served = []
+
+        def acquire(replica):
+            scheduler.acquire(EXAMPLE_SPREADSHEET, self.locks, replica=replica)
+            served.append(replica)
+
+        first = threading.Thread(target=acquire, args=(0,))
+        first.start()
+        self.wait_for_queue(scheduler, 1)
+        second = threading.Thread(target=acquire, args=(1,))
+        second.start()
+        self.wait_for_queue(scheduler, 2)
+
+        # The request for the second replica does not wait behind the one
+        # for the first, and is woken as soon as its replica is unlocked.
+        self.locks[1].release()
+        scheduler.notify(EXAMPLE_SPREADSHEET, 1)
+        second.join(0.5)
+        self.assertFalse(second.is_alive())
+        self.assertEqual(served, [1])
+
+        self.locks[0].release()
+        scheduler.notify(EXAMPLE_SPREADSHEET, 0)
+        first.join()
+        self.assertEqual(served, [1, 0])
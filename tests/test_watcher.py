@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from .context import EVENT_HEADER, IN_Q_OVERFLOW, OVERFLOW, InotifyWatcher
+
+
+class TestInotifyWatcher(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        try:
+            self.watcher = InotifyWatcher(self.path)
+        except RuntimeError:
+            shutil.rmtree(self.path)
+            self.skipTest("inotify is not available")
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.path)
+
+    def test_file_reported_once_written(self):
+        path = os.path.join(self.path, "example.ods")
+
+        with open(path, "wb") as f:
+            f.write(b"0123456789")
+            f.flush()
+            # The file is still being written.
+            self.assertEqual(self.watcher.read(0.1), [])
+            f.write(b"0123456789")
+
+        self.assertEqual(self.watcher.read(0.1), [(path, False, False)])
+
+    def test_directory(self):
+        path = os.path.join(self.path, "dir")
+        os.mkdir(path)
+        self.assertEqual(self.watcher.read(0.1), [(path, True, False)])
+
+        os.rmdir(path)
+        events = self.watcher.read(0.1)
+        self.assertIn((path, True, True), events)
+
+    def test_overflow(self):
+        # The kernel reports lost events with a watch descriptor of -1.
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, EVENT_HEADER.pack(-1, IN_Q_OVERFLOW, 0, 0))
+        os.close(write_fd)
+        os.close(self.watcher.fd)
+        self.watcher.fd = read_fd
+
+        self.assertEqual(self.watcher.read(0.1), [OVERFLOW])
@@ -0,0 +1,69 @@
+import socket
+import threading
+import unittest
+
+from .context import (
+    decode_message,
+    encode_message,
+    receive_exactly,
+    send_frame,
+)
+
+
+class TestWire(unittest.TestCase):
+    def test_json(self):
+        msg = ["RESPONSE", 1, [[1, 2], [3, "a"]]]
+        self.assertEqual(decode_message(encode_message(msg)), msg)
+
+    def test_binary_small_message_is_json(self):
+        msg = ["GET", "Sheet1", "A1:B2"]
+        encoded = encode_message(msg, "binary")
+        self.assertEqual(encoded[:1], b"J")
+        self.assertEqual(decode_message(encoded, "binary"), msg)
+
+    def test_binary_column(self):
+        msg = ["RESPONSE", 1, [0.5 * i for i in range(100)]]
+        encoded = encode_message(msg, "binary")
+        self.assertEqual(encoded[:1], b"A")
+        self.assertEqual(decode_message(encoded, "binary"), msg)
+
+    def test_binary_range_with_strings(self):
+        cells = [[float(i), "" if i % 3 else "x"] for i in range(50)]
+        msg = {"A1:B50": cells, "C1": 6.0}
+        decoded = decode_message(encode_message(msg, "binary"), "binary")
+        self.assertEqual(decoded, msg)
+
+    def test_binary_ragged_rows(self):
+        msg = [[1.0] * 40, [2.0] * 41]
+        decoded = decode_message(encode_message(msg, "binary"), "binary")
+        self.assertEqual(decoded, msg)
+
+    def test_binary_tuples(self):
+        cells = tuple((float(i), float(i) + 0.5) for i in range(50))
+        encoded = encode_message(["RESPONSE", 1, cells], "binary")
+        self.assertEqual(encoded[:1], b"A")
+        decoded = decode_message(encoded, "binary")
+        rows = [list(row) for row in cells]
+        self.assertEqual(decoded, ["RESPONSE", 1, rows])
+
+    def test_bytes(self):
+        msg = {"shape": [2, 3], "data": bytes(range(13))}
+        for encoding in ("json", "binary"):
+            decoded = decode_message(encode_message(msg, encoding), encoding)
+            self.assertEqual(decoded, msg)
+            self.assertIsInstance(decoded["data"], bytearray)
+
+    def test_frame(self):
+        body = bytes(range(256)) * 4096
+        sender, receiver = socket.socketpair()
+        thread = threading.Thread(target=send_frame, args=(sender, body))
+        thread.start()
+
+        length = int.from_bytes(receive_exactly(receiver, 4), "big")
+        received = receive_exactly(receiver, length)
+        thread.join()
+
+        self.assertEqual(received, body)
+        sender.close()
+        self.assertIsNone(receive_exactly(receiver, 4))
+        receiver.close()
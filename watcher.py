@@ -0,0 +1,154 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# Files are reported once they have been written and closed, or moved in,
+# rather than when created, so that they are not read half written. Created
+# directories are reported so that they are watched too.
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# Reported by 'read' when the kernel's event queue overflowed and events were
+# lost, so the whole tree must be scanned again.
+OVERFLOW = (None, True, False)
+
+
+class InotifyWatcher:
+    """Watches a directory tree for changed files using Linux inotify.
+
+    A RuntimeError is raised on creation if inotify is not available, so that
+    the caller can fall back to polling.
+    """
+
+    def __init__(self, path):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.__add_watch = libc.inotify_add_watch
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            raise RuntimeError("inotify is not available.")
+
+        if self.fd < 0:
+            raise RuntimeError("inotify is not available.")
+
+        self.__add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+
+        self.path = path
+        self.watches = {}  # watch descriptor: directory path
+        self.add_tree(path)
+
+    def add_tree(self, path):
+        """Watch a directory and all the directories below it."""
+
+        self.__watch(path)
+        for root, dirs, files in os.walk(path, followlinks=True):
+            for d in dirs:
+                self.__watch(os.path.join(root, d))
+
+    def __watch(self, path):
+        wd = self.__add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = path
+
+    def read(self, timeout):
+        """Wait up to 'timeout' seconds for events and return a list of
+        (path, is_directory, removed) tuples for them. OVERFLOW is among them
+        if events have been lost.
+        """
+
+        ready = select.select([self.fd], [], [], timeout)
+        if not ready[0]:
+            return []
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Directories created meanwhile may not be watched yet.
+                self.add_tree(self.path)
+                events.append(OVERFLOW)
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                # The watch was removed, usually with its directory.
+                self.watches.pop(wd, None)
+                continue
+
+            if mask & IN_DELETE_SELF:
+                events.append((directory, True, True))
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name))
+            is_dir = bool(mask & IN_ISDIR)
+            removed = bool(mask & (IN_MOVED_FROM | IN_DELETE))
+
+            if mask & IN_CREATE and not is_dir:
+                # IN_CLOSE_WRITE follows once the file has been written.
+                continue
+
+            if is_dir and not removed:
+                self.add_tree(path)
+
+            events.append((path, is_dir, removed))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
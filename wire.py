@@ -0,0 +1,276 @@
+# Copyright (C) 2016 Robert Scott
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Encodings for the messages sent between the client and the server.
+
+Each message is prefixed by its length as a 4 byte big-endian unsigned int.
+JSON is the default. The binary encoding is asked for by the client in the
+SPREADSHEET handshake and used for every message after it. Large lists of cell
+values are then sent as a buffer of little-endian float64s, with a side-table
+of the cells that hold strings, rather than as JSON text. The rest of the
+message is JSON. Numbers come back as floats, as pyoo returns them.
+
+Messages can also hold raw bytes, e.g. the float64 buffer of GET_ARRAY. These
+are base64 encoded with JSON and are sent as they are with the binary encoding.
+They are decoded as a bytearray.
+"""
+
+import base64
+import json
+import struct
+import sys
+from array import array
+
+JSON = "json"
+BINARY = "binary"
+ENCODINGS = (JSON, BINARY)
+
+# Lists of fewer cell values than this are left in the JSON part.
+ARRAY_MIN_SIZE = 64
+
+JSON_TAG = b"J"  # The whole message is JSON
+ARRAY_TAG = b"A"  # A JSON header followed by the float64 buffer
+ARRAY_KEY = "$array"
+BYTES_KEY = "$bytes"
+BASE64_KEY = "$base64"
+
+# The arrays of GET_ARRAY and SET_ARRAY are little-endian float64s.
+ARRAY_DTYPE = "<f8"
+
+
+class _ArrayPacker:
+    """Replaces the lists of cell values in a message with references to the
+    float64 buffer."""
+
+    def __init__(self):
+        self.buffers = []
+        self.size = 0  # The number of float64s in the buffers
+
+    def pack(self, obj):
+        # pyoo returns the values of a range as tuples.
+        if type(obj) is list or type(obj) is tuple:
+            packed = self.__pack_values(obj)
+            if packed is not None:
+                return packed
+            return [self.pack(item) for item in obj]
+
+        if type(obj) is dict:
+            return {key: self.pack(value) for key, value in obj.items()}
+
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            return self.__pack_bytes(obj)
+
+        return obj
+
+    def __pack_bytes(self, obj):
+        """Add raw bytes to the buffer, padded to whole float64s."""
+
+        view = memoryview(obj).cast("B")
+        padding = -len(view) % 8
+
+        packed = {BYTES_KEY: [self.size, len(view)]}
+        self.buffers.append(view)
+        if padding:
+            self.buffers.append(bytes(padding))
+        self.size += (len(view) + padding) // 8
+        return packed
+
+    def __pack_values(self, obj):
+        """Pack a list of cell values, or a rectangular list of lists of them,
+        into the buffer. None is returned if obj is not one."""
+
+        if not obj:
+            return None
+
+        if type(obj[0]) is list or type(obj[0]) is tuple:
+            width = len(obj[0])
+            for row in obj:
+                row_type = type(row)
+                if row_type is not list and row_type is not tuple:
+                    return None
+                if len(row) != width:
+                    return None
+            values = [value for row in obj for value in row]
+            shape = [len(obj), width]
+        else:
+            values = obj
+            shape = [len(obj)]
+
+        if len(values) < ARRAY_MIN_SIZE:
+            return None
+
+        numbers = []
+        strings = {}
+        for i, value in enumerate(values):
+            value_type = type(value)
+            if value_type is float or value_type is int:
+                numbers.append(value)
+            elif value_type is str:
+                numbers.append(0.0)
+                strings[str(i)] = value
+            else:
+                return None
+
+        if len(strings) == len(values):
+            # Only strings, so nothing is saved over JSON.
+            return None
+
+        floats = array("d", numbers)
+        if sys.byteorder == "big":
+            floats.byteswap()
+
+        packed = {ARRAY_KEY: [self.size, shape, strings]}
+        self.buffers.append(floats.tobytes())
+        self.size += len(floats)
+        return packed
+
+
+def _unpack(obj, body):
+    """Replace the references to the buffer in a decoded header with the
+    values they refer to. 'body' is a memoryview of the buffer."""
+
+    if type(obj) is list:
+        return [_unpack(item, body) for item in obj]
+
+    if type(obj) is dict:
+        if len(obj) == 1 and ARRAY_KEY in obj:
+            offset, shape, strings = obj[ARRAY_KEY]
+            size = shape[0] if len(shape) == 1 else shape[0] * shape[1]
+
+            floats = array("d")
+            floats.frombytes(body[offset * 8 : (offset + size) * 8])
+            if sys.byteorder == "big":
+                floats.byteswap()
+
+            values = floats.tolist()
+            for i, string in strings.items():
+                values[int(i)] = string
+
+            if len(shape) == 2:
+                width = shape[1]
+                values = [
+                    values[row : row + width] for row in range(0, size, width)
+                ]
+            return values
+
+        if len(obj) == 1 and BYTES_KEY in obj:
+            offset, length = obj[BYTES_KEY]
+            return bytearray(body[offset * 8 : offset * 8 + length])
+
+        return {key: _unpack(value, body) for key, value in obj.items()}
+
+    return obj
+
+
+def _to_json(obj):
+    """Encode the types json does not know about."""
+
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return {BASE64_KEY: str(base64.b64encode(obj), encoding="ascii")}
+
+    raise TypeError("%s is not JSON serializable" % type(obj).__name__)
+
+
+def _from_json(obj):
+    if len(obj) == 1 and BASE64_KEY in obj:
+        return bytearray(base64.b64decode(obj[BASE64_KEY]))
+    return obj
+
+
+def send_frame(sock, body):
+    """Send a message body prefixed by its length.
+
+    The length and the body are handed to the socket as separate buffers, so
+    the body is not copied to prepend the length.
+    """
+
+    header = struct.pack(">I", len(body))
+
+    if not hasattr(sock, "sendmsg"):
+        # sendmsg is not available on Windows.
+        sock.sendall(header + body)
+        return
+
+    buffers = [memoryview(header), memoryview(body)]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+
+        # Drop what was sent, which can end part way through a buffer.
+        while sent and buffers:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def receive_exactly(sock, length):
+    """Receive exactly 'length' bytes into a preallocated bytearray.
+
+    None is returned if the connection is closed first. socket.timeout is
+    raised if the socket has a timeout that passes.
+    """
+
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+
+    while received < length:
+        count = sock.recv_into(view[received:], length - received)
+        if count == 0:
+            return None
+        received += count
+
+    return data
+
+
+def encode_message(msg, encoding=JSON):
+    """Encode a message as bytes, without its length prefix."""
+
+    if encoding == JSON:
+        return bytes(json.dumps(msg, default=_to_json), "utf-8")
+
+    packer = _ArrayPacker()
+    header = packer.pack(msg)
+    if not packer.buffers:
+        return JSON_TAG + bytes(json.dumps(msg), "utf-8")
+
+    header = bytes(json.dumps(header), "utf-8")
+    return b"".join(
+        [ARRAY_TAG, struct.pack(">I", len(header)), header] + packer.buffers
+    )
+
+
+def decode_message(payload, encoding=JSON):
+    """Decode a message from the bytes encode_message returned."""
+
+    if encoding == JSON:
+        return json.loads(
+            str(payload, encoding="utf-8"), object_hook=_from_json
+        )
+
+    tag = payload[:1]
+    if tag == JSON_TAG:
+        return json.loads(str(payload[1:], encoding="utf-8"))
+
+    if tag != ARRAY_TAG:
+        raise ValueError("Unknown message encoding.")
+
+    header_length = struct.unpack(">I", payload[1:5])[0]
+    header = json.loads(str(payload[5 : 5 + header_length], encoding="utf-8"))
+
+    return _unpack(header, memoryview(payload)[5 + header_length :])